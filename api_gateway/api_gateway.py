@@ -1,23 +1,53 @@
-from fastapi import FastAPI, Depends, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, Depends, HTTPException, Header, Response, Query
+from pydantic import BaseModel, HttpUrl, Field
 import os
 import pika
 import json
 import uuid
-from sqlalchemy import create_engine, Column, String, Text, Integer, Float, BigInteger, DateTime
+from collections import namedtuple
+from sqlalchemy import create_engine, Column, String, Text, Integer, Float, BigInteger, DateTime, func, or_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import sessionmaker, Session
-from datetime import datetime
-from contextlib import asynccontextmanager
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager, nullcontext
 import logging 
 import logging.config
 import os
 
 from api_gateway.database import SessionLocal
-from api_gateway.models import GenerationRequest
+from api_gateway.models import GenerationRequest, TERMINAL_STATUSES, RESULT_STATUSES
 from api_gateway.tracing import tracer
 from api_gateway.logging_config import LOGGING_CONFIG
+from api_gateway.background import PeriodicTask
+from api_gateway import idempotency
+from api_gateway import result_cache
+from api_gateway import similarity
+from api_gateway import http_cache
+from api_gateway.estimator import ThroughputEstimator, retry_after_seconds, CAPACITY_REFRESH_SECONDS
+from api_gateway.singleflight import SingleFlight
+from api_gateway import bloom
+from api_gateway.notifications import PgNotificationListener, notify
+from api_gateway.webhooks import WebhookDispatcher, check_callback_url
+from api_gateway import leases
+from api_gateway.leader import AdvisoryLockLeader
+from api_gateway.reaper import StuckJobReaper, REAPER_INTERVAL_SECONDS, REAPER_LOCK_ID
+from api_gateway import cancellation
+from api_gateway import expiry
+from api_gateway.expiry import ExpiredJobConsumer
+from api_gateway import variants
+from api_gateway import batching
+from api_gateway import routing
+from api_gateway import fair_scheduler
+from api_gateway import rate_limit
+from api_gateway import scheduled_jobs
+from api_gateway import pregeneration
+from api_gateway import pipelines
+from api_gateway import progress
+from api_gateway import status_updates
+from api_gateway import queue_backends
+from api_gateway.metrics import NEAR_DUPLICATE_LOOKUPS, BLOOM_FILTER_LOOKUPS, STATUS_UPDATES
 
 from prometheus_fastapi_instrumentator import Instrumentator
 
@@ -55,6 +85,8 @@ class RabbitMQManager:
             self.channel = self.connection.channel()
             
             self.channel.queue_declare(queue=self.queue_name, durable=True)
+            if routing.TOPIC_ROUTING_ENABLED:
+                routing.declare_exchanges(self.channel, QUEUE_NAME)
             self.channel.confirm_delivery()
             
             logger.info("RabbitMQ connection and channel established successfully!")
@@ -88,9 +120,68 @@ RABBITMQ_USER = os.getenv("RABBITMQ_DEFAULT_USER", "user")
 RABBITMQ_PASS = os.getenv("RABBITMQ_DEFAULT_PASS", "password")
 QUEUE_NAME = "image_generation_queue"
 
+# broker queues the workers consume, keyed by lane name
+QUEUE_LANES = {"default": QUEUE_NAME}
+if batching.BATCH_PUBLISH_ENABLED:
+    QUEUE_LANES["batch"] = batching.BATCH_QUEUE_NAME
+
 rabbitmq_manager = RabbitMQManager(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, QUEUE_NAME)     
+# background tasks get their own connection, pika connections are not thread-safe
+monitor_rabbitmq_manager = RabbitMQManager(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, QUEUE_NAME)
+reaper_rabbitmq_manager = RabbitMQManager(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, QUEUE_NAME)
+expiry_rabbitmq_manager = RabbitMQManager(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, QUEUE_NAME)
+scheduler_rabbitmq_manager = RabbitMQManager(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, QUEUE_NAME)
+batch_rabbitmq_manager = RabbitMQManager(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, batching.BATCH_QUEUE_NAME)
+pregeneration_rabbitmq_manager = RabbitMQManager(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, pregeneration.PREGENERATION_QUEUE_NAME)
+results_rabbitmq_manager = RabbitMQManager(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, status_updates.RESULTS_QUEUE_NAME)
+
+def publish_task(queue, request_id, params, expires_at=None, variant_tasks=None, style=None, queue_name=QUEUE_NAME):
+    task_message = {
+        "request_id": request_id,
+        "params": params
+    }
+    if style:
+        task_message["style"] = style
+    if variant_tasks:
+        # one message for all seeds, the worker runs them as a single batched pass
+        task_message["variants"] = variant_tasks
+
+    exchange, routing_key = "", queue_name
+    if routing.TOPIC_ROUTING_ENABLED and queue_name == QUEUE_NAME:
+        # workers bind the model/style keys whose weights they keep loaded, the rest falls back to QUEUE_NAME
+        exchange, routing_key = routing.TASK_EXCHANGE, routing.routing_key(style)
+
+    with tracer.start_as_current_span("publish_to_rabbitmq") as pika_span:
+        pika_span.set_attribute("routing_key", routing_key)
+        pika_span.set_attribute("request_id", request_id)
+        pika_span.set_attribute("queue_backend", queue_backends.QUEUE_BACKEND)
+
+        queue.publish(queue_name, task_message, expires_at, exchange, routing_key)
+    if routed_depth and exchange:
+        routed_depth.record_published()
+
+
+def publish_batch_task(queue, jobs):
+    batch_message = {
+        "batch_id": str(uuid.uuid4()),
+        "jobs": [{"request_id": job.request_id, "params": job.params} for job in jobs]
+    }
+    if jobs[0].style:
+        # jobs are grouped by style, so the whole batch shares it
+        batch_message["style"] = jobs[0].style
+
+    with tracer.start_as_current_span("publish_batch_to_rabbitmq") as pika_span:
+        pika_span.set_attribute("routing_key", batching.BATCH_QUEUE_NAME)
+        pika_span.set_attribute("batch_size", len(jobs))
+
+        queue.publish(batching.BATCH_QUEUE_NAME, batch_message, batching.batch_expiration(jobs))
+
 
 def get_mq_channel():
+    if leases.pull_mode_enabled() or queue_backends.postgres_backend_enabled():
+        # workers lease jobs over HTTP or claim them from Postgres, there is no broker
+        return None
+
     channel = rabbitmq_manager.get_channel()
     if not channel:
         raise HTTPException(
@@ -100,9 +191,289 @@ def get_mq_channel():
     return channel
 
 
+def get_optional_mq_channel():
+    # for best-effort publishes that must not fail the request when the broker is down
+    try:
+        return get_mq_channel()
+    except HTTPException:
+        return None
+
+
+postgres_queue = queue_backends.PostgresQueueBackend(SessionLocal) if queue_backends.postgres_backend_enabled() else None
+
+
+def get_queue_backend():
+    if leases.pull_mode_enabled():
+        return None
+    if postgres_queue:
+        return postgres_queue
+    return queue_backends.RabbitMQBackend(get_mq_channel())
+
+
+def get_optional_queue_backend():
+    try:
+        return get_queue_backend()
+    except HTTPException:
+        return None
+
+
+def _background_queue(manager):
+    # background threads publish over their own connection, pika connections are not thread-safe
+    if postgres_queue:
+        return postgres_queue
+    channel = manager.get_channel()
+    return queue_backends.RabbitMQBackend(channel) if channel else None
+
+
+# styled tasks bypass QUEUE_NAME for the worker queues, which the broker's depth of QUEUE_NAME does not count.
+# Postgres keeps routed tasks in QUEUE_NAME itself.
+routed_depth = None
+routed_depth_refresher = None
+if routing.TOPIC_ROUTING_ENABLED and not postgres_queue:
+    routed_depth = routing.RoutedQueueDepth(lambda: routing.routed_queue_depth(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, QUEUE_NAME))
+    routed_depth_refresher = PeriodicTask("routed-queue-depth", routing.ROUTED_DEPTH_REFRESH_SECONDS, routed_depth.refresh)
+
+
+def _work_queue_depth(queue, queue_name=QUEUE_NAME):
+    # None when the depth is unknown
+    if routed_depth and queue_name == QUEUE_NAME:
+        return routed_depth.current()
+    return queue.depth(queue_name)
+
+
+idempotency_locks = idempotency.KeyedLocks()
+prompt_index = similarity.PromptIndex() if similarity.NEAR_DUPLICATE_ENABLED else None
+throughput_estimator = ThroughputEstimator()
+
+
+def _refresh_lane_depths():
+    queue = _background_queue(monitor_rabbitmq_manager)
+    if not queue:
+        return
+    for lane, queue_name in QUEUE_LANES.items():
+        depth = _work_queue_depth(queue, queue_name)
+        if depth is None:
+            continue
+        throughput_estimator.observe_lane(lane, depth.messages, depth.consumers)
+
+
+def _publish_batch(jobs):
+    # runs on the batching thread, which owns its own connection
+    queue = _background_queue(batch_rabbitmq_manager)
+    if not queue:
+        raise RuntimeError("Cannot connect to message queue")
+    publish_batch_task(queue, jobs)
+
+
+batch_publisher = batching.BatchingPublisher(_publish_batch) if batching.BATCH_PUBLISH_ENABLED else None
+BATCH_PUBLISH_TIMEOUT_SECONDS = batching.BATCH_MAX_WAIT_MS / 1000 + 10
+
+
+def _fair_scheduling_active():
+    return fair_scheduler.FAIR_SCHEDULING_ENABLED and not leases.pull_mode_enabled()
+
+
+def _fair_broker_capacity():
+    queue = _background_queue(scheduler_rabbitmq_manager)
+    if not queue:
+        return 0
+    depth = _work_queue_depth(queue)
+    if depth is None:
+        return 0
+    return fair_scheduler.broker_capacity(depth.messages, depth.consumers)
+
+
+def _dispatch_held_job(db, job):
+    queue = _background_queue(scheduler_rabbitmq_manager)
+    if not queue:
+        raise RuntimeError("Cannot connect to message queue")
+    children = variants.children_of(db, job.request_id) if job.num_variants else []
+    publish_task(queue, str(job.request_id), leases.task_params(job), job.expires_at, variants.task_variants(children), job.style)
+
+
+fair_dispatcher = fair_scheduler.FairDispatcher(
+    SessionLocal,
+    AdvisoryLockLeader(fair_scheduler.FAIR_SCHEDULER_LOCK_ID),
+    _fair_broker_capacity,
+    _dispatch_held_job
+)
+api_key_limiter = rate_limit.ApiKeyLimiter(SessionLocal)
+rate_limit_reconciler = PeriodicTask("rate-limit-reconcile", rate_limit.RATE_LIMIT_RECONCILE_SECONDS, api_key_limiter.reconcile)
+fair_dispatch_task = PeriodicTask("fair-dispatch", fair_scheduler.FAIR_SCHEDULER_INTERVAL_SECONDS, fair_dispatcher.run_once)
+# with fair scheduling on, due delayed jobs simply join their tenant's queue; otherwise they are released here.
+# Never both at once, so the two share the scheduler connection.
+scheduled_job_releaser = scheduled_jobs.ScheduledJobReleaser(
+    SessionLocal,
+    AdvisoryLockLeader(scheduled_jobs.SCHEDULED_RELEASE_LOCK_ID),
+    _dispatch_held_job
+)
+
+
+def _pregeneration_queue_depth():
+    queue = _background_queue(pregeneration_rabbitmq_manager)
+    if not queue:
+        # unknown depth is never treated as idle
+        return float("inf")
+    depth = _work_queue_depth(queue)
+    return float("inf") if depth is None else depth.messages
+
+
+def _publish_pregeneration(job):
+    queue = _background_queue(pregeneration_rabbitmq_manager)
+    if not queue:
+        raise RuntimeError("Cannot connect to message queue")
+    publish_task(queue, str(job.request_id), leases.task_params(job), style=job.style, queue_name=pregeneration.PREGENERATION_QUEUE_NAME)
+
+
+pregenerator = pregeneration.Pregenerator(
+    SessionLocal,
+    AdvisoryLockLeader(pregeneration.PREGENERATION_LOCK_ID),
+    _pregeneration_queue_depth,
+    _publish_pregeneration,
+    register_request_id=lambda db, request_uuid: _register_request_id(db, request_uuid),
+    remember_request_ids=lambda request_uuids: _remember_request_ids(request_uuids)
+)
+pregeneration_task = PeriodicTask("pregeneration", pregeneration.PREGENERATION_INTERVAL_SECONDS, pregenerator.run_once)
+scheduled_release_task = PeriodicTask("scheduled-job-release", scheduled_jobs.SCHEDULER_TICK_SECONDS, scheduled_job_releaser.run_once)
+capacity_refresher = PeriodicTask("capacity-refresh", CAPACITY_REFRESH_SECONDS, _refresh_lane_depths)
+progress_buffer = progress.ProgressBuffer(SessionLocal)
+progress_flusher = PeriodicTask("progress-flush", progress.PROGRESS_FLUSH_SECONDS, progress_buffer.flush)
+
+
+def _requeue_task(job):
+    if leases.pull_mode_enabled():
+        # Pending rows are picked up by the next lease
+        return
+    queue = _background_queue(reaper_rabbitmq_manager)
+    if not queue:
+        raise RuntimeError("Cannot connect to message queue")
+    publish_task(queue, str(job.request_id), leases.task_params(job), job.expires_at, style=job.style)
+
+
+def _requeue_stage(job, stage):
+    queue = _background_queue(reaper_rabbitmq_manager)
+    if not queue:
+        raise RuntimeError("Cannot connect to message queue")
+    _publish_stage(queue, job, stage)
+
+
+stuck_job_reaper = StuckJobReaper(
+    SessionLocal,
+    AdvisoryLockLeader(REAPER_LOCK_ID),
+    publish=_requeue_task,
+    on_terminal=lambda job: _finish_terminal_job(job),
+    publish_stage=_requeue_stage
+)
+reaper_task = PeriodicTask("stuck-job-reaper", REAPER_INTERVAL_SECONDS, stuck_job_reaper.run_once)
+status_reads = SingleFlight("status_read")
+notification_listener = PgNotificationListener()
+webhook_dispatcher = WebhookDispatcher()
+expired_job_consumer = ExpiredJobConsumer(
+    expiry_rabbitmq_manager,
+    SessionLocal,
+    on_expired=lambda job: _finish_terminal_job(job)
+)
+
+cancelled_requests = cancellation.CancellationSet()
+notification_listener.subscribe(
+    cancellation.CANCELLATIONS_CHANNEL,
+    cancelled_requests.on_notification,
+    on_connect=cancelled_requests.reload
+)
+
+known_request_ids = bloom.KnownRequestIds() if bloom.BLOOM_FILTER_ENABLED else None
+bloom_rebuilder = None
+if known_request_ids is not None:
+    # the listener's (re)connect triggers a full rebuild, so ids missed while disconnected are recovered
+    notification_listener.subscribe(bloom.REQUEST_IDS_CHANNEL, known_request_ids.on_notification, on_connect=known_request_ids.rebuild)
+    bloom_rebuilder = PeriodicTask("request-id-bloom-rebuild", bloom.BLOOM_REBUILD_INTERVAL_SECONDS, known_request_ids.rebuild)
+
+task_queue_purger = None
+if postgres_queue:
+    # wakes claims long-polling on an empty queue
+    notification_listener.subscribe(queue_backends.TASK_QUEUE_CHANNEL, postgres_queue.on_notification)
+    task_queue_purger = PeriodicTask("task-queue-purge", queue_backends.TASK_QUEUE_PURGE_INTERVAL_SECONDS, postgres_queue.purge_expired)
+
+
+def _apply_dead_letter_policy():
+    try:
+        queue_patterns = list(QUEUE_LANES.values())
+        if routing.TOPIC_ROUTING_ENABLED:
+            queue_patterns.append(routing.WORKER_QUEUE_PATTERN)
+        expiry.apply_dead_letter_policy(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, queue_patterns)
+    except Exception:
+        # expired messages are then dropped by the broker and the reaper's deadline sweep marks the jobs
+        logger.warning("Could not apply the dead-letter policy through the RabbitMQ management API", exc_info=True)
+
+
+idempotency_purger = PeriodicTask(
+    "idempotency-key-purge",
+    idempotency.IDEMPOTENCY_PURGE_INTERVAL_SECONDS,
+    idempotency.purge_expired_keys
+)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    idempotency_purger.start()
+    notification_listener.start()
+    webhook_dispatcher.start()
+    capacity_refresher.start()
+    progress_flusher.start()
+    reaper_task.start()
+    if task_queue_purger:
+        task_queue_purger.start()
+    elif not leases.pull_mode_enabled():
+        _apply_dead_letter_policy()
+        expired_job_consumer.start()
+        if status_updates.STATUS_RESULTS_ENABLED:
+            status_result_consumer.start()
+    if bloom_rebuilder:
+        bloom_rebuilder.start()
+    if batch_publisher:
+        batch_publisher.start()
+    if routed_depth_refresher:
+        routed_depth_refresher.start()
+    if _fair_scheduling_active():
+        fair_dispatch_task.start()
+    elif not leases.pull_mode_enabled():
+        scheduled_release_task.start()
+    if rate_limit.API_KEY_AUTH_ENABLED:
+        rate_limit_reconciler.start()
+    if pregeneration.PREGENERATION_ENABLED and result_cache.RESULT_CACHE_ENABLED and not leases.pull_mode_enabled():
+        pregeneration_task.start()
     yield
+    pregeneration_task.stop()
+    pregenerator.leader.release()
+    rate_limit_reconciler.stop()
+    fair_dispatch_task.stop()
+    fair_dispatcher.leader.release()
+    if routed_depth_refresher:
+        routed_depth_refresher.stop()
+    scheduled_release_task.stop()
+    scheduled_job_releaser.leader.release()
+    if batch_publisher:
+        batch_publisher.stop()
+    if bloom_rebuilder:
+        bloom_rebuilder.stop()
+    status_result_consumer.stop()
+    expired_job_consumer.stop()
+    if task_queue_purger:
+        task_queue_purger.stop()
+    reaper_task.stop()
+    stuck_job_reaper.leader.release()
+    progress_flusher.stop()
+    capacity_refresher.stop()
+    webhook_dispatcher.stop()
+    notification_listener.stop()
+    idempotency_purger.stop()
+    monitor_rabbitmq_manager.close()
+    reaper_rabbitmq_manager.close()
+    expiry_rabbitmq_manager.close()
+    batch_rabbitmq_manager.close()
+    scheduler_rabbitmq_manager.close()
+    pregeneration_rabbitmq_manager.close()
+    results_rabbitmq_manager.close()
     rabbitmq_manager.close()
 
 
@@ -123,73 +494,392 @@ def get_db():
         db.close()
 
 
+def get_api_key(db: Session = Depends(get_db), x_api_key: str | None = Header(default=None)):
+    if not rate_limit.API_KEY_AUTH_ENABLED:
+        return None
+    if not x_api_key:
+        raise HTTPException(status_code=401, detail="Missing X-API-Key header")
+    api_key = api_key_limiter.authenticate(db, x_api_key)
+    if api_key is None:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    return api_key
+
+
+def require_admin_api_key(api_key = Depends(get_api_key)):
+    if api_key is not None and api_key.plan != rate_limit.ADMIN_PLAN:
+        raise HTTPException(status_code=403, detail="API key is not allowed to call this endpoint")
+    return api_key
+
+
+def _charge_api_key(api_key, cost):
+    if api_key is None:
+        return
+    if cost > api_key.burst_steps:
+        raise HTTPException(status_code=422, detail="Job cost exceeds the API key's burst allowance")
+    try:
+        api_key_limiter.charge(api_key, cost)
+    except rate_limit.RateLimitExceeded as e:
+        logger.warning(f"Rejected request over limit for tenant {api_key.tenant_id}: {e.reason}")
+        raise HTTPException(status_code=429, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+
+
+def _refund_api_key(api_key, cost):
+    if api_key is not None:
+        api_key_limiter.refund(api_key, cost)
+
+
 class InferenceRequest(BaseModel):
     prompt: str
     negative_prompt: str = ""
     num_inference_steps: int = 50
     guidance_scale: float = 7.5
     seed: int = 50
+    callback_url: HttpUrl | None = None
+    ttl_seconds: int | None = Field(default=None, gt=0)
+    deadline: datetime | None = None
+    num_variants: int = Field(default=1, ge=1, le=variants.MAX_VARIANTS)
+    style: str | None = Field(default=None, pattern=routing.STYLE_PATTERN)
+    run_at: datetime | None = None
+    stages: list[str] | None = None
+
+
+# request fields the gateway handles itself and does not forward to workers
+GATEWAY_ONLY_FIELDS = {"callback_url", "ttl_seconds", "deadline", "num_variants", "style", "run_at", "stages"}
+
+
+def _find_reusable_image(db, request):
+    cached_image_url = result_cache.lookup(db, request)
+    # the prompt index only holds plain base generations
+    if cached_image_url or prompt_index is None or routing.explicit_style(request.style, request.prompt) or request.stages:
+        return cached_image_url
+
+    match = prompt_index.find(
+        request.prompt,
+        request.negative_prompt,
+        request.num_inference_steps,
+        request.guidance_scale,
+        request.seed
+    )
+    if match is None:
+        NEAR_DUPLICATE_LOOKUPS.labels(result="miss").inc()
+        return None
+
+    NEAR_DUPLICATE_LOOKUPS.labels(result="hit").inc()
+    logger.info(
+        "Matched near-duplicate prompt",
+        extra={"request_id": str(match.request_id), "score": match.score}
+    )
+    return match.image_url
+
+
+def _send_completion_callback(db_request):
+    if not db_request.callback_url or db_request.status not in TERMINAL_STATUSES:
+        return
+
+    payload = {
+        "request_id": str(db_request.request_id),
+        "status": db_request.status,
+        "image_url": db_request.image_url if db_request.status == "Completed" else None
+    }
+    webhook_dispatcher.enqueue(db_request.callback_url, payload)
+
+
+def _refresh_variant_parent(db, parent_request_id):
+    parent = variants.refresh_parent(db, parent_request_id)
+    if parent and parent.status in TERMINAL_STATUSES:
+        _send_completion_callback(parent)
+
+
+def _finish_terminal_job(job):
+    # background paths (reaper, expiry consumer) finish jobs outside any request session
+    _send_completion_callback(job)
+    if job.parent_request_id:
+        db = SessionLocal()
+        try:
+            _refresh_variant_parent(db, job.parent_request_id)
+        finally:
+            db.close()
+
+
+def _register_request_id(db, request_uuid):
+    # other replicas learn the id through NOTIFY once the transaction commits
+    if known_request_ids is not None:
+        notify(db, bloom.REQUEST_IDS_CHANNEL, str(request_uuid))
+
+
+def _remember_request_ids(request_uuids):
+    # only after the commit: a rebuild scanning meanwhile cannot see the row yet and would drop an earlier add
+    if known_request_ids is not None:
+        for request_uuid in request_uuids:
+            known_request_ids.add(request_uuid)
+
+
+def _ensure_known_request_id(request_uuid):
+    if known_request_ids is None or not known_request_ids.ready:
+        return
+    if not known_request_ids.might_exist(request_uuid):
+        BLOOM_FILTER_LOOKUPS.labels(result="negative").inc()
+        raise HTTPException(status_code=404, detail="request_id not found")
+    BLOOM_FILTER_LOOKUPS.labels(result="maybe").inc()
+
+
+def _save_request(db, request, idempotency_key=None, cached_image_url=None, expires_at=None, tenant_id=None, run_at=None):
+    db_request = GenerationRequest(
+        request_id = uuid.uuid4(),
+        prompt = request.prompt,
+        negative_prompt = request.negative_prompt,
+        num_inference_steps = request.num_inference_steps,
+        guidance_scale = request.guidance_scale,
+        seed = request.seed,
+        callback_url = str(request.callback_url) if request.callback_url else None,
+        expires_at = expires_at,
+        style = routing.resolve_style(request.style, request.prompt),
+        tenant_id = tenant_id,
+        run_at = run_at,
+        awaiting_dispatch = not cached_image_url and not leases.pull_mode_enabled() and (
+            _fair_scheduling_active() or scheduled_jobs.is_delayed(run_at)
+        ),
+        pipeline = pipelines.pipeline_value(request.stages)
+    )
+    if cached_image_url:
+        db_request.status = "Completed"
+        db_request.image_url = cached_image_url
+
+    children = []
+    if request.num_variants > 1:
+        db_request.num_variants = request.num_variants
+        db_request.created_at = datetime.utcnow()
+        children = variants.create_children(db_request, variants.variant_seeds(request.seed, request.num_variants))
+
+    db.add(db_request)
+    db.add_all(children)
+    if db_request.pipeline and not cached_image_url:
+        db.add_all(pipelines.create_stages(db_request.request_id, request.stages))
+    if idempotency_key:
+        idempotency.remember_request_id(db, idempotency_key, db_request.request_id)
+    request_uuids = [db_request.request_id] + [child.request_id for child in children]
+    for request_uuid in request_uuids:
+        _register_request_id(db, request_uuid)
+    db.commit()
+    _remember_request_ids(request_uuids)
+    db.refresh(db_request)
+    return db_request, children
 
 
 # save request id to db, send request to message queue, return request id to user
 @app.post("/generate", status_code=202)
-def generate_task(request: InferenceRequest, db: Session = Depends(get_db), channel: pika.channel.Channel = Depends(get_mq_channel)):
-
-    with tracer.start_as_current_span("save_request_to_db") as db_span:
-        db_request = GenerationRequest(
-            prompt = request.prompt,
-            negative_prompt = request.negative_prompt,
-            num_inference_steps = request.num_inference_steps,
-            guidance_scale = request.guidance_scale,
-            seed = request.seed
-        )
-        
-        db.add(db_request)
-        db.commit()
-        db.refresh(db_request)
-        generated_request_id = str(db_request.request_id)
-        
-        db_span.set_attribute("request_id", generated_request_id)
-        
-        logger.info(
-            "Saved request to database", 
-            extra={"request_id": generated_request_id}
-        )
-    
-    try:
-        task_message = {
-            "request_id": generated_request_id,
-            "params": request.model_dump()
-        }
-        
-        with tracer.start_as_current_span("publish_to_rabbitmq") as pika_span:
-            pika_span.set_attribute("routing_key", QUEUE_NAME)
-            pika_span.set_attribute("request_id", generated_request_id)
-            
-            channel.basic_publish(
-                exchange="",
-                routing_key=QUEUE_NAME,
-                body=json.dumps(task_message),
-                properties=pika.BasicProperties(delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE)
+def generate_task(
+    request: InferenceRequest,
+    db: Session = Depends(get_db),
+    queue: queue_backends.QueueBackend = Depends(get_queue_backend),
+    idempotency_key: str | None = Header(default=None),
+    x_tenant_id: str | None = Header(default=None),
+    api_key: rate_limit.ApiKeyInfo | None = Depends(get_api_key)
+):
+    if idempotency_key is not None and not idempotency.is_valid_key(idempotency_key):
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key header")
+    if x_tenant_id is not None and not fair_scheduler.is_valid_tenant(x_tenant_id):
+        raise HTTPException(status_code=400, detail="Invalid X-Tenant-ID header")
+    # an authenticated key decides the tenant, the header is only trusted without auth
+    tenant_id = api_key.tenant_id if api_key else x_tenant_id or fair_scheduler.DEFAULT_TENANT
+
+    expires_at = expiry.job_expires_at(request.ttl_seconds, request.deadline)
+    if expires_at is not None and expiry.is_expired_at(expires_at):
+        raise HTTPException(status_code=422, detail="deadline is already in the past")
+
+    if request.stages:
+        error = pipelines.validate_stages(request.stages)
+        if error is None and request.num_variants > 1:
+            error = "stages cannot be combined with num_variants"
+        if error is None and leases.pull_mode_enabled():
+            error = "stages need the AMQP dispatch mode"
+        if error:
+            raise HTTPException(status_code=422, detail=error)
+
+    if request.callback_url:
+        error = check_callback_url(str(request.callback_url))
+        if error:
+            raise HTTPException(status_code=422, detail=error)
+
+    run_at = scheduled_jobs.to_utc_naive(request.run_at) if request.run_at else None
+    if run_at and expires_at and expires_at <= run_at:
+        raise HTTPException(status_code=422, detail="deadline must be after run_at")
+
+    idempotency_key = idempotency.scoped_key(tenant_id, idempotency_key) if idempotency_key else None
+
+    # concurrent retries with the same key wait here and replay the first submission
+    with idempotency_locks.hold(idempotency_key) if idempotency_key else nullcontext():
+        if idempotency_key:
+            existing_request_id = idempotency.find_request_id(db, idempotency_key)
+            if existing_request_id:
+                logger.info(
+                    "Replayed request for idempotency key",
+                    extra={"request_id": str(existing_request_id)}
+                )
+                return {"request_id": str(existing_request_id)}
+
+        # identical (or, when enabled, near-identical) prompt with the same params already produced an image
+        # variants want fresh images for every seed
+        cached_image_url = _find_reusable_image(db, request) if request.num_variants == 1 else None
+
+        # reused images cost no GPU time and are not charged
+        cost = 0 if cached_image_url else fair_scheduler.job_cost(request)
+        _charge_api_key(api_key, cost)
+
+        with tracer.start_as_current_span("save_request_to_db") as db_span:
+            try:
+                db_request, children = _save_request(db, request, idempotency_key, cached_image_url, expires_at, tenant_id, run_at)
+            except IntegrityError:
+                # another replica stored the same key first
+                db.rollback()
+                _refund_api_key(api_key, cost)
+                existing_request_id = idempotency.find_request_id(db, idempotency_key) if idempotency_key else None
+                if not existing_request_id:
+                    raise
+                return {"request_id": str(existing_request_id)}
+
+            generated_request_id = str(db_request.request_id)
+
+            db_span.set_attribute("request_id", generated_request_id)
+
+            logger.info(
+                "Saved request to database",
+                extra={"request_id": generated_request_id}
             )
-            
-    except Exception as e:
-        logger.error(
-            "Error publishing to RabbitMQ",
-            extra={"request_id": generated_request_id},
-            exc_info=True
-        )
-        db.query(GenerationRequest).filter(GenerationRequest.request_id == db_request.request_id).update({"status": "Failed"})
-        db.commit()
-        raise HTTPException(status_code=500, detail="Failed to queue the request")
-    
-    
+
+        if cached_image_url:
+            logger.info(
+                "Served request from result cache",
+                extra={"request_id": generated_request_id}
+            )
+            _send_completion_callback(db_request)
+            return {"request_id": generated_request_id}
+
+        if leases.pull_mode_enabled():
+            return {"request_id": generated_request_id}
+
+        if db_request.awaiting_dispatch:
+            # released to the broker by the fair scheduler in its tenant's turn, or once run_at passes
+            return {"request_id": generated_request_id}
+
+        try:
+            params = request.model_dump(exclude=GATEWAY_ONLY_FIELDS)
+            if batch_publisher is not None and not children:
+                # waits at most the batching window, so publish errors still reach the client
+                batch_publisher.submit(generated_request_id, params, expires_at, db_request.style).result(timeout=BATCH_PUBLISH_TIMEOUT_SECONDS)
+            else:
+                publish_task(queue, generated_request_id, params, expires_at, variants.task_variants(children), db_request.style)
+        except Exception as e:
+            logger.error(
+                "Error publishing to RabbitMQ",
+                extra={"request_id": generated_request_id},
+                exc_info=True
+            )
+            db.query(GenerationRequest).filter(GenerationRequest.request_id == db_request.request_id).update({"status": "Failed"})
+            if children:
+                db.query(GenerationRequest).filter(GenerationRequest.parent_request_id == db_request.request_id).update({"status": "Failed"})
+            if idempotency_key:
+                # let the client retry the submission instead of replaying a failed job
+                idempotency.forget_key(db, idempotency_key)
+            db.commit()
+            _refund_api_key(api_key, cost)
+            raise HTTPException(status_code=500, detail="Failed to queue the request")
+
     return {"request_id": str(generated_request_id)}
-    
+
+
+def _queue_position(db, db_request):
+    return db.query(func.count(GenerationRequest.request_id)).filter(
+        GenerationRequest.status == "Pending",
+        GenerationRequest.num_variants.is_(None),
+        or_(GenerationRequest.run_at.is_(None), GenerationRequest.run_at <= datetime.utcnow()),
+        # speculative jobs wait in their own low-priority queue
+        GenerationRequest.tenant_id.is_distinct_from(pregeneration.PREGENERATION_TENANT),
+        GenerationRequest.created_at < db_request.created_at
+    ).scalar() or 0
+
+
+def _processing_seconds(db_request):
+    if not db_request.started_at:
+        return 0.0
+    return max((datetime.utcnow() - db_request.started_at).total_seconds(), 0.0)
+
+
+# detached copy of the row fields get_status needs, safe to share between concurrent requests
+StatusSnapshot = namedtuple(
+    "StatusSnapshot",
+    ["request_id", "status", "image_url", "num_inference_steps", "created_at", "updated_at", "started_at", "queue_position", "variants", "run_at", "stages", "progress"]
+)
+
+
+def _current_progress(request_id, status, progress_step, num_inference_steps):
+    # live progress from this replica's buffer, else whatever was last flushed by any replica
+    if status != "Processing":
+        return None
+    live = progress_buffer.get(request_id)
+    if live:
+        return {"step": live.step, "total_steps": live.total_steps or num_inference_steps}
+    if progress_step is not None:
+        return {"step": progress_step, "total_steps": num_inference_steps}
+    return None
+
+
+def _load_status_version(db, request_uuid):
+    version = db.query(
+        GenerationRequest.status,
+        GenerationRequest.updated_at,
+        GenerationRequest.progress_step,
+        GenerationRequest.num_inference_steps
+    ).filter(GenerationRequest.request_id == request_uuid).first()
+    if not version:
+        return None
+    return (version.status, version.updated_at, _current_progress(request_uuid, version.status, version.progress_step, version.num_inference_steps))
+
+
+def _load_status_snapshot(db, request_uuid):
+    db_request = db.query(GenerationRequest).filter(GenerationRequest.request_id == request_uuid).first()
+    if not db_request:
+        return None
+
+    queue_position = _queue_position(db, db_request) if db_request.status == "Pending" else 0
+    variant_statuses = None
+    if db_request.num_variants:
+        variant_statuses = [
+            {
+                "request_id": str(child.request_id),
+                "seed": child.seed,
+                "status": child.status,
+                "image_url": child.image_url if child.status == "Completed" else None
+            }
+            for child in variants.children_of(db, db_request.request_id)
+        ]
+    stages = None
+    if db_request.pipeline:
+        stages = [pipelines.describe(stage) for stage in pipelines.load_stages(db, db_request.request_id)]
+    return StatusSnapshot(
+        request_id = db_request.request_id,
+        status = db_request.status,
+        image_url = db_request.image_url,
+        num_inference_steps = db_request.num_inference_steps,
+        created_at = db_request.created_at,
+        updated_at = db_request.updated_at,
+        started_at = db_request.started_at,
+        queue_position = queue_position,
+        variants = variant_statuses,
+        run_at = db_request.run_at,
+        stages = stages,
+        progress = _current_progress(db_request.request_id, db_request.status, db_request.progress_step, db_request.num_inference_steps)
+    )
+
 
 # user send request_id to check status, if completed, return image url
 @app.get("/status/{request_id}")
-def get_status(request_id: str, db: Session = Depends(get_db)):
+def get_status(
+    request_id: str,
+    response: Response,
+    db: Session = Depends(get_db),
+    if_none_match: str | None = Header(default=None)
+):
     logger.info(
         "Checking status for request",
         extra={"request_id": request_id}
@@ -200,7 +890,24 @@ def get_status(request_id: str, db: Session = Depends(get_db)):
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid request_id format")
 
-    db_request = db.query(GenerationRequest).filter(GenerationRequest.request_id == request_uuid).first()
+    _ensure_known_request_id(request_uuid)
+
+    # concurrent polls for the same request_id share one in-flight query
+    if if_none_match:
+        # revalidation only needs the version columns, not the full row
+        version = status_reads.do(("version", request_uuid), lambda: _load_status_version(db, request_uuid))
+        if not version:
+            raise HTTPException(status_code=404, detail="request_id not found")
+
+        status, updated_at, current_progress = version
+        etag = http_cache.status_etag(status, updated_at, current_progress)
+        if http_cache.etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={
+                "ETag": etag,
+                "Cache-Control": http_cache.status_cache_control(status)
+            })
+
+    db_request = status_reads.do(("row", request_uuid), lambda: _load_status_snapshot(db, request_uuid))
     
     if not db_request:
         raise HTTPException(status_code=404, detail="request_id not found")
@@ -212,37 +919,601 @@ def get_status(request_id: str, db: Session = Depends(get_db)):
     
     if db_request.status == "Completed":
         response_data["image_url"] = db_request.image_url
+
+    if db_request.variants is not None:
+        response_data["variants"] = db_request.variants
+
+    if db_request.stages is not None:
+        response_data["stages"] = db_request.stages
+
+    if db_request.progress is not None:
+        response_data["progress"] = db_request.progress
+
+    if db_request.status not in TERMINAL_STATUSES:
+        # tell the client where the job stands and when another poll is worth making
+        num_inference_steps = db_request.num_inference_steps or 0
+        processing_seconds = _processing_seconds(db_request)
+        eta_seconds = throughput_estimator.seconds_remaining(
+            db_request.status,
+            num_inference_steps,
+            db_request.queue_position,
+            processing_seconds
+        )
+        next_poll_ms = throughput_estimator.next_poll_ms(
+            db_request.status,
+            num_inference_steps,
+            db_request.queue_position,
+            processing_seconds
+        )
+        if scheduled_jobs.is_delayed(db_request.run_at):
+            response_data["run_at"] = db_request.run_at.isoformat()
+            eta_seconds += (db_request.run_at - datetime.utcnow()).total_seconds()
+        response_data["queue_position"] = db_request.queue_position
+        response_data["eta_seconds"] = round(eta_seconds, 1)
+        response_data["next_poll_ms"] = next_poll_ms
+        response.headers["Retry-After"] = str(retry_after_seconds(next_poll_ms))
+
+    response.headers["ETag"] = http_cache.status_etag(db_request.status, db_request.updated_at, db_request.progress)
+    response.headers["Cache-Control"] = http_cache.status_cache_control(db_request.status)
     
     return response_data
 
 
+# queue depth, worker count and throughput estimates for autoscaling and dashboards
+@app.get("/capacity")
+def get_capacity():
+    return throughput_estimator.capacity()
+
+
 class UpdateRequest(BaseModel):
     status: str
     image_url: str = None
+    model_version: str = None
+
+
+def _index_completed_request(db_request, model_version=None):
+    if prompt_index is None or (model_version or result_cache.MODEL_VERSION) != result_cache.MODEL_VERSION:
+        return
+    if db_request.pipeline or routing.explicit_style(db_request.style, db_request.prompt):
+        # not reusable for a plain request with a similar prompt
+        return
+
+    prompt_index.add(
+        db_request.request_id,
+        db_request.prompt,
+        db_request.negative_prompt,
+        db_request.num_inference_steps,
+        db_request.guidance_scale,
+        db_request.seed,
+        db_request.image_url
+    )
+
+
+def _apply_status_update(db, db_request, status, image_url=None, model_version=None):
+    if status == "Processing":
+        # the reaper requeues the job if the worker stops reporting before the lease runs out
+        leases.start_processing_lease(db_request)
+        db_request.started_at = datetime.utcnow()
+    elif status == "Completed" and db_request.started_at and db_request.num_inference_steps and not db_request.pipeline:
+        # pipelines report base generation time when their first stage finishes
+        throughput_estimator.observe_completion(db_request.num_inference_steps, _processing_seconds(db_request))
+
+    db_request.status = status
+    if image_url:
+        db_request.image_url = image_url
+    if status in TERMINAL_STATUSES:
+        leases.release_lease(db_request)
+    if status != "Processing":
+        # status changes are written through; buffered progress of the old state is dropped
+        progress_buffer.discard(db_request.request_id)
+
+    if status == "Completed" and db_request.image_url:
+        result_cache.store(db, db_request, db_request.image_url, model_version)
+        
+    db.commit()
+
+    if status == "Completed" and db_request.image_url:
+        _index_completed_request(db_request, model_version)
+
+    _send_completion_callback(db_request)
+    if db_request.parent_request_id:
+        _refresh_variant_parent(db, db_request.parent_request_id)
+
+
+class BatchUpdateItem(BaseModel):
+    request_id: uuid.UUID
+    status: str
+    image_url: str = None
+    model_version: str = None
+
+
+# Inference service reports a whole GPU batch at once; declared before /update_db/{request_id} so "batch" is not taken for an id
+@app.put("/update_db/batch")
+def update_db_batch(
+    items: list[BatchUpdateItem],
+    db: Session = Depends(get_db),
+    queue: queue_backends.QueueBackend = Depends(get_optional_queue_backend)
+):
+    if not items or len(items) > status_updates.MAX_STATUS_BATCH_SIZE:
+        raise HTTPException(status_code=422, detail=f"a batch holds 1 to {status_updates.MAX_STATUS_BATCH_SIZE} updates")
+
+    valid = [
+        status_updates.StatusUpdate(item.request_id, item.status, item.image_url, item.model_version)
+        for item in items
+        if item.status in status_updates.WORKER_STATUSES
+    ]
+    applied = iter(_apply_status_batch(db, valid, queue)) if valid else iter(())
+
+    results = []
+    for item in items:
+        if item.status in status_updates.WORKER_STATUSES:
+            outcome = next(applied)
+            result, previous_status = outcome.result, outcome.previous_status
+        else:
+            result, previous_status = "invalid", None
+        STATUS_UPDATES.labels(path="http", result=result).inc()
+        results.append({"request_id": str(item.request_id), "result": result, "previous_status": previous_status})
+
+    logger.info(f"Applied {sum(entry['result'] == 'updated' for entry in results)} of {len(items)} batched status updates")
+    return {"results": results}
 
 
 # Inference service call to update database
 @app.put("/update_db/{request_id}")
-def update_db(request_id: str, update_data: UpdateRequest, db: Session = Depends(get_db)):
+def update_db(
+    request_id: str,
+    update_data: UpdateRequest,
+    db: Session = Depends(get_db),
+    queue: queue_backends.QueueBackend = Depends(get_optional_queue_backend)
+):
     try:
         request_uuid = uuid.UUID(request_id)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid request_id format")
+
+    _ensure_known_request_id(request_uuid)
+    _update_job_status(db, request_uuid, update_data, queue)
+
+    logger.info(
+        "Updated status for request to status",
+        extra={"request_id": request_id, "status": update_data.status}
+    )
     
+    return {"message": "Status updated successfully"}
+
+
+def _update_job_status(db, request_uuid, update_data, queue):
     db_request = db.query(GenerationRequest).filter(GenerationRequest.request_id == request_uuid).first()
     
     if not db_request:
         raise HTTPException(status_code=404, detail="request_id not found")
+
+    if db_request.status == "Cancelled":
+        # tells a worker about to start the job to ack it without running inference
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+
+    if db_request.status == "Expired":
+        raise HTTPException(status_code=410, detail="Job expired before it was started")
+
+    if update_data.status not in status_updates.WORKER_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {list(status_updates.WORKER_STATUSES)}")
+    if (db_request.status, update_data.status) not in status_updates.ALLOWED_TRANSITIONS:
+        # terminal states are served as immutable, a late report from a slow or retried worker must not reopen them
+        raise HTTPException(status_code=409, detail=f"Request already {db_request.status}")
+
+    if update_data.status == "Processing" and db_request.status == "Pending" and expiry.is_expired(db_request):
+        # the deadline passed while the message waited, the worker acks it without running inference
+        _apply_status_update(db, db_request, "Expired")
+        raise HTTPException(status_code=410, detail="Job expired before it was started")
+
+    if db_request.pipeline and db_request.status not in TERMINAL_STATUSES and _update_base_stage(db, db_request, update_data, queue):
+        return
     
-    db_request.status = update_data.status
-    if update_data.image_url:
-        db_request.image_url = update_data.image_url
-        
+    _apply_status_update(db, db_request, update_data.status, update_data.image_url, update_data.model_version)
+
+
+BATCH_RESULTS_BY_STATUS_CODE = {400: "invalid", 404: "not_found", 409: "illegal_transition", 410: "cancelled"}
+
+
+def _apply_status_batch(db, updates, queue=None):
+    outcomes = status_updates.apply_batch(db, updates)
+    by_id = {update.request_id: update for update in updates}
+    applied = [outcome.request_id for outcome in outcomes if outcome.result == "updated"]
+    jobs = db.query(GenerationRequest).filter(GenerationRequest.request_id.in_(applied)).populate_existing().all() if applied else []
+
+    for job in jobs:
+        if job.status == "Completed" and job.image_url:
+            if job.started_at and job.num_inference_steps:
+                throughput_estimator.observe_completion(job.num_inference_steps, _processing_seconds(job))
+            result_cache.store(db, job, job.image_url, by_id[job.request_id].model_version)
+    db.commit()
+
+    for job in jobs:
+        if job.status != "Processing":
+            progress_buffer.discard(job.request_id)
+        if job.status == "Completed" and job.image_url:
+            _index_completed_request(job, by_id[job.request_id].model_version)
+        _send_completion_callback(job)
+    # a GPU batch of variants finishes many children of the same parent at once
+    for parent_request_id in {job.parent_request_id for job in jobs if job.parent_request_id}:
+        _refresh_variant_parent(db, parent_request_id)
+
+    # pipeline jobs hand their image to the next stage, which only the per-job path does
+    for index, outcome in enumerate(outcomes):
+        if outcome.result != "pipeline":
+            continue
+        update = by_id[outcome.request_id]
+        try:
+            _update_job_status(db, outcome.request_id, UpdateRequest(status=update.status, image_url=update.image_url, model_version=update.model_version), queue)
+            outcomes[index] = outcome._replace(result="updated")
+        except HTTPException as error:
+            db.rollback()
+            outcomes[index] = outcome._replace(result=BATCH_RESULTS_BY_STATUS_CODE.get(error.status_code, "failed"))
+    return outcomes
+
+
+def _ingest_status_results(channel, updates):
+    # runs on the consumer thread, next pipeline stages are published over its channel
+    db = SessionLocal()
+    try:
+        return _apply_status_batch(db, updates, queue_backends.RabbitMQBackend(channel))
+    finally:
+        db.close()
+
+
+status_result_consumer = status_updates.StatusResultConsumer(results_rabbitmq_manager, _ingest_status_results)
+
+
+def _publish_stage(queue, db_request, stage):
+    queue_name = pipelines.PIPELINE_STAGE_QUEUES[stage.name]
+    with tracer.start_as_current_span("publish_stage_to_rabbitmq") as pika_span:
+        pika_span.set_attribute("routing_key", queue_name)
+        pika_span.set_attribute("request_id", str(db_request.request_id))
+
+        queue.declare(queue_name)
+        queue.publish(queue_name, pipelines.stage_message(db_request, stage))
+
+
+def _advance_pipeline(db, db_request, stages, image_url, queue):
+    # hands the finished stage's image to the next stage's pool, or completes the job after the last one
+    next_stage = pipelines.current_stage(stages)
+    if next_stage is None:
+        _apply_status_update(db, db_request, "Completed", image_url)
+        return
+
+    if queue is None:
+        # nothing is committed, the worker retries its report once the broker is back
+        raise HTTPException(status_code=503, detail="Service unavailable: Cannot connect to message queue")
+    pipelines.queue_stage(next_stage, image_url)
+    _publish_stage(queue, db_request, next_stage)
+    # stage progress does not change the job status, bump the version so pollers see it
+    db_request.updated_at = datetime.utcnow()
     db.commit()
     logger.info(
-        "Updated status for request to status",
-        extra={"request_id": request_id, "status": update_data.status}
+        f"Queued pipeline stage '{next_stage.name}'",
+        extra={"request_id": str(db_request.request_id)}
     )
-    
+
+
+def _update_base_stage(db, db_request, update_data, queue):
+    # returns True when the update was consumed by the pipeline instead of finishing the job
+    stages = pipelines.load_stages(db, db_request.request_id, for_update=True)
+    if not stages:
+        return False
+    if stages[0].status == "Completed":
+        # a redelivered or late base report; the later stages own the job now and only they finish it
+        raise HTTPException(status_code=409, detail="Base generation already completed")
+
+    base = stages[0]
+    pipelines.mark(base, update_data.status, update_data.image_url)
+    if update_data.status != "Completed":
+        return False
+    if not update_data.image_url:
+        raise HTTPException(status_code=400, detail="image_url is required to continue the pipeline")
+
+    if db_request.started_at and db_request.num_inference_steps:
+        throughput_estimator.observe_completion(db_request.num_inference_steps, _processing_seconds(db_request))
+    # the next stage takes a lease of its own once its worker reports in
+    leases.release_lease(db_request)
+    db_request.status = "Processing"
+    _advance_pipeline(db, db_request, stages, update_data.image_url, queue)
+    return True
+
+
+class StageUpdateRequest(BaseModel):
+    status: str
+    image_url: str = None
+
+
+# Stage workers (upscaling, background removal, ...) report progress on their stage of a pipeline
+@app.put("/update_db/{request_id}/stages/{stage_name}")
+def update_stage(
+    request_id: str,
+    stage_name: str,
+    update_data: StageUpdateRequest,
+    db: Session = Depends(get_db),
+    queue: queue_backends.QueueBackend = Depends(get_optional_queue_backend)
+):
+    request_uuid = _parse_request_id(request_id)
+    _ensure_known_request_id(request_uuid)
+    if update_data.status not in ("Processing", "Completed", "Failed"):
+        raise HTTPException(status_code=400, detail="status must be one of ['Processing', 'Completed', 'Failed']")
+
+    db_request = db.query(GenerationRequest).filter(GenerationRequest.request_id == request_uuid).first()
+    if not db_request or not db_request.pipeline:
+        raise HTTPException(status_code=404, detail="pipeline not found")
+    if db_request.status == "Cancelled":
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+    if db_request.status in TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Request already {db_request.status}")
+
+    stages = pipelines.load_stages(db, request_uuid, for_update=True)
+    stage = pipelines.current_stage(stages)
+    if stage is None or stage.position == 0 or stage.name != stage_name:
+        raise HTTPException(status_code=409, detail=f"'{stage_name}' is not the running stage")
+
+    pipelines.mark(stage, update_data.status, update_data.image_url)
+    if update_data.status == "Completed":
+        if not update_data.image_url:
+            raise HTTPException(status_code=400, detail="image_url is required to complete a stage")
+        leases.release_lease(db_request)
+        _advance_pipeline(db, db_request, stages, update_data.image_url, queue)
+    elif update_data.status == "Failed":
+        _apply_status_update(db, db_request, "Failed")
+    else:
+        # the reaper runs the stage again if its worker stops reporting before the lease runs out
+        leases.start_processing_lease(db_request)
+        db_request.updated_at = datetime.utcnow()
+        db.commit()
+
+    logger.info(
+        f"Updated pipeline stage '{stage_name}' to {update_data.status}",
+        extra={"request_id": request_id}
+    )
+    return {"message": "Stage updated successfully"}
+
+
+# drop cached results, by default every entry not produced by the current model version
+@app.delete("/result_cache", dependencies=[Depends(require_admin_api_key)])
+def invalidate_result_cache(model_version: str = None, db: Session = Depends(get_db)):
+    deleted = result_cache.invalidate(db, model_version)
+    if prompt_index is not None and model_version == result_cache.MODEL_VERSION:
+        prompt_index.clear()
+    return {"deleted": deleted}
+
+
+def _require_pull_mode():
+    if not leases.pull_mode_enabled():
+        raise HTTPException(status_code=409, detail="Work leasing is disabled, jobs are dispatched through the message queue")
+
+
+def _parse_request_id(request_id):
+    try:
+        return uuid.UUID(request_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid request_id format")
+
+
+class LeaseRequest(BaseModel):
+    lease_token: str
+
+
+class WorkCompleteRequest(BaseModel):
+    lease_token: str
+    status: str = "Completed"
+    image_url: str = None
+    model_version: str = None
+
+
+# Inference service leases up to `max` jobs instead of consuming from RabbitMQ
+@app.post("/work/lease")
+def lease_work(
+    max_jobs: int = Query(default=1, alias="max", ge=1, le=leases.MAX_LEASE_BATCH_SIZE),
+    visibility_timeout: int = Query(default=leases.LEASE_VISIBILITY_SECONDS, ge=1),
+    db: Session = Depends(get_db)
+):
+    _require_pull_mode()
+
+    jobs = leases.lease_jobs(db, max_jobs, visibility_timeout)
+    logger.info(f"Leased {len(jobs)} jobs")
+
+    return {"jobs": [
+        {
+            "request_id": str(job.request_id),
+            "params": leases.task_params(job),
+            "style": job.style,
+            "lease_token": job.lease_token,
+            "lease_expires_at": job.lease_expires_at.isoformat(),
+            "attempt": job.attempts
+        }
+        for job in jobs
+    ]}
+
+
+# Inference service extends the lease of a job it is still working on
+@app.post("/work/{request_id}/heartbeat")
+def heartbeat_work(
+    request_id: str,
+    lease: LeaseRequest,
+    visibility_timeout: int = Query(default=leases.LEASE_VISIBILITY_SECONDS, ge=1),
+    db: Session = Depends(get_db)
+):
+    _require_pull_mode()
+    request_uuid = _parse_request_id(request_id)
+
+    if request_uuid in cancelled_requests:
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+
+    lease_expires_at = leases.extend_lease(db, request_uuid, lease.lease_token, visibility_timeout)
+    if lease_expires_at is None:
+        raise HTTPException(status_code=409, detail="Lease expired or held by another worker")
+
+    return {"request_id": request_id, "lease_expires_at": lease_expires_at.isoformat()}
+
+
+def _require_postgres_queue():
+    if not postgres_queue:
+        raise HTTPException(status_code=409, detail="The Postgres task queue is disabled, tasks are published to RabbitMQ")
+
+
+class ClaimRequest(BaseModel):
+    max_messages: int = Field(default=1, ge=1, le=queue_backends.MAX_CLAIM_BATCH_SIZE)
+    visibility_seconds: int = Field(default=queue_backends.TASK_QUEUE_VISIBILITY_SECONDS, gt=0)
+    wait_seconds: float = Field(default=0, ge=0, le=queue_backends.MAX_CLAIM_WAIT_SECONDS)
+    routing_keys: list[str] | None = None
+
+
+class AckRequest(BaseModel):
+    ids: list[int]
+
+
+# Inference service claims task messages when QUEUE_BACKEND=postgres; unacked messages are redelivered after visibility_seconds
+@app.post("/queues/{queue_name}/claim")
+def claim_messages(queue_name: str, claim: ClaimRequest):
+    _require_postgres_queue()
+    claimed = postgres_queue.claim_or_wait(queue_name, claim.max_messages, claim.wait_seconds, claim.visibility_seconds, claim.routing_keys)
+    return {
+        "messages": [
+            {"id": task.id, "routing_key": task.routing_key, "deliveries": task.deliveries, "message": task.message}
+            for task in claimed
+        ]
+    }
+
+
+@app.post("/queues/{queue_name}/ack")
+def ack_messages(queue_name: str, ack: AckRequest):
+    _require_postgres_queue()
+    return {"acked": postgres_queue.ack(queue_name, ack.ids)}
+
+
+# Inference service finishes a leased job
+@app.post("/work/{request_id}/complete")
+def complete_work(request_id: str, result: WorkCompleteRequest, db: Session = Depends(get_db)):
+    _require_pull_mode()
+    request_uuid = _parse_request_id(request_id)
+    if result.status not in RESULT_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {list(RESULT_STATUSES)}")
+
+    _ensure_known_request_id(request_uuid)
+    db_request = db.query(GenerationRequest).filter(GenerationRequest.request_id == request_uuid).first()
+    if not db_request:
+        raise HTTPException(status_code=404, detail="request_id not found")
+    if db_request.status == "Cancelled":
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+    if not leases.holds_lease(db_request, result.lease_token):
+        raise HTTPException(status_code=409, detail="Lease expired or held by another worker")
+
+    _apply_status_update(db, db_request, result.status, result.image_url, result.model_version)
+    logger.info(
+        "Completed leased job",
+        extra={"request_id": request_id, "status": result.status}
+    )
+
     return {"message": "Status updated successfully"}
-    
\ No newline at end of file
+
+
+class ProgressRequest(BaseModel):
+    step: int = Field(ge=0)
+    total_steps: int | None = Field(default=None, ge=1)
+
+
+# Inference service reports per-step progress; buffered in memory and flushed to the database in batches
+@app.patch("/progress/{request_id}", status_code=204)
+def report_progress(request_id: str, update_data: ProgressRequest):
+    request_uuid = _parse_request_id(request_id)
+    _ensure_known_request_id(request_uuid)
+    if request_uuid in cancelled_requests:
+        # lets the worker stop early, same as update_db
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+
+    progress_buffer.report(request_uuid, update_data.step, update_data.total_steps)
+    return Response(status_code=204)
+
+
+def _broadcast_cancellation(channel, request_id):
+    # fanout for AMQP workers; best effort, workers also learn it from update_db and /work
+    if channel is None:
+        return
+    try:
+        channel.exchange_declare(exchange=cancellation.CANCELLATION_EXCHANGE, exchange_type="fanout", durable=True)
+        channel.basic_publish(
+            exchange=cancellation.CANCELLATION_EXCHANGE,
+            routing_key="",
+            body=json.dumps({"request_id": request_id})
+        )
+    except Exception:
+        logger.warning("Failed to broadcast cancellation", extra={"request_id": request_id}, exc_info=True)
+
+
+# user cancels a job that has not finished yet
+@app.delete("/generate/{request_id}")
+def cancel_task(
+    request_id: str,
+    db: Session = Depends(get_db),
+    channel: pika.channel.Channel = Depends(get_optional_mq_channel),
+    api_key: rate_limit.ApiKeyInfo | None = Depends(get_api_key)
+):
+    request_uuid = _parse_request_id(request_id)
+    _ensure_known_request_id(request_uuid)
+
+    db_request = db.query(GenerationRequest).filter(GenerationRequest.request_id == request_uuid).with_for_update().first()
+    # other tenants' jobs look the same as missing ones
+    if not db_request or (api_key and db_request.tenant_id != api_key.tenant_id):
+        raise HTTPException(status_code=404, detail="request_id not found")
+    if db_request.status in TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Request already {db_request.status}")
+
+    cancelled = [db_request]
+    if db_request.num_variants:
+        # cancelling the parent cancels every variant that has not finished
+        cancelled += db.query(GenerationRequest).filter(
+            GenerationRequest.parent_request_id == request_uuid,
+            GenerationRequest.status.notin_(TERMINAL_STATUSES)
+        ).with_for_update().all()
+
+    for job in cancelled:
+        job.status = "Cancelled"
+        leases.release_lease(job)
+        notify(db, cancellation.CANCELLATIONS_CHANNEL, str(job.request_id))
+    db.commit()
+
+    for job in cancelled:
+        cancelled_requests.add(job.request_id)
+        _broadcast_cancellation(channel, str(job.request_id))
+    _send_completion_callback(db_request)
+    if db_request.parent_request_id:
+        _refresh_variant_parent(db, db_request.parent_request_id)
+    logger.info("Cancelled request", extra={"request_id": request_id})
+
+    return {"request_id": request_id, "status": "Cancelled"}
+
+
+# Inference service checks whether a job was cancelled before starting it, answered from memory
+@app.head("/work/{request_id}")
+def check_work_cancelled(request_id: str, response: Response):
+    request_uuid = _parse_request_id(request_id)
+    response.headers["X-Cancelled"] = "true" if request_uuid in cancelled_requests else "false"
+
+
+# caller's own usage for billing, from the start of the current UTC day by default
+@app.get("/usage")
+def get_usage(
+    since: datetime | None = None,
+    db: Session = Depends(get_db),
+    api_key: rate_limit.ApiKeyInfo | None = Depends(get_api_key)
+):
+    if api_key is None:
+        raise HTTPException(status_code=404, detail="API key authentication is disabled")
+
+    if since is None:
+        since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    elif since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    inference_steps, jobs = api_key_limiter.usage(db, api_key.key_hash, since)
+    return {
+        "tenant_id": api_key.tenant_id,
+        "since": since.isoformat(),
+        "inference_steps": int(inference_steps),
+        "jobs": int(jobs),
+        "daily_step_quota": api_key.daily_step_quota
+    }
@@ -0,0 +1,35 @@
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    # runs `func` every `interval` seconds on a daemon thread until stopped
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        logger.info(f"Started background task '{self.name}' every {self.interval}s")
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.func()
+            except Exception:
+                logger.error(f"Background task '{self.name}' failed", exc_info=True)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 5)
+            self._thread = None
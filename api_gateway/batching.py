@@ -0,0 +1,117 @@
+import os
+import time
+import threading
+import logging
+from collections import namedtuple
+from concurrent.futures import Future
+
+from api_gateway.metrics import BATCHED_JOBS
+
+logger = logging.getLogger(__name__)
+
+BATCH_PUBLISH_ENABLED = os.getenv("BATCH_PUBLISH_ENABLED", "false").lower() == "true"
+BATCH_QUEUE_NAME = "image_generation_batch_queue"
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", "50"))
+
+BatchJob = namedtuple("BatchJob", ["request_id", "params", "expires_at", "style", "future"])
+
+
+def batch_key(params, style=None):
+    # diffusion batches need the same step count, guidance and weights; the model has no resolution field yet
+    return (params["num_inference_steps"], round(float(params["guidance_scale"]), 4), style)
+
+
+def batch_expiration(jobs):
+    # the batch only expires once every job in it has, the reaper expires the rest individually
+    expirations = [job.expires_at for job in jobs]
+    if any(expires_at is None for expires_at in expirations):
+        return None
+    return max(expirations)
+
+
+class BatchingPublisher:
+    # buffers jobs for at most max_wait_ms and publishes compatible ones together, up to max_size per message
+    def __init__(self, publish_batch, max_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.publish_batch = publish_batch
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self._groups = {}
+        self._flush_at = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="batching-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout=self.max_wait + 5)
+            self._thread = None
+
+    def submit(self, request_id, params, expires_at=None, style=None):
+        # the returned future resolves once the job's batch is on the broker, or carries the publish error
+        job = BatchJob(request_id, params, expires_at, style, Future())
+        key = batch_key(params, style)
+        with self._condition:
+            group = self._groups.setdefault(key, [])
+            if not group:
+                self._flush_at[key] = time.monotonic() + self.max_wait
+            group.append(job)
+            # wake the flusher to pick up a new deadline or a full group
+            if len(group) == 1 or len(group) >= self.max_size:
+                self._condition.notify()
+        return job.future
+
+    def _take_ready(self, now):
+        ready = []
+        for key in list(self._groups):
+            group = self._groups[key]
+            if self._stopping or len(group) >= self.max_size or self._flush_at[key] <= now:
+                ready.append(group[:self.max_size])
+                rest = group[self.max_size:]
+                if rest:
+                    self._groups[key] = rest
+                    self._flush_at[key] = now + self.max_wait
+                else:
+                    del self._groups[key]
+                    del self._flush_at[key]
+        return ready
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    ready = self._take_ready(now)
+                    if ready or (self._stopping and not self._groups):
+                        break
+                    timeout = min(self._flush_at.values()) - now if self._flush_at else None
+                    self._condition.wait(timeout)
+                stopping = self._stopping and not self._groups
+
+            for jobs in ready:
+                self._publish(jobs)
+            if stopping:
+                return
+
+    def _publish(self, jobs):
+        try:
+            self.publish_batch(jobs)
+        except Exception as e:
+            logger.error(f"Failed to publish batch of {len(jobs)} jobs", exc_info=True)
+            for job in jobs:
+                job.future.set_exception(e)
+            return
+
+        BATCHED_JOBS.observe(len(jobs))
+        for job in jobs:
+            job.future.set_result(None)
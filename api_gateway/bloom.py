@@ -0,0 +1,113 @@
+import os
+import math
+import uuid
+import hashlib
+import threading
+import logging
+
+from api_gateway.database import SessionLocal
+from api_gateway.models import GenerationRequest
+
+logger = logging.getLogger(__name__)
+
+BLOOM_FILTER_ENABLED = os.getenv("BLOOM_FILTER_ENABLED", "false").lower() == "true"
+BLOOM_FALSE_POSITIVE_RATE = float(os.getenv("BLOOM_FALSE_POSITIVE_RATE", "0.01"))
+BLOOM_MAX_BYTES = int(os.getenv("BLOOM_MAX_BYTES", str(32 * 1024 * 1024)))
+BLOOM_MIN_CAPACITY = int(os.getenv("BLOOM_MIN_CAPACITY", "100000"))
+BLOOM_REBUILD_INTERVAL_SECONDS = int(os.getenv("BLOOM_REBUILD_INTERVAL_SECONDS", "3600"))
+BLOOM_SCAN_BATCH_SIZE = 10000
+REQUEST_IDS_CHANNEL = "generation_request_ids"
+
+
+class BloomFilter:
+    def __init__(self, capacity, false_positive_rate=BLOOM_FALSE_POSITIVE_RATE, max_bytes=BLOOM_MAX_BYTES):
+        num_bits = math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))
+        if num_bits > max_bytes * 8:
+            logger.warning(
+                f"Bloom filter for {capacity} items needs {num_bits // 8} bytes, capping at {max_bytes}; "
+                "false positive rate will be higher than configured"
+            )
+            num_bits = max_bytes * 8
+
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray(math.ceil(self.num_bits / 8))
+
+    def _positions(self, item):
+        # double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def size_bytes(self):
+        return len(self._bits)
+
+
+class KnownRequestIds:
+    # every request_id this gateway has seen; a miss is a definite 404
+    def __init__(self):
+        self._filter = None
+        self._lock = threading.Lock()
+        self._added_during_rebuild = None
+
+    @property
+    def ready(self):
+        return self._filter is not None
+
+    def add(self, request_uuid):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(request_uuid.bytes)
+            if self._added_during_rebuild is not None:
+                self._added_during_rebuild.append(request_uuid.bytes)
+
+    def might_exist(self, request_uuid):
+        current = self._filter
+        if current is None:
+            return True
+        return request_uuid.bytes in current
+
+    def rebuild(self):
+        with self._lock:
+            self._added_during_rebuild = []
+
+        db = SessionLocal()
+        try:
+            total = db.query(GenerationRequest).count()
+            rebuilt = BloomFilter(max(total * 2, BLOOM_MIN_CAPACITY))
+            ids = db.query(GenerationRequest.request_id).execution_options(stream_results=True).yield_per(BLOOM_SCAN_BATCH_SIZE)
+            for (request_id,) in ids:
+                rebuilt.add(request_id.bytes)
+        except Exception:
+            with self._lock:
+                self._added_during_rebuild = None
+            raise
+        finally:
+            db.close()
+
+        with self._lock:
+            for item in self._added_during_rebuild:
+                rebuilt.add(item)
+            self._added_during_rebuild = None
+            self._filter = rebuilt
+
+        logger.info(f"Rebuilt request_id bloom filter with {rebuilt.count} ids in {rebuilt.size_bytes} bytes")
+
+    def on_notification(self, payload):
+        try:
+            self.add(uuid.UUID(payload))
+        except ValueError:
+            logger.warning(f"Ignoring malformed request_id notification: {payload}")
+
@@ -0,0 +1,67 @@
+import os
+import uuid
+import threading
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+
+from api_gateway.database import SessionLocal
+from api_gateway.models import GenerationRequest
+
+logger = logging.getLogger(__name__)
+
+CANCELLATION_SET_SIZE = int(os.getenv("CANCELLATION_SET_SIZE", "50000"))
+CANCELLATION_RETENTION_HOURS = int(os.getenv("CANCELLATION_RETENTION_HOURS", "24"))
+CANCELLATIONS_CHANNEL = "generation_cancellations"
+CANCELLATION_EXCHANGE = "generation_cancellations"
+
+
+class CancellationSet:
+    # bounded set of cancelled request_ids as raw 16-byte uuids, oldest evicted first;
+    # replicas stay in sync through NOTIFY and reload recent cancellations on reconnect
+    def __init__(self, capacity=CANCELLATION_SET_SIZE):
+        self.capacity = capacity
+        self._members = set()
+        self._order = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, request_uuid):
+        return request_uuid.bytes in self._members
+
+    def add(self, request_uuid):
+        key = request_uuid.bytes
+        with self._lock:
+            if key in self._members:
+                return
+            self._members.add(key)
+            self._order.append(key)
+            while len(self._order) > self.capacity:
+                self._members.discard(self._order.popleft())
+
+    def on_notification(self, payload):
+        try:
+            self.add(uuid.UUID(payload))
+        except ValueError:
+            logger.warning(f"Ignoring malformed cancellation notification: {payload}")
+
+    def reload(self):
+        db = SessionLocal()
+        try:
+            since = datetime.utcnow() - timedelta(hours=CANCELLATION_RETENTION_HOURS)
+            # the newest cancellations when there are more than fit, workers are still checking those
+            recent = (
+                db.query(GenerationRequest.request_id)
+                .filter(GenerationRequest.status == "Cancelled", GenerationRequest.updated_at >= since)
+                .order_by(GenerationRequest.updated_at.desc())
+                .limit(self.capacity)
+                .all()
+            )
+            # added oldest first, so the newest are also the last to be evicted
+            for (request_id,) in reversed(recent):
+                self.add(request_id)
+        finally:
+            db.close()
+        logger.info(f"Loaded {len(self)} recent cancellations")
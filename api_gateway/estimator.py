@@ -0,0 +1,117 @@
+import os
+import math
+import time
+import threading
+from collections import deque
+
+INITIAL_SECONDS_PER_STEP = float(os.getenv("INITIAL_SECONDS_PER_STEP", "0.1"))
+SECONDS_PER_STEP_ALPHA = float(os.getenv("SECONDS_PER_STEP_ALPHA", "0.2"))
+THROUGHPUT_WINDOW_SECONDS = int(os.getenv("THROUGHPUT_WINDOW_SECONDS", "300"))
+MIN_POLL_INTERVAL_MS = int(os.getenv("MIN_POLL_INTERVAL_MS", "1000"))
+MAX_POLL_INTERVAL_MS = int(os.getenv("MAX_POLL_INTERVAL_MS", "30000"))
+CAPACITY_REFRESH_SECONDS = int(os.getenv("CAPACITY_REFRESH_SECONDS", "5"))
+DEFAULT_INFERENCE_STEPS = 50
+# lane observations older than this are ignored, e.g. while the broker is unreachable
+LANE_STALE_SECONDS = CAPACITY_REFRESH_SECONDS * 6
+
+
+class LaneState:
+    def __init__(self, queue_depth, workers, observed_at):
+        self.queue_depth = queue_depth
+        self.workers = workers
+        self.observed_at = observed_at
+
+
+class ThroughputEstimator:
+    # online model of the system: EWMA of inference seconds per step and of job size,
+    # completions seen in a sliding window, and per-lane broker depth and consumer counts
+    def __init__(self, seconds_per_step=INITIAL_SECONDS_PER_STEP, alpha=SECONDS_PER_STEP_ALPHA, window_seconds=THROUGHPUT_WINDOW_SECONDS):
+        self.seconds_per_step = seconds_per_step
+        self.average_steps = float(DEFAULT_INFERENCE_STEPS)
+        self.alpha = alpha
+        self.window_seconds = window_seconds
+        self._completions = deque()
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def observe_completion(self, num_inference_steps, processing_seconds, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if num_inference_steps and processing_seconds > 0:
+                sample = processing_seconds / num_inference_steps
+                self.seconds_per_step += self.alpha * (sample - self.seconds_per_step)
+                self.average_steps += self.alpha * (num_inference_steps - self.average_steps)
+            self._completions.append(now)
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._completions and self._completions[0] < now - self.window_seconds:
+            self._completions.popleft()
+
+    def jobs_per_second(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._trim(now)
+            return len(self._completions) / self.window_seconds
+
+    def observe_lane(self, lane, queue_depth, workers, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._lanes[lane] = LaneState(queue_depth, workers, now)
+
+    def lanes(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return {
+                lane: state for lane, state in self._lanes.items()
+                if state.observed_at >= now - LANE_STALE_SECONDS
+            }
+
+    def active_workers(self, now=None):
+        return sum(state.workers for state in self.lanes(now).values())
+
+    def job_seconds(self, num_inference_steps):
+        return num_inference_steps * self.seconds_per_step
+
+    def service_rate(self, num_inference_steps, now=None):
+        # jobs per second the workers can clear: broker consumer count over average job time when known,
+        # otherwise recent completions, otherwise a single worker running jobs like this one
+        workers = self.active_workers(now)
+        if workers:
+            return workers / max(self.job_seconds(self.average_steps), 1e-3)
+        return self.jobs_per_second(now) or 1.0 / max(self.job_seconds(num_inference_steps), 1e-3)
+
+    def seconds_remaining(self, status, num_inference_steps, queue_position=0, processing_seconds=0.0, now=None):
+        job_seconds = self.job_seconds(num_inference_steps)
+        if status == "Processing":
+            return max(job_seconds - processing_seconds, 0.0)
+
+        return queue_position / self.service_rate(num_inference_steps, now) + job_seconds
+
+    def next_poll_ms(self, status, num_inference_steps, queue_position=0, processing_seconds=0.0, now=None):
+        # poll at half the expected remaining time, so the interval shrinks as completion approaches
+        remaining = self.seconds_remaining(status, num_inference_steps, queue_position, processing_seconds, now)
+        interval_ms = remaining * 1000 / 2
+        return int(min(max(interval_ms, MIN_POLL_INTERVAL_MS), MAX_POLL_INTERVAL_MS))
+
+    def capacity(self, now=None):
+        lanes = self.lanes(now)
+        queue_depth = sum(state.queue_depth for state in lanes.values())
+        rate = self.service_rate(self.average_steps, now)
+        return {
+            "lanes": {
+                lane: {"queue_depth": state.queue_depth, "workers": state.workers}
+                for lane, state in lanes.items()
+            },
+            "queue_depth": queue_depth,
+            "active_workers": sum(state.workers for state in lanes.values()),
+            "seconds_per_step": round(self.seconds_per_step, 4),
+            "average_steps": round(self.average_steps, 1),
+            "jobs_per_second": round(rate, 4),
+            "completions_per_second": round(self.jobs_per_second(now), 4),
+            "estimated_drain_seconds": round(queue_depth / rate, 1),
+        }
+
+
+def retry_after_seconds(next_poll_ms):
+    return math.ceil(next_poll_ms / 1000)
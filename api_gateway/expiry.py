@@ -0,0 +1,234 @@
+import os
+import re
+import json
+import uuid
+import threading
+import logging
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+
+import httpx
+from sqlalchemy import update
+
+from api_gateway.models import GenerationRequest
+
+logger = logging.getLogger(__name__)
+
+DEAD_LETTER_EXCHANGE = "image_generation.dead_letter"
+EXPIRED_QUEUE = "image_generation_expired"
+DEAD_LETTER_POLICY = "image-generation-dead-letter"
+DEAD_LETTER_POLICY_PRIORITY = 10
+RABBITMQ_MANAGEMENT_PORT = int(os.getenv("RABBITMQ_MANAGEMENT_PORT", "15672"))
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "100"))
+EXPIRY_BATCH_WAIT_SECONDS = float(os.getenv("EXPIRY_BATCH_WAIT_SECONDS", "1.0"))
+RECONNECT_DELAY_SECONDS = 5
+
+
+def message_expiration(expires_at, now=None):
+    # AMQP per-message TTL, in milliseconds as a string
+    now = datetime.utcnow() if now is None else now
+    return str(max(int((expires_at - now).total_seconds() * 1000), 1))
+
+
+def job_expires_at(ttl_seconds=None, deadline=None, now=None):
+    # the earlier of the relative TTL and the absolute deadline, as naive UTC like the other timestamps
+    now = datetime.utcnow() if now is None else now
+    candidates = []
+    if ttl_seconds is not None:
+        candidates.append(now + timedelta(seconds=ttl_seconds))
+    if deadline is not None:
+        if deadline.tzinfo is not None:
+            deadline = deadline.astimezone(timezone.utc).replace(tzinfo=None)
+        candidates.append(deadline)
+    return min(candidates) if candidates else None
+
+
+def is_expired_at(expires_at, now=None):
+    now = datetime.utcnow() if now is None else now
+    return expires_at <= now
+
+
+def is_expired(db_request, now=None):
+    return db_request.expires_at is not None and is_expired_at(db_request.expires_at, now)
+
+
+def _shadowed_policy(policies, queue_name):
+    # the policy RabbitMQ would apply to the queue without ours: the highest priority one whose pattern matches
+    matching = [
+        policy for policy in policies
+        if not _is_dead_letter_policy(policy["name"])
+        and policy.get("apply-to", "all") in ("all", "queues")
+        and re.search(policy["pattern"], queue_name)
+    ]
+    return max(matching, key=lambda policy: policy.get("priority", 0), default=None)
+
+
+def _is_dead_letter_policy(name):
+    return name == DEAD_LETTER_POLICY or name.startswith(DEAD_LETTER_POLICY + ".")
+
+
+def apply_dead_letter_policy(host, user, password, queue_patterns):
+    # the work queues already exist without x-dead-letter-exchange arguments and cannot be redeclared with
+    # them, so dead-lettering is attached through a policy instead. RabbitMQ applies one policy per queue,
+    # so a queue already governed by an operator policy (max-length, quorum settings, ...) gets a copy of
+    # that policy's definition plus the dead-letter exchange, named "<DEAD_LETTER_POLICY>.<operator policy>"
+    # and pinned to the queues it covered at startup; later changes to the operator policy need a restart.
+    api = f"http://{host}:{RABBITMQ_MANAGEMENT_PORT}/api"
+    vhost = quote("/", safe="")
+    pattern = "^(" + "|".join(queue_patterns) + ")$"
+    with httpx.Client(auth=(user, password), timeout=10) as client:
+        policies = client.get(f"{api}/policies/{vhost}")
+        policies.raise_for_status()
+        policies = policies.json()
+        queues = client.get(f"{api}/queues/{vhost}", params={"columns": "name"})
+        queues.raise_for_status()
+
+        shadowed = {}
+        for queue in queues.json():
+            if re.fullmatch(pattern, queue["name"]):
+                policy = _shadowed_policy(policies, queue["name"])
+                if policy:
+                    shadowed.setdefault(policy["name"], (policy, []))[1].append(queue["name"])
+
+        wanted = {DEAD_LETTER_POLICY: {
+            "pattern": pattern,
+            "definition": {"dead-letter-exchange": DEAD_LETTER_EXCHANGE},
+            "apply-to": "queues",
+            "priority": DEAD_LETTER_POLICY_PRIORITY
+        }}
+        for name, (policy, queue_names) in shadowed.items():
+            wanted[f"{DEAD_LETTER_POLICY}.{name}"] = {
+                "pattern": "^(" + "|".join(re.escape(queue_name) for queue_name in queue_names) + ")$",
+                "definition": {**policy["definition"], "dead-letter-exchange": DEAD_LETTER_EXCHANGE},
+                "apply-to": "queues",
+                "priority": max(policy.get("priority", 0), DEAD_LETTER_POLICY_PRIORITY) + 1
+            }
+            logger.warning(f"Work queues {queue_names} are governed by policy '{name}', merged it into the dead-letter policy")
+
+        for name, body in wanted.items():
+            client.put(f"{api}/policies/{vhost}/{quote(name, safe='')}", json=body).raise_for_status()
+        # merged copies of operator policies that no longer cover any work queue
+        for policy in policies:
+            if _is_dead_letter_policy(policy["name"]) and policy["name"] not in wanted:
+                client.delete(f"{api}/policies/{vhost}/{quote(policy['name'], safe='')}").raise_for_status()
+    logger.info(f"Applied dead-letter policy to queues matching {pattern}")
+
+
+def dead_letter_reason(properties):
+    deaths = (properties.headers or {}).get("x-death") or []
+    if deaths:
+        return deaths[0].get("reason")
+    return (properties.headers or {}).get("x-first-death-reason")
+
+
+def request_ids_from_message(body):
+    # single, variant and batch task messages
+    message = json.loads(body)
+    if "jobs" in message:
+        return [uuid.UUID(job["request_id"]) for job in message["jobs"]]
+    request_ids = [uuid.UUID(message["request_id"])]
+    request_ids += [uuid.UUID(variant["request_id"]) for variant in message.get("variants", [])]
+    return request_ids
+
+
+def mark_expired(db, request_ids):
+    # one set-based UPDATE per batch; jobs a worker already picked up are left alone
+    if not request_ids:
+        return []
+    expired = db.scalars(
+        update(GenerationRequest)
+        .where(GenerationRequest.request_id.in_(request_ids), GenerationRequest.status == "Pending")
+        .values(status="Expired")
+        .returning(GenerationRequest)
+    ).all()
+    db.commit()
+    return expired
+
+
+class ExpiredJobConsumer:
+    # drains dead-lettered task messages in batches and marks their jobs Expired
+    def __init__(self, rabbitmq_manager, session_factory, on_expired=None):
+        self.rabbitmq_manager = rabbitmq_manager
+        self.session_factory = session_factory
+        self.on_expired = on_expired
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="expired-job-consumer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=EXPIRY_BATCH_WAIT_SECONDS + RECONNECT_DELAY_SECONDS)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                channel = self.rabbitmq_manager.get_channel()
+                if channel is None:
+                    self._stop_event.wait(RECONNECT_DELAY_SECONDS)
+                    continue
+                self._consume(channel)
+            except Exception:
+                logger.error("Expired job consumer failed, reconnecting", exc_info=True)
+                self._stop_event.wait(RECONNECT_DELAY_SECONDS)
+
+    def _consume(self, channel):
+        channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type="fanout", durable=True)
+        channel.queue_declare(queue=EXPIRED_QUEUE, durable=True)
+        channel.queue_bind(queue=EXPIRED_QUEUE, exchange=DEAD_LETTER_EXCHANGE)
+        channel.basic_qos(prefetch_count=EXPIRY_BATCH_SIZE)
+
+        batch = []
+        for method, properties, body in channel.consume(EXPIRED_QUEUE, inactivity_timeout=EXPIRY_BATCH_WAIT_SECONDS):
+            if method is not None:
+                batch.append((method, properties, body))
+            if batch and (method is None or len(batch) >= EXPIRY_BATCH_SIZE):
+                self._apply(channel, batch)
+                batch = []
+            if self._stop_event.is_set():
+                break
+        channel.cancel()
+
+    def _apply(self, channel, batch):
+        request_ids = []
+        for method, properties, body in batch:
+            reason = dead_letter_reason(properties)
+            try:
+                ids = request_ids_from_message(body)
+            except (ValueError, KeyError):
+                logger.warning("Discarding malformed dead-lettered message")
+                continue
+            if reason == "expired":
+                request_ids.extend(ids)
+            else:
+                logger.warning(f"Discarding message dead-lettered with reason '{reason}'", extra={"request_id": str(ids[0])})
+
+        db = self.session_factory()
+        try:
+            try:
+                expired = mark_expired(db, request_ids)
+            except Exception:
+                # hand the batch back now, a later multiple ack on this channel would otherwise cover it too
+                channel.basic_nack(delivery_tag=batch[-1][0].delivery_tag, multiple=True, requeue=True)
+                raise
+            channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+            logger.info(f"Marked {len(expired)} of {len(batch)} dead-lettered jobs as Expired")
+
+            if self.on_expired:
+                # the commit expired the returned jobs, they reload their attributes while the session is still open
+                for job in expired:
+                    try:
+                        self.on_expired(job)
+                    except Exception:
+                        db.rollback()
+                        logger.error("Failed to finish expired job", extra={"request_id": str(job.request_id)}, exc_info=True)
+        finally:
+            db.close()
+
@@ -0,0 +1,172 @@
+import os
+import re
+import logging
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import func, or_
+
+from api_gateway.models import GenerationRequest
+from api_gateway.metrics import TENANT_BACKLOG_JOBS, TENANT_BACKLOG_STEPS, FAIR_DISPATCHED_JOBS
+
+logger = logging.getLogger(__name__)
+
+FAIR_SCHEDULING_ENABLED = os.getenv("FAIR_SCHEDULING_ENABLED", "false").lower() == "true"
+FAIR_SCHEDULER_INTERVAL_SECONDS = float(os.getenv("FAIR_SCHEDULER_INTERVAL_SECONDS", "0.5"))
+# inference steps each unit of weight earns per round, about one default-sized job
+DRR_QUANTUM_STEPS = int(os.getenv("DRR_QUANTUM_STEPS", "50"))
+# messages kept ready on the broker per consuming worker; the rest wait in the gateway's tenant queues
+DISPATCH_DEPTH_PER_WORKER = int(os.getenv("DISPATCH_DEPTH_PER_WORKER", "2"))
+MIN_DISPATCH_DEPTH = int(os.getenv("MIN_DISPATCH_DEPTH", "2"))
+FAIR_SCHEDULER_LOCK_ID = 0x66616972
+
+DEFAULT_TENANT = "default"
+# tenants starting with "_" are reserved for the gateway's own jobs
+TENANT_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+
+
+def _parse_mapping(value):
+    pairs = (item.split("=", 1) for item in value.split(",") if "=" in item)
+    return {key.strip(): val.strip() for key, val in pairs}
+
+
+# weights must be positive, a tenant with no weight would never earn credit
+PLAN_WEIGHTS = {plan: max(float(weight), 0.1) for plan, weight in _parse_mapping(os.getenv("PLAN_WEIGHTS", "free=1,pro=4,enterprise=8")).items()}
+TENANT_PLANS = _parse_mapping(os.getenv("TENANT_PLANS", ""))
+DEFAULT_PLAN = os.getenv("DEFAULT_PLAN", "free")
+
+
+def is_valid_tenant(tenant_id):
+    return bool(TENANT_PATTERN.match(tenant_id))
+
+
+def tenant_weight(tenant_id):
+    return PLAN_WEIGHTS.get(TENANT_PLANS.get(tenant_id, DEFAULT_PLAN), 1.0)
+
+
+def job_cost(job):
+    # GPU time grows with steps, and a variant parent renders every seed
+    return (job.num_inference_steps or 0) * (job.num_variants or 1)
+
+
+class DeficitRoundRobin:
+    # weighted DRR over per-tenant queues; each visit adds quantum * weight to the tenant's deficit
+    # and it may send jobs while their cost fits. Deficits persist across calls while a tenant is backlogged.
+    def __init__(self, quantum=DRR_QUANTUM_STEPS, weight=tenant_weight):
+        self.quantum = quantum
+        self.weight = weight
+        self.deficits = {}
+        self._order = deque()
+
+    def select(self, queues, budget, cost=job_cost):
+        # queues: tenant -> deque of jobs, oldest first. Returns up to `budget` jobs in dispatch order.
+        for tenant in queues:
+            if tenant not in self.deficits:
+                self.deficits[tenant] = 0.0
+                self._order.append(tenant)
+        for tenant in list(self._order):
+            if not queues.get(tenant):
+                # idle tenants do not bank credit
+                self._order.remove(tenant)
+                del self.deficits[tenant]
+
+        selected = []
+        while budget > 0 and self._order:
+            tenant = self._order[0]
+            queue = queues[tenant]
+            self.deficits[tenant] += self.quantum * self.weight(tenant)
+            while queue and budget > 0 and cost(queue[0]) <= self.deficits[tenant]:
+                job = queue.popleft()
+                self.deficits[tenant] -= cost(job)
+                selected.append((tenant, job))
+                budget -= 1
+
+            self._order.rotate(-1)
+            if not queue:
+                self._order.remove(tenant)
+                del self.deficits[tenant]
+        return selected
+
+
+def held_jobs_query(db):
+    return db.query(GenerationRequest).filter(
+        GenerationRequest.awaiting_dispatch.is_(True),
+        GenerationRequest.status == "Pending",
+        # delayed jobs join their tenant's queue once run_at passes
+        or_(GenerationRequest.run_at.is_(None), GenerationRequest.run_at <= datetime.utcnow())
+    )
+
+
+class FairDispatcher:
+    # holds new jobs in per-tenant virtual queues (rows awaiting dispatch) and feeds the broker only
+    # as fast as workers drain it, so one tenant's flood cannot fill the queue ahead of everyone else
+    def __init__(self, session_factory, leader, broker_capacity, dispatch, scheduler=None):
+        self.session_factory = session_factory
+        self.leader = leader
+        self.broker_capacity = broker_capacity
+        self.dispatch = dispatch
+        self.scheduler = scheduler or DeficitRoundRobin()
+        self._exported = set()
+
+    def run_once(self):
+        if not self.leader.is_leader():
+            return 0
+
+        db = self.session_factory()
+        try:
+            backlog = self._export_backlog(db)
+            budget = self.broker_capacity()
+            if budget <= 0 or not backlog:
+                return 0
+
+            queues = {tenant: deque(self._oldest(db, tenant, budget)) for tenant in backlog}
+            dispatched = 0
+            try:
+                for tenant, job in self.scheduler.select(queues, budget):
+                    self.dispatch(db, job)
+                    job.awaiting_dispatch = False
+                    FAIR_DISPATCHED_JOBS.labels(tenant=tenant).inc()
+                    dispatched += 1
+            finally:
+                # jobs already on the broker must not be dispatched again, even if a later publish failed
+                db.commit()
+            return dispatched
+        finally:
+            db.close()
+
+    def _oldest(self, db, tenant, limit):
+        return (
+            held_jobs_query(db)
+            .filter(GenerationRequest.tenant_id == tenant)
+            .order_by(GenerationRequest.created_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+
+    def _export_backlog(self, db):
+        rows = (
+            held_jobs_query(db)
+            .with_entities(
+                GenerationRequest.tenant_id,
+                func.count(GenerationRequest.request_id),
+                func.coalesce(func.sum(GenerationRequest.num_inference_steps * func.coalesce(GenerationRequest.num_variants, 1)), 0)
+            )
+            .group_by(GenerationRequest.tenant_id)
+            .all()
+        )
+        backlog = {tenant: (jobs, steps) for tenant, jobs, steps in rows}
+
+        # tenants whose backlog drained are reset rather than left at their last value
+        for tenant in set(self._exported) - set(backlog):
+            TENANT_BACKLOG_JOBS.labels(tenant=tenant).set(0)
+            TENANT_BACKLOG_STEPS.labels(tenant=tenant).set(0)
+        for tenant, (jobs, steps) in backlog.items():
+            TENANT_BACKLOG_JOBS.labels(tenant=tenant).set(jobs)
+            TENANT_BACKLOG_STEPS.labels(tenant=tenant).set(steps)
+        self._exported = set(backlog)
+        return backlog
+
+
+def broker_capacity(queue_depth, workers):
+    return max(workers * DISPATCH_DEPTH_PER_WORKER, MIN_DISPATCH_DEPTH) - queue_depth
@@ -0,0 +1,29 @@
+import os
+import hashlib
+
+from api_gateway.models import TERMINAL_STATUSES
+
+STATUS_PENDING_MAX_AGE_SECONDS = int(os.getenv("STATUS_PENDING_MAX_AGE_SECONDS", "2"))
+STATUS_TERMINAL_MAX_AGE_SECONDS = 31536000
+
+
+def status_etag(status, updated_at, progress=None):
+    # weak: the body may carry hints that change without the row changing
+    version = f"{status}|{updated_at.isoformat() if updated_at else ''}"
+    if progress:
+        # buffered progress moves without updated_at changing
+        version += f"|{progress['step']}"
+    return 'W/"' + hashlib.sha1(version.encode("utf-8")).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+def status_cache_control(status):
+    if status in TERMINAL_STATUSES:
+        return f"public, max-age={STATUS_TERMINAL_MAX_AGE_SECONDS}, immutable"
+    return f"public, max-age={STATUS_PENDING_MAX_AGE_SECONDS}"
@@ -0,0 +1,101 @@
+import os
+import hashlib
+import threading
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from api_gateway.database import SessionLocal
+from api_gateway.models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_KEY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = int(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "600"))
+IDEMPOTENCY_PURGE_BATCH_SIZE = 1000
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+
+class KeyedLocks:
+    # one lock per key so concurrent duplicates inside a replica wait for the first submission
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}
+
+    @contextmanager
+    def hold(self, key):
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+def is_valid_key(key):
+    return 0 < len(key) <= MAX_IDEMPOTENCY_KEY_LENGTH
+
+
+def scoped_key(tenant_id, key):
+    # keys are chosen by clients, so two tenants may pick the same one; the stored key is per tenant
+    return hashlib.sha256(f"{tenant_id}\n{key}".encode("utf-8")).hexdigest()
+
+
+def find_request_id(db, key):
+    record = db.get(IdempotencyKey, key)
+    if record is None:
+        return None
+
+    if record.expires_at <= datetime.utcnow():
+        db.delete(record)
+        db.flush()
+        return None
+
+    return record.request_id
+
+
+def remember_request_id(db, key, request_id):
+    now = datetime.utcnow()
+    db.add(IdempotencyKey(
+        key = key,
+        request_id = request_id,
+        created_at = now,
+        expires_at = now + timedelta(seconds=IDEMPOTENCY_KEY_TTL_SECONDS)
+    ))
+
+
+def forget_key(db, key):
+    db.query(IdempotencyKey).filter(IdempotencyKey.key == key).delete(synchronize_session=False)
+
+
+def purge_expired_keys():
+    db = SessionLocal()
+    try:
+        total = 0
+        while True:
+            expired_keys = [
+                key for (key,) in db.query(IdempotencyKey.key)
+                .filter(IdempotencyKey.expires_at <= datetime.utcnow())
+                .limit(IDEMPOTENCY_PURGE_BATCH_SIZE)
+            ]
+            if not expired_keys:
+                break
+            deleted = (
+                db.query(IdempotencyKey)
+                .filter(IdempotencyKey.key.in_(expired_keys))
+                .delete(synchronize_session=False)
+            )
+            db.commit()
+            total += deleted
+            if deleted < IDEMPOTENCY_PURGE_BATCH_SIZE:
+                break
+        if total:
+            logger.info(f"Purged {total} expired idempotency keys")
+    finally:
+        db.close()
@@ -0,0 +1,51 @@
+import logging
+
+from api_gateway.database import engine
+
+logger = logging.getLogger(__name__)
+
+
+class AdvisoryLockLeader:
+    # leadership is a session-level pg advisory lock held on a dedicated connection;
+    # if that connection dies Postgres releases the lock and another replica takes over
+    def __init__(self, lock_id, engine=engine):
+        self.lock_id = lock_id
+        self.engine = engine
+        self._connection = None
+
+    def is_leader(self):
+        try:
+            if self._connection is not None:
+                self._execute("SELECT 1")
+                return True
+
+            connection = self.engine.raw_connection()
+            connection.detach()
+            connection.driver_connection.autocommit = True
+            self._connection = connection
+            if self._execute("SELECT pg_try_advisory_lock(%s)", (self.lock_id,)):
+                logger.info(f"Acquired leadership for advisory lock {self.lock_id}")
+                return True
+
+            self._close()
+            return False
+        except Exception:
+            logger.warning(f"Lost connection holding advisory lock {self.lock_id}", exc_info=True)
+            self._close()
+            return False
+
+    def _execute(self, statement, params=None):
+        with self._connection.driver_connection.cursor() as cursor:
+            cursor.execute(statement, params)
+            return cursor.fetchone()[0]
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def release(self):
+        self._close()
@@ -0,0 +1,84 @@
+import os
+import secrets
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+
+from api_gateway.models import GenerationRequest
+
+# "amqp": jobs are published to RabbitMQ; "pull": workers lease them from the job table over HTTP
+WORK_DISPATCH_MODE = os.getenv("WORK_DISPATCH_MODE", "amqp")
+LEASE_VISIBILITY_SECONDS = int(os.getenv("LEASE_VISIBILITY_SECONDS", "300"))
+# lease given to AMQP workers when they report Processing; renewed by reporting Processing again
+PROCESSING_LEASE_SECONDS = int(os.getenv("PROCESSING_LEASE_SECONDS", "900"))
+MAX_LEASE_BATCH_SIZE = int(os.getenv("MAX_LEASE_BATCH_SIZE", "32"))
+
+
+def pull_mode_enabled():
+    return WORK_DISPATCH_MODE == "pull"
+
+
+def task_params(job):
+    return {
+        "prompt": job.prompt,
+        "negative_prompt": job.negative_prompt,
+        "num_inference_steps": job.num_inference_steps,
+        "guidance_scale": job.guidance_scale,
+        "seed": job.seed,
+    }
+
+
+def lease_jobs(db, max_jobs, visibility_seconds=LEASE_VISIBILITY_SECONDS):
+    # oldest pending jobs first; SKIP LOCKED lets concurrent leasers take disjoint batches without
+    # waiting on each other. Expired leases are returned to Pending by the reaper.
+    now = datetime.utcnow()
+    jobs = (
+        db.query(GenerationRequest)
+        .filter(
+            GenerationRequest.status == "Pending",
+            # variant parents only aggregate their children, which are leased one by one
+            GenerationRequest.num_variants.is_(None),
+            # jobs past their deadline are left for the reaper to mark Expired
+            or_(GenerationRequest.expires_at.is_(None), GenerationRequest.expires_at > now),
+            or_(GenerationRequest.run_at.is_(None), GenerationRequest.run_at <= now)
+        )
+        .order_by(GenerationRequest.created_at)
+        .limit(max_jobs)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+    for job in jobs:
+        job.status = "Processing"
+        job.started_at = now
+        job.lease_token = secrets.token_hex(16)
+        job.lease_expires_at = now + timedelta(seconds=visibility_seconds)
+        job.attempts = (job.attempts or 0) + 1
+
+    db.commit()
+    return jobs
+
+
+def extend_lease(db, request_uuid, lease_token, visibility_seconds=LEASE_VISIBILITY_SECONDS):
+    lease_expires_at = datetime.utcnow() + timedelta(seconds=visibility_seconds)
+    updated = db.query(GenerationRequest).filter(
+        GenerationRequest.request_id == request_uuid,
+        GenerationRequest.status == "Processing",
+        GenerationRequest.lease_token == lease_token
+    ).update({"lease_expires_at": lease_expires_at}, synchronize_session=False)
+    db.commit()
+    return lease_expires_at if updated else None
+
+
+def start_processing_lease(job):
+    if job.status != "Processing":
+        job.attempts = (job.attempts or 0) + 1
+    job.lease_expires_at = datetime.utcnow() + timedelta(seconds=PROCESSING_LEASE_SECONDS)
+
+
+def holds_lease(job, lease_token):
+    return job.status == "Processing" and job.lease_token is not None and secrets.compare_digest(job.lease_token, lease_token)
+
+
+def release_lease(job):
+    job.lease_token = None
+    job.lease_expires_at = None
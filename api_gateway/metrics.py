@@ -0,0 +1,78 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+RESULT_CACHE_LOOKUPS = Counter(
+    "result_cache_lookups_total",
+    "Result cache lookups on /generate",
+    ["result"]
+)
+RESULT_CACHE_INVALIDATIONS = Counter(
+    "result_cache_invalidated_entries_total",
+    "Result cache entries removed by invalidation"
+)
+NEAR_DUPLICATE_LOOKUPS = Counter(
+    "near_duplicate_lookups_total",
+    "Near-duplicate prompt lookups on /generate after an exact cache miss",
+    ["result"]
+)
+SINGLEFLIGHT_CALLS = Counter(
+    "singleflight_calls_total",
+    "Calls through a single-flight group; followers shared a leader's in-flight result",
+    ["flight", "role"]
+)
+BLOOM_FILTER_LOOKUPS = Counter(
+    "request_id_bloom_lookups_total",
+    "request_id lookups answered by the bloom filter; negative ones never reach the database",
+    ["result"]
+)
+WEBHOOK_DELIVERIES = Counter(
+    "webhook_deliveries_total",
+    "Completion callback outcomes",
+    ["result"]
+)
+BATCHED_JOBS = Histogram(
+    "batched_jobs_per_message",
+    "Jobs packed into each batch message by the grouping publisher",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16)
+)
+TENANT_BACKLOG_JOBS = Gauge(
+    "tenant_backlog_jobs",
+    "Jobs held by the fair scheduler, per tenant",
+    ["tenant"]
+)
+TENANT_BACKLOG_STEPS = Gauge(
+    "tenant_backlog_inference_steps",
+    "Inference steps held by the fair scheduler, per tenant",
+    ["tenant"]
+)
+FAIR_DISPATCHED_JOBS = Counter(
+    "fair_scheduler_dispatched_jobs_total",
+    "Jobs released to the broker by the fair scheduler",
+    ["tenant"]
+)
+API_KEY_USAGE_STEPS = Counter(
+    "api_key_usage_inference_steps_total",
+    "Inference steps charged to API keys, per tenant",
+    ["tenant"]
+)
+RATE_LIMITED_REQUESTS = Counter(
+    "rate_limited_requests_total",
+    "Generation requests rejected by the per-key rate limit or quota",
+    ["reason"]
+)
+PREGENERATED_JOBS = Counter(
+    "pregenerated_jobs_total",
+    "Speculative jobs queued for popular prompts while workers were idle"
+)
+PROGRESS_REPORTS = Counter(
+    "progress_reports_total",
+    "Per-step progress reports accepted into the in-memory buffer"
+)
+PROGRESS_ROWS_FLUSHED = Counter(
+    "progress_rows_flushed_total",
+    "Rows written by coalesced progress flushes"
+)
+STATUS_UPDATES = Counter(
+    "batched_status_updates_total",
+    "Worker status updates applied through the set-based batch path, by outcome",
+    ["path", "result"]
+)
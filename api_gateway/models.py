@@ -1,9 +1,14 @@
 import uuid
 from datetime import datetime
-from sqlalchemy import Column, String, Text, Integer, Float, BigInteger, DateTime
+from sqlalchemy import Column, String, Text, Integer, Float, BigInteger, Boolean, DateTime, ForeignKey, Index, text
 from sqlalchemy.dialects.postgresql import UUID
 from api_gateway.database import Base
 
+# statuses a request never leaves once reached
+TERMINAL_STATUSES = ("Completed", "Failed", "Cancelled", "Expired")
+# terminal statuses a worker may report
+RESULT_STATUSES = ("Completed", "Failed")
+
 class GenerationRequest(Base):
     __tablename__ = "generation_requests"
     request_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -16,4 +21,108 @@ class GenerationRequest(Base):
     image_url = Column(Text)
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
-    
\ No newline at end of file
+    started_at = Column(DateTime)
+    callback_url = Column(Text)
+    lease_token = Column(String(64))
+    lease_expires_at = Column(DateTime)
+    attempts = Column(Integer, nullable=False, default=0)
+    expires_at = Column(DateTime)
+    parent_request_id = Column(UUID(as_uuid=True), ForeignKey("generation_requests.request_id", ondelete="CASCADE"), index=True)
+    num_variants = Column(Integer)
+    style = Column(String(64))
+    tenant_id = Column(String(64))
+    # held by the gateway's fair scheduler until it is published
+    awaiting_dispatch = Column(Boolean, nullable=False, default=False)
+    run_at = Column(DateTime)
+    # comma-separated post-processing stages after base generation, e.g. "upscale,remove_background"
+    pipeline = Column(String(255))
+    # last flushed by the progress buffer; live progress is held in the gateway's memory
+    progress_step = Column(Integer)
+    progress_updated_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("idx_generation_requests_status_created_at", "status", "created_at"),
+        Index("idx_generation_requests_created_at", "created_at"),
+        Index("idx_generation_requests_status_lease_expires_at", "status", "lease_expires_at"),
+        Index("idx_generation_requests_status_expires_at", "status", "expires_at"),
+        Index(
+            "idx_generation_requests_awaiting_dispatch",
+            "tenant_id",
+            "created_at",
+            postgresql_where=text("awaiting_dispatch AND status = 'Pending'")
+        ),
+        Index(
+            "idx_generation_requests_scheduled_run_at",
+            "run_at",
+            postgresql_where=text("awaiting_dispatch AND status = 'Pending'")
+        ),
+    )
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    key = Column(String(255), primary_key=True)
+    request_id = Column(UUID(as_uuid=True), ForeignKey("generation_requests.request_id", ondelete="CASCADE"), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class ResultCacheEntry(Base):
+    __tablename__ = "result_cache"
+    cache_key = Column(String(64), primary_key=True)
+    model_version = Column(String(64), nullable=False, index=True)
+    image_url = Column(Text, nullable=False)
+    source_request_id = Column(UUID(as_uuid=True))
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ApiKey(Base):
+    __tablename__ = "api_keys"
+    # sha256 of the key, the key itself is never stored
+    key_hash = Column(String(64), primary_key=True)
+    tenant_id = Column(String(64), nullable=False, index=True)
+    plan = Column(String(32), nullable=False, default="free")
+    steps_per_minute = Column(Integer, nullable=False)
+    burst_steps = Column(Integer, nullable=False)
+    daily_step_quota = Column(BigInteger)
+    active = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ApiKeyUsage(Base):
+    __tablename__ = "api_key_usage"
+    key_hash = Column(String(64), ForeignKey("api_keys.key_hash", ondelete="CASCADE"), primary_key=True)
+    window_start = Column(DateTime, primary_key=True)
+    inference_steps = Column(BigInteger, nullable=False, default=0)
+    jobs = Column(Integer, nullable=False, default=0)
+
+
+class JobStage(Base):
+    __tablename__ = "job_stages"
+    request_id = Column(UUID(as_uuid=True), ForeignKey("generation_requests.request_id", ondelete="CASCADE"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    name = Column(String(64), nullable=False)
+    status = Column(String(20), nullable=False, default="Pending")
+    input_image_url = Column(Text)
+    output_image_url = Column(Text)
+    queued_at = Column(DateTime)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+
+class QueuedTask(Base):
+    # broker-less task queue used when QUEUE_BACKEND=postgres
+    __tablename__ = "task_queue"
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    queue_name = Column(String(255), nullable=False)
+    routing_key = Column(String(255))
+    body = Column(Text, nullable=False)
+    enqueued_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # pushed forward on claim; a message that is not acked in time becomes claimable again
+    visible_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime)
+    deliveries = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("idx_task_queue_queue_name_visible_at", "queue_name", "visible_at"),
+    )
@@ -0,0 +1,83 @@
+import select
+import threading
+import logging
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import text
+
+from api_gateway.database import engine
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY_SECONDS = 5
+
+
+class PgNotificationListener:
+    # dedicated LISTEN connection that dispatches NOTIFY payloads to per-channel handlers
+    def __init__(self, engine=engine):
+        self.engine = engine
+        self._handlers = {}
+        self._on_connect = []
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def subscribe(self, channel, handler, on_connect=None):
+        # on_connect runs after every (re)connect, to resync state that notifications may have missed
+        self._handlers.setdefault(channel, []).append(handler)
+        if on_connect:
+            self._on_connect.append(on_connect)
+
+    def start(self):
+        if not self._handlers or (self._thread and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="pg-notification-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=RECONNECT_DELAY_SECONDS + 1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            connection = None
+            try:
+                connection = self.engine.raw_connection()
+                connection.detach()
+                driver_connection = connection.driver_connection
+                driver_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with driver_connection.cursor() as cursor:
+                    for channel in self._handlers:
+                        cursor.execute(f'LISTEN "{channel}"')
+                logger.info(f"Listening for notifications on {list(self._handlers)}")
+
+                for callback in self._on_connect:
+                    callback()
+
+                self._listen(driver_connection)
+            except Exception:
+                logger.error("Notification listener failed, reconnecting", exc_info=True)
+                self._stop_event.wait(RECONNECT_DELAY_SECONDS)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def _listen(self, driver_connection):
+        while not self._stop_event.is_set():
+            if select.select([driver_connection], [], [], 1.0) == ([], [], []):
+                continue
+            driver_connection.poll()
+            while driver_connection.notifies:
+                notification = driver_connection.notifies.pop(0)
+                for handler in self._handlers.get(notification.channel, []):
+                    try:
+                        handler(notification.payload)
+                    except Exception:
+                        logger.error(f"Handler for channel '{notification.channel}' failed", exc_info=True)
+
+
+def notify(db, channel, payload):
+    # delivered to listeners when the surrounding transaction commits
+    db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": channel, "payload": payload})
@@ -0,0 +1,106 @@
+import os
+from datetime import datetime
+
+from api_gateway.models import JobStage
+
+BASE_STAGE = "generate"
+# post-processing stages and the queue each one's GPU pool consumes
+PIPELINE_STAGE_QUEUES = {
+    name.strip(): queue.strip()
+    for name, queue in (
+        item.split("=", 1)
+        for item in os.getenv(
+            "PIPELINE_STAGE_QUEUES",
+            "upscale=image_upscale_queue,remove_background=image_background_removal_queue"
+        ).split(",")
+        if "=" in item
+    )
+}
+MAX_PIPELINE_STAGES = 4
+
+
+def validate_stages(stages):
+    unknown = [name for name in stages if name not in PIPELINE_STAGE_QUEUES]
+    if unknown:
+        return f"unknown stages {unknown}, available: {sorted(PIPELINE_STAGE_QUEUES)}"
+    if len(stages) > MAX_PIPELINE_STAGES:
+        return f"at most {MAX_PIPELINE_STAGES} stages are supported"
+    if len(set(stages)) != len(stages):
+        return "stages must not repeat"
+    return None
+
+
+def pipeline_value(stages):
+    return ",".join(stages) if stages else None
+
+
+def stage_names(pipeline):
+    return pipeline.split(",") if pipeline else []
+
+
+def create_stages(request_id, stages):
+    # position 0 is the base generation, published like any other job
+    names = [BASE_STAGE] + list(stages)
+    now = datetime.utcnow()
+    return [
+        JobStage(
+            request_id = request_id,
+            position = position,
+            name = name,
+            status = "Pending",
+            queued_at = now if position == 0 else None
+        )
+        for position, name in enumerate(names)
+    ]
+
+
+def load_stages(db, request_id, for_update=False):
+    query = db.query(JobStage).filter(JobStage.request_id == request_id).order_by(JobStage.position)
+    if for_update:
+        query = query.with_for_update()
+    return query.all()
+
+
+def current_stage(stages):
+    for stage in stages:
+        if stage.status != "Completed":
+            return stage
+    return None
+
+
+def mark(stage, status, image_url=None, now=None):
+    now = datetime.utcnow() if now is None else now
+    if status == "Processing" and stage.started_at is None:
+        stage.started_at = now
+    if status in ("Completed", "Failed"):
+        stage.finished_at = now
+    if image_url:
+        stage.output_image_url = image_url
+    stage.status = status
+
+
+def queue_stage(stage, input_image_url, now=None):
+    stage.input_image_url = input_image_url
+    stage.queued_at = datetime.utcnow() if now is None else now
+
+
+def stage_message(job, stage):
+    return {
+        "request_id": str(job.request_id),
+        "stage": stage.name,
+        "input_image_url": stage.input_image_url,
+        "params": {"prompt": job.prompt, "seed": job.seed}
+    }
+
+
+def describe(stage):
+    def seconds(start, end):
+        return round((end - start).total_seconds(), 3) if start and end else None
+
+    return {
+        "name": stage.name,
+        "status": stage.status,
+        "queue_seconds": seconds(stage.queued_at, stage.started_at),
+        "run_seconds": seconds(stage.started_at, stage.finished_at),
+        "image_url": stage.output_image_url
+    }
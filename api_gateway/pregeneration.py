@@ -0,0 +1,188 @@
+import os
+import time
+import uuid
+import logging
+from datetime import datetime, timedelta
+
+from api_gateway.models import GenerationRequest, ResultCacheEntry
+from api_gateway import result_cache
+from api_gateway import routing
+from api_gateway.metrics import PREGENERATED_JOBS
+
+logger = logging.getLogger(__name__)
+
+PREGENERATION_ENABLED = os.getenv("PREGENERATION_ENABLED", "false").lower() == "true"
+PREGENERATION_QUEUE_NAME = "image_generation_pregeneration_queue"
+PREGENERATION_INTERVAL_SECONDS = int(os.getenv("PREGENERATION_INTERVAL_SECONDS", "60"))
+PREGENERATION_TOP_K = int(os.getenv("PREGENERATION_TOP_K", "256"))
+PREGENERATION_MIN_COUNT = int(os.getenv("PREGENERATION_MIN_COUNT", "5"))
+# the work queue is considered idle at or below this depth
+PREGENERATION_IDLE_QUEUE_DEPTH = int(os.getenv("PREGENERATION_IDLE_QUEUE_DEPTH", "2"))
+PREGENERATION_MAX_JOBS_PER_RUN = int(os.getenv("PREGENERATION_MAX_JOBS_PER_RUN", "4"))
+PREGENERATION_LOOKBACK_HOURS = int(os.getenv("PREGENERATION_LOOKBACK_HOURS", "24"))
+# counts are halved this often so the sketch follows what is trending now
+PREGENERATION_DECAY_SECONDS = int(os.getenv("PREGENERATION_DECAY_SECONDS", "3600"))
+PREGENERATION_SCAN_BATCH_SIZE = 10000
+PREGENERATION_INFLIGHT_SECONDS = 1800
+PREGENERATION_TENANT = "_pregeneration"
+PREGENERATION_LOCK_ID = 0x70726567
+
+
+class SpaceSaving:
+    # top-k heavy hitters in O(k) memory: a new key replaces the current minimum and inherits its
+    # count as overestimation error, so any key with true frequency above n/k is guaranteed to be kept
+    def __init__(self, capacity=PREGENERATION_TOP_K):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+            return None
+
+        evicted = None
+        floor = 0
+        if len(self.counts) >= self.capacity:
+            evicted = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(evicted)
+            self.errors.pop(evicted)
+        self.counts[key] = floor + count
+        self.errors[key] = floor
+        return evicted
+
+    def top(self, min_count=1):
+        # ranked by guaranteed count, so keys that only inherited a large error do not jump the line
+        ranked = sorted(self.counts, key=lambda key: self.counts[key] - self.errors[key], reverse=True)
+        return [key for key in ranked if self.counts[key] - self.errors[key] >= min_count]
+
+    def decay(self):
+        for key in list(self.counts):
+            self.counts[key] //= 2
+            self.errors[key] //= 2
+            if self.counts[key] == 0:
+                del self.counts[key]
+                del self.errors[key]
+
+
+def request_tuple(row):
+    return (
+        row.prompt,
+        row.negative_prompt or "",
+        row.num_inference_steps,
+        round(float(row.guidance_scale), 4),
+        row.seed,
+        routing.explicit_style(row.style, row.prompt)
+    )
+
+
+class Pregenerator:
+    # counts recent submissions incrementally and, while workers are idle, queues the most popular
+    # uncached tuples at low priority so their results are already in the result cache at peak
+    def __init__(self, session_factory, leader, queue_depth, publish, sketch=None, register_request_id=None, remember_request_ids=None):
+        self.session_factory = session_factory
+        self.leader = leader
+        self.queue_depth = queue_depth
+        self.publish = publish
+        # the gateway's request_id registration (bloom filter): inside the insert transaction, and after its commit
+        self.register_request_id = register_request_id
+        self.remember_request_ids = remember_request_ids
+        self.sketch = sketch or SpaceSaving()
+        self._cursor = None
+        self._next_decay = time.monotonic() + PREGENERATION_DECAY_SECONDS
+        self._in_flight = {}
+
+    def run_once(self):
+        if not self.leader.is_leader():
+            return 0
+
+        db = self.session_factory()
+        try:
+            self.observe_recent(db)
+            if time.monotonic() >= self._next_decay:
+                self.sketch.decay()
+                self._next_decay = time.monotonic() + PREGENERATION_DECAY_SECONDS
+
+            if self.queue_depth() > PREGENERATION_IDLE_QUEUE_DEPTH:
+                return 0
+            return self.enqueue_popular(db)
+        finally:
+            db.close()
+
+    def observe_recent(self, db):
+        if self._cursor is None:
+            self._cursor = datetime.utcnow() - timedelta(hours=PREGENERATION_LOOKBACK_HOURS)
+
+        rows = (
+            db.query(
+                GenerationRequest.prompt,
+                GenerationRequest.negative_prompt,
+                GenerationRequest.num_inference_steps,
+                GenerationRequest.guidance_scale,
+                GenerationRequest.seed,
+                GenerationRequest.style,
+                GenerationRequest.created_at
+            )
+            .filter(
+                GenerationRequest.created_at > self._cursor,
+                GenerationRequest.parent_request_id.is_(None),
+                GenerationRequest.num_variants.is_(None),
+                GenerationRequest.tenant_id.is_distinct_from(PREGENERATION_TENANT)
+            )
+            .order_by(GenerationRequest.created_at)
+            .limit(PREGENERATION_SCAN_BATCH_SIZE)
+            .all()
+        )
+        for row in rows:
+            if row.num_inference_steps is not None and row.guidance_scale is not None and row.seed is not None:
+                self.sketch.add(request_tuple(row))
+        if rows:
+            self._cursor = rows[-1].created_at
+        return len(rows)
+
+    def enqueue_popular(self, db):
+        now = time.monotonic()
+        self._in_flight = {key: started for key, started in self._in_flight.items() if now - started < PREGENERATION_INFLIGHT_SECONDS}
+
+        enqueued = 0
+        for candidate in self.sketch.top(PREGENERATION_MIN_COUNT):
+            if enqueued >= PREGENERATION_MAX_JOBS_PER_RUN:
+                break
+            if candidate in self._in_flight:
+                continue
+            prompt, negative_prompt, steps, guidance_scale, seed, style = candidate
+            key = result_cache.cache_key(prompt, negative_prompt, steps, guidance_scale, seed, style=style)
+            if db.get(ResultCacheEntry, key) is not None:
+                continue
+
+            job = GenerationRequest(
+                request_id = uuid.uuid4(),
+                prompt = prompt,
+                negative_prompt = negative_prompt,
+                num_inference_steps = steps,
+                guidance_scale = guidance_scale,
+                seed = seed,
+                style = style or routing.detect_style(prompt),
+                tenant_id = PREGENERATION_TENANT
+            )
+            db.add(job)
+            if self.register_request_id:
+                self.register_request_id(db, job.request_id)
+            db.commit()
+            if self.remember_request_ids:
+                self.remember_request_ids([job.request_id])
+            try:
+                self.publish(job)
+            except Exception:
+                job.status = "Failed"
+                db.commit()
+                raise
+
+            self._in_flight[candidate] = now
+            PREGENERATED_JOBS.inc()
+            enqueued += 1
+            logger.info("Queued speculative pre-generation", extra={"request_id": str(job.request_id)})
+        return enqueued
@@ -0,0 +1,89 @@
+import os
+import threading
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, update
+
+from api_gateway.models import GenerationRequest
+from api_gateway.metrics import PROGRESS_REPORTS, PROGRESS_ROWS_FLUSHED
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FLUSH_SECONDS = float(os.getenv("PROGRESS_FLUSH_SECONDS", "5"))
+# entries of jobs finished elsewhere (another replica, the reaper) are dropped after this long without a report
+PROGRESS_RETENTION_SECONDS = int(os.getenv("PROGRESS_RETENTION_SECONDS", "900"))
+
+Progress = namedtuple("Progress", ["step", "total_steps", "reported_at"])
+
+
+class ProgressBuffer:
+    # write-behind store for per-step progress: reports only touch memory, a periodic flush
+    # writes the latest step of every job that moved since the last flush in one statement
+    def __init__(self, session_factory, retention_seconds=PROGRESS_RETENTION_SECONDS):
+        self.session_factory = session_factory
+        self.retention = timedelta(seconds=retention_seconds)
+        self._progress = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def report(self, request_id, step, total_steps=None, now=None):
+        progress = Progress(step, total_steps, datetime.utcnow() if now is None else now)
+        with self._lock:
+            self._progress[request_id] = progress
+            self._dirty.add(request_id)
+        PROGRESS_REPORTS.inc()
+        return progress
+
+    def get(self, request_id):
+        return self._progress.get(request_id)
+
+    def discard(self, request_id):
+        # terminal transitions are written through by update_db, nothing left to flush
+        with self._lock:
+            self._progress.pop(request_id, None)
+            self._dirty.discard(request_id)
+
+    def __len__(self):
+        return len(self._progress)
+
+    def _take_dirty(self, now):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            stale = [request_id for request_id, progress in self._progress.items() if now - progress.reported_at > self.retention]
+            for request_id in stale:
+                del self._progress[request_id]
+            return [
+                {"b_request_id": request_id, "b_step": self._progress[request_id].step, "b_reported_at": self._progress[request_id].reported_at}
+                for request_id in dirty
+                if request_id in self._progress
+            ]
+
+    def flush(self, now=None):
+        rows = self._take_dirty(datetime.utcnow() if now is None else now)
+        if not rows:
+            return 0
+
+        table = GenerationRequest.__table__
+        statement = (
+            update(table)
+            .where(table.c.request_id == bindparam("b_request_id"), table.c.status == "Processing")
+            # progress is not a status change, keep updated_at (and the status ETag version) as is: the assignment
+            # overrides the model's onupdate, the updated_at trigger skips rows where only progress columns change
+            .values(progress_step=bindparam("b_step"), progress_updated_at=bindparam("b_reported_at"), updated_at=table.c.updated_at)
+        )
+        db = self.session_factory()
+        try:
+            db.execute(statement, rows)
+            db.commit()
+        except Exception:
+            # retried with whatever is newest on the next flush
+            with self._lock:
+                self._dirty.update(row["b_request_id"] for row in rows)
+            raise
+        finally:
+            db.close()
+
+        PROGRESS_ROWS_FLUSHED.inc(len(rows))
+        return len(rows)
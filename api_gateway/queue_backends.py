@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import threading
+import logging
+from abc import ABC, abstractmethod
+from collections import namedtuple, defaultdict
+from datetime import datetime, timedelta
+
+import pika
+from sqlalchemy import func, or_
+
+from api_gateway import expiry
+from api_gateway.models import QueuedTask
+from api_gateway.notifications import notify
+
+logger = logging.getLogger(__name__)
+
+# "rabbitmq": tasks are published to the broker; "postgres": tasks are rows in task_queue, no broker needed
+QUEUE_BACKEND = os.getenv("QUEUE_BACKEND", "rabbitmq")
+TASK_QUEUE_CHANNEL = "task_queue"
+TASK_QUEUE_VISIBILITY_SECONDS = int(os.getenv("TASK_QUEUE_VISIBILITY_SECONDS", "900"))
+TASK_QUEUE_PURGE_INTERVAL_SECONDS = int(os.getenv("TASK_QUEUE_PURGE_INTERVAL_SECONDS", "60"))
+MAX_CLAIM_BATCH_SIZE = int(os.getenv("MAX_CLAIM_BATCH_SIZE", "32"))
+# a long-polling claim holds one of the gateway's request threads (40 by default) while it waits,
+# past MAX_CLAIM_WAITERS concurrent waiters claims answer right away and the worker polls again
+MAX_CLAIM_WAIT_SECONDS = 30
+MAX_CLAIM_WAITERS = int(os.getenv("MAX_CLAIM_WAITERS", "10"))
+
+# messages: ready to be consumed; consumers: RabbitMQ's consumer count, or claimed and unacked
+# messages for Postgres, which knows nothing about idle consumers
+QueueDepth = namedtuple("QueueDepth", ["messages", "consumers"])
+ClaimedTask = namedtuple("ClaimedTask", ["id", "routing_key", "message", "deliveries"])
+
+
+def postgres_backend_enabled():
+    return QUEUE_BACKEND == "postgres"
+
+
+class QueueBackend(ABC):
+    @abstractmethod
+    def declare(self, queue_name):
+        pass
+
+    @abstractmethod
+    def publish(self, queue_name, message, expires_at=None, exchange="", routing_key=None):
+        pass
+
+    @abstractmethod
+    def depth(self, queue_name):
+        pass
+
+
+class RabbitMQBackend(QueueBackend):
+    # wraps a channel owned by the calling thread
+    def __init__(self, channel):
+        self.channel = channel
+
+    def declare(self, queue_name):
+        self.channel.queue_declare(queue=queue_name, durable=True)
+
+    def publish(self, queue_name, message, expires_at=None, exchange="", routing_key=None):
+        self.channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key or queue_name,
+            body=json.dumps(message),
+            # the broker dead-letters the message once the job's deadline passes
+            properties=pika.BasicProperties(
+                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+                expiration=expiry.message_expiration(expires_at) if expires_at else None
+            )
+        )
+
+    def depth(self, queue_name):
+        method = self.channel.queue_declare(queue=queue_name, passive=True).method
+        return QueueDepth(method.message_count, method.consumer_count)
+
+
+class PostgresQueueBackend(QueueBackend):
+    # SKIP LOCKED lets concurrent consumers claim disjoint batches; NOTIFY wakes claimers waiting on an empty queue.
+    # Exchanges do not exist here, a topic routing key is stored with the message and matched exactly on claim.
+    def __init__(self, session_factory, max_waiters=MAX_CLAIM_WAITERS):
+        self.session_factory = session_factory
+        self._versions = defaultdict(int)
+        self._condition = threading.Condition()
+        self._waiters = threading.BoundedSemaphore(max_waiters)
+
+    def declare(self, queue_name):
+        pass
+
+    def publish(self, queue_name, message, expires_at=None, exchange="", routing_key=None):
+        db = self.session_factory()
+        try:
+            db.add(QueuedTask(
+                queue_name = queue_name,
+                routing_key = routing_key if exchange else None,
+                body = json.dumps(message),
+                expires_at = expires_at
+            ))
+            notify(db, TASK_QUEUE_CHANNEL, queue_name)
+            db.commit()
+        finally:
+            db.close()
+
+    def depth(self, queue_name, now=None):
+        now = datetime.utcnow() if now is None else now
+        db = self.session_factory()
+        try:
+            ready, claimed = db.query(
+                func.count().filter(QueuedTask.visible_at <= now),
+                func.count().filter(QueuedTask.visible_at > now)
+            ).filter(QueuedTask.queue_name == queue_name).one()
+        finally:
+            db.close()
+        return QueueDepth(ready or 0, claimed or 0)
+
+    def claim(self, queue_name, max_messages, visibility_seconds=TASK_QUEUE_VISIBILITY_SECONDS, routing_keys=None, now=None):
+        now = datetime.utcnow() if now is None else now
+        db = self.session_factory()
+        try:
+            query = db.query(QueuedTask).filter(
+                QueuedTask.queue_name == queue_name,
+                QueuedTask.visible_at <= now,
+                # expired messages are never delivered, the reaper marks their jobs Expired
+                or_(QueuedTask.expires_at.is_(None), QueuedTask.expires_at > now)
+            )
+            if routing_keys:
+                query = query.filter(or_(QueuedTask.routing_key.in_(routing_keys), QueuedTask.routing_key.is_(None)))
+            tasks = query.order_by(QueuedTask.id).limit(max_messages).with_for_update(skip_locked=True).all()
+
+            claimed = []
+            for task in tasks:
+                task.visible_at = now + timedelta(seconds=visibility_seconds)
+                task.deliveries = (task.deliveries or 0) + 1
+                claimed.append(ClaimedTask(task.id, task.routing_key, json.loads(task.body), task.deliveries))
+            db.commit()
+            return claimed
+        finally:
+            db.close()
+
+    def claim_or_wait(self, queue_name, max_messages, wait_seconds, visibility_seconds=TASK_QUEUE_VISIBILITY_SECONDS, routing_keys=None):
+        # long poll: claims right away, otherwise sleeps until a publish to this queue is announced
+        if wait_seconds <= 0 or not self._waiters.acquire(blocking=False):
+            return self.claim(queue_name, max_messages, visibility_seconds, routing_keys)
+        try:
+            deadline = time.monotonic() + wait_seconds
+            while True:
+                with self._condition:
+                    version = self._versions[queue_name]
+                claimed = self.claim(queue_name, max_messages, visibility_seconds, routing_keys)
+                remaining = deadline - time.monotonic()
+                if claimed or remaining <= 0:
+                    return claimed
+                with self._condition:
+                    self._condition.wait_for(lambda: self._versions[queue_name] != version, remaining)
+        finally:
+            self._waiters.release()
+
+    def on_notification(self, queue_name):
+        with self._condition:
+            self._versions[queue_name] += 1
+            self._condition.notify_all()
+
+    def ack(self, queue_name, task_ids):
+        if not task_ids:
+            return 0
+        db = self.session_factory()
+        try:
+            deleted = db.query(QueuedTask).filter(
+                QueuedTask.queue_name == queue_name,
+                QueuedTask.id.in_(task_ids)
+            ).delete(synchronize_session=False)
+            db.commit()
+            return deleted
+        finally:
+            db.close()
+
+    def purge_expired(self):
+        db = self.session_factory()
+        try:
+            deleted = db.query(QueuedTask).filter(QueuedTask.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+        if deleted:
+            logger.info(f"Purged {deleted} expired task queue messages")
+        return deleted
@@ -0,0 +1,221 @@
+import os
+import math
+import time
+import hashlib
+import threading
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from api_gateway.models import ApiKey, ApiKeyUsage
+from api_gateway.metrics import API_KEY_USAGE_STEPS, RATE_LIMITED_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+API_KEY_AUTH_ENABLED = os.getenv("API_KEY_AUTH_ENABLED", "false").lower() == "true"
+RATE_LIMIT_RECONCILE_SECONDS = int(os.getenv("RATE_LIMIT_RECONCILE_SECONDS", "5"))
+API_KEY_CACHE_SECONDS = int(os.getenv("API_KEY_CACHE_SECONDS", "60"))
+# keys on this plan may call operator endpoints such as result cache invalidation
+ADMIN_PLAN = os.getenv("ADMIN_API_KEY_PLAN", "admin")
+
+ApiKeyInfo = namedtuple("ApiKeyInfo", ["key_hash", "tenant_id", "plan", "steps_per_minute", "burst_steps", "daily_step_quota"])
+
+
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def usage_window(now):
+    # usage is stored per hour, enough for billing and small enough to reconcile cheaply
+    return now.replace(minute=0, second=0, microsecond=0)
+
+
+def seconds_until_next_day(now):
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return math.ceil((tomorrow - now).total_seconds())
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity, now=None):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, cost, now=None):
+        # returns 0 when the cost was taken, otherwise the seconds until it would fit
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return math.ceil((cost - self.tokens) / self.rate)
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def deduct(self, amount):
+        # consumption seen on other replicas; may go negative and is paid back by refill
+        self.tokens -= amount
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class ApiKeyLimiter:
+    # per-key token buckets in steps per minute, enforced locally and reconciled through api_key_usage:
+    # each replica adds what it consumed and deducts what the others consumed since the last pass
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._buckets = {}
+        self._pending = {}
+        self._seen = {}
+        self._daily_used = {}
+
+    def authenticate(self, db, api_key):
+        key_hash = hash_api_key(api_key)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._keys.get(key_hash)
+        if cached and cached[1] > now:
+            return cached[0]
+
+        row = db.get(ApiKey, key_hash)
+        if row is None or not row.active:
+            return None
+        info = ApiKeyInfo(row.key_hash, row.tenant_id, row.plan, row.steps_per_minute, row.burst_steps, row.daily_step_quota)
+        with self._lock:
+            self._keys[key_hash] = (info, now + API_KEY_CACHE_SECONDS)
+        return info
+
+    def _bucket(self, key, now=None):
+        bucket = self._buckets.get(key.key_hash)
+        rate = key.steps_per_minute / 60
+        if bucket is None or bucket.rate != rate or bucket.capacity != key.burst_steps:
+            bucket = TokenBucket(rate, key.burst_steps, now)
+            self._buckets[key.key_hash] = bucket
+        return bucket
+
+    def charge(self, key, cost, now=None):
+        with self._lock:
+            steps, jobs = self._pending.get(key.key_hash, (0, 0))
+            if key.daily_step_quota is not None:
+                used = self._daily_used.get(key.key_hash, 0) + steps
+                if used + cost > key.daily_step_quota:
+                    RATE_LIMITED_REQUESTS.labels(reason="quota").inc()
+                    raise RateLimitExceeded(seconds_until_next_day(datetime.utcnow()), "Daily quota exhausted")
+
+            retry_after = self._bucket(key, now).try_consume(cost, now)
+            if retry_after:
+                RATE_LIMITED_REQUESTS.labels(reason="rate").inc()
+                raise RateLimitExceeded(retry_after, "Rate limit exceeded")
+
+            self._pending[key.key_hash] = (steps + cost, jobs + 1)
+        API_KEY_USAGE_STEPS.labels(tenant=key.tenant_id).inc(cost)
+
+    def refund(self, key, cost):
+        # the job never reached a worker
+        with self._lock:
+            bucket = self._buckets.get(key.key_hash)
+            if bucket:
+                bucket.refund(cost)
+            steps, jobs = self._pending.get(key.key_hash, (0, 0))
+            self._pending[key.key_hash] = (steps - cost, jobs - 1)
+
+    def reconcile(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            known = set(self._buckets)
+
+        now = datetime.utcnow()
+        window = usage_window(now)
+        db = self.session_factory()
+        try:
+            try:
+                for key_hash, (steps, jobs) in pending.items():
+                    if steps == 0 and jobs == 0:
+                        continue
+                    statement = insert(ApiKeyUsage).values(
+                        key_hash = key_hash,
+                        window_start = window,
+                        inference_steps = steps,
+                        jobs = jobs
+                    ).on_conflict_do_update(
+                        index_elements=["key_hash", "window_start"],
+                        set_={
+                            "inference_steps": ApiKeyUsage.inference_steps + steps,
+                            "jobs": ApiKeyUsage.jobs + jobs
+                        }
+                    )
+                    db.execute(statement)
+                db.commit()
+            except Exception:
+                # nothing was written, keep the unflushed usage for the next pass
+                with self._lock:
+                    for key_hash, (steps, jobs) in pending.items():
+                        current_steps, current_jobs = self._pending.get(key_hash, (0, 0))
+                        self._pending[key_hash] = (current_steps + steps, current_jobs + jobs)
+                raise
+
+            try:
+                totals = dict(
+                    db.query(ApiKeyUsage.key_hash, ApiKeyUsage.inference_steps)
+                    .filter(ApiKeyUsage.window_start == window, ApiKeyUsage.key_hash.in_(known))
+                    .all()
+                ) if known else {}
+                daily_used = dict(
+                    db.query(ApiKeyUsage.key_hash, func.sum(ApiKeyUsage.inference_steps))
+                    .filter(ApiKeyUsage.window_start >= now.replace(hour=0, minute=0, second=0, microsecond=0), ApiKeyUsage.key_hash.in_(known))
+                    .group_by(ApiKeyUsage.key_hash)
+                    .all()
+                ) if known else {}
+            except Exception:
+                # the usage is persisted; count it as seen so the next pass does not take it for another replica's
+                with self._lock:
+                    for key_hash, (steps, _) in pending.items():
+                        seen_window, seen_total = self._seen.get(key_hash, (None, None))
+                        if seen_window == window:
+                            self._seen[key_hash] = (window, seen_total + steps)
+                raise
+        finally:
+            db.close()
+
+        with self._lock:
+            for key_hash in known:
+                total = totals.get(key_hash, 0)
+                own = pending.get(key_hash, (0, 0))[0]
+                seen_window, seen_total = self._seen.get(key_hash, (None, None))
+                if seen_window == window:
+                    foreign = total - seen_total - own
+                elif seen_window is None:
+                    # first pass on this replica: history is already reflected in the daily quota
+                    foreign = 0
+                else:
+                    foreign = total - own
+                if foreign > 0 and key_hash in self._buckets:
+                    self._buckets[key_hash].deduct(foreign)
+                self._seen[key_hash] = (window, total)
+            self._daily_used = {key_hash: int(used) for key_hash, used in daily_used.items()}
+
+    def usage(self, db, key_hash, since):
+        return (
+            db.query(
+                func.coalesce(func.sum(ApiKeyUsage.inference_steps), 0),
+                func.coalesce(func.sum(ApiKeyUsage.jobs), 0)
+            )
+            .filter(ApiKeyUsage.key_hash == key_hash, ApiKeyUsage.window_start >= usage_window(since))
+            .one()
+        )
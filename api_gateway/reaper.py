@@ -0,0 +1,152 @@
+import os
+import logging
+from datetime import datetime
+
+from api_gateway.models import GenerationRequest
+from api_gateway import leases
+from api_gateway import pipelines
+
+logger = logging.getLogger(__name__)
+
+REAPER_INTERVAL_SECONDS = int(os.getenv("REAPER_INTERVAL_SECONDS", "30"))
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE", "100"))
+REAPER_MAX_BATCHES_PER_RUN = int(os.getenv("REAPER_MAX_BATCHES_PER_RUN", "10"))
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", "3"))
+REAPER_LOCK_ID = 0x72656170
+
+
+class StuckJobReaper:
+    # requeues Processing jobs whose lease expired, failing them once the retry budget is spent,
+    # and expires Pending jobs whose deadline passed while they waited
+    def __init__(self, session_factory, leader, publish, on_terminal=None, publish_stage=None):
+        self.session_factory = session_factory
+        self.leader = leader
+        self.publish = publish
+        self.on_terminal = on_terminal
+        self.publish_stage = publish_stage
+
+    def run_once(self):
+        if not self.leader.is_leader():
+            return 0
+
+        reaped = self._run_batches(self._reap_batch)
+        expired = self._run_batches(self._expire_batch)
+
+        if reaped or expired:
+            logger.info(f"Reaped {reaped} jobs with expired processing leases, expired {expired} pending jobs")
+        return reaped + expired
+
+    def _run_batches(self, reap_batch):
+        total = 0
+        for _ in range(REAPER_MAX_BATCHES_PER_RUN):
+            batch_size = reap_batch()
+            total += batch_size
+            if batch_size < REAPER_BATCH_SIZE:
+                break
+        return total
+
+    def _claim(self, db, status, deadline_column):
+        return (
+            db.query(GenerationRequest)
+            .filter(
+                GenerationRequest.status == status,
+                deadline_column < datetime.utcnow()
+            )
+            .order_by(deadline_column)
+            .limit(REAPER_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+
+    def _reap_batch(self):
+        db = self.session_factory()
+        try:
+            expired_leases = self._claim(db, "Processing", GenerationRequest.lease_expires_at)
+
+            now = datetime.utcnow()
+            requeued, requeued_stages, finished = [], [], []
+            for job in expired_leases:
+                stage = self._running_stage(db, job)
+                leases.release_lease(job)
+                if job.expires_at and job.expires_at < now:
+                    job.status = "Expired"
+                elif (job.attempts or 0) >= MAX_JOB_ATTEMPTS:
+                    job.status = "Failed"
+                elif stage is not None:
+                    # the job stays Processing, only the stage that lost its worker runs again
+                    stage.status = "Pending"
+                    stage.started_at = None
+                    job.attempts = (job.attempts or 0) + 1
+                    requeued_stages.append((job, stage))
+                    continue
+                else:
+                    job.status = "Pending"
+                    job.started_at = None
+                    requeued.append(job)
+                    continue
+
+                job.started_at = None
+                if stage is not None:
+                    pipelines.mark(stage, "Failed", now=now)
+                finished.append(job)
+            db.commit()
+
+            for job in requeued:
+                logger.warning(
+                    "Requeued job with expired processing lease",
+                    extra={"request_id": str(job.request_id), "attempt": job.attempts}
+                )
+                try:
+                    self.publish(job)
+                except Exception:
+                    logger.error("Failed to requeue job", extra={"request_id": str(job.request_id)}, exc_info=True)
+                    job.status = "Failed"
+                    finished.append(job)
+            for job, stage in requeued_stages:
+                logger.warning(
+                    f"Requeued pipeline stage '{stage.name}' with expired processing lease",
+                    extra={"request_id": str(job.request_id), "attempt": job.attempts}
+                )
+                try:
+                    self.publish_stage(job, stage)
+                except Exception:
+                    logger.error("Failed to requeue pipeline stage", extra={"request_id": str(job.request_id)}, exc_info=True)
+                    job.status = "Failed"
+                    pipelines.mark(stage, "Failed")
+                    finished.append(job)
+            db.commit()
+
+            self._finish(finished)
+            return len(expired_leases)
+        finally:
+            db.close()
+
+    def _running_stage(self, db, job):
+        # post-processing stages hold the job's lease while they run; the base stage is requeued as a task
+        if not job.pipeline or self.publish_stage is None:
+            return None
+        stage = pipelines.current_stage(pipelines.load_stages(db, job.request_id, for_update=True))
+        return stage if stage is not None and stage.position > 0 else None
+
+    def _expire_batch(self):
+        # catches deadlines the broker did not act on, e.g. messages stuck behind others or pull mode
+        db = self.session_factory()
+        try:
+            overdue = self._claim(db, "Pending", GenerationRequest.expires_at)
+            for job in overdue:
+                job.status = "Expired"
+            db.commit()
+
+            self._finish(overdue)
+            return len(overdue)
+        finally:
+            db.close()
+
+    def _finish(self, jobs):
+        for job in jobs:
+            logger.warning(
+                f"Marked stuck job as {job.status}",
+                extra={"request_id": str(job.request_id), "attempt": job.attempts}
+            )
+            if self.on_terminal:
+                self.on_terminal(job)
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import logging
+
+from sqlalchemy.dialects.postgresql import insert
+
+from api_gateway.models import ResultCacheEntry
+from api_gateway import routing
+from api_gateway import pipelines
+from api_gateway.metrics import RESULT_CACHE_LOOKUPS, RESULT_CACHE_INVALIDATIONS
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+MODEL_VERSION = os.getenv("MODEL_VERSION", "default")
+
+
+def cache_key(prompt, negative_prompt, num_inference_steps, guidance_scale, seed, model_version=MODEL_VERSION, style=None, pipeline=None):
+    # guidance_scale is stored as REAL, so round it before hashing to match values read back from the db
+    params = {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt or "",
+        "num_inference_steps": int(num_inference_steps),
+        "guidance_scale": round(float(guidance_scale), 4),
+        "seed": int(seed),
+        "model_version": model_version,
+    }
+    # only added when set so keys of plain requests stay stable
+    if style:
+        params["style"] = style
+    if pipeline:
+        params["pipeline"] = pipeline
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def request_cache_key(request):
+    return cache_key(
+        request.prompt,
+        request.negative_prompt,
+        request.num_inference_steps,
+        request.guidance_scale,
+        request.seed,
+        style=routing.explicit_style(request.style, request.prompt),
+        pipeline=pipelines.pipeline_value(request.stages)
+    )
+
+
+def lookup(db, request):
+    if not RESULT_CACHE_ENABLED:
+        return None
+
+    entry = db.get(ResultCacheEntry, request_cache_key(request))
+    if entry is None:
+        RESULT_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+
+    RESULT_CACHE_LOOKUPS.labels(result="hit").inc()
+    return entry.image_url
+
+
+def store(db, db_request, image_url, model_version=None):
+    if not RESULT_CACHE_ENABLED or db_request.num_inference_steps is None:
+        return
+
+    model_version = model_version or MODEL_VERSION
+    key = cache_key(
+        db_request.prompt,
+        db_request.negative_prompt,
+        db_request.num_inference_steps,
+        db_request.guidance_scale,
+        db_request.seed,
+        model_version,
+        routing.explicit_style(db_request.style, db_request.prompt),
+        db_request.pipeline
+    )
+    statement = insert(ResultCacheEntry).values(
+        cache_key = key,
+        model_version = model_version,
+        image_url = image_url,
+        source_request_id = db_request.request_id
+    ).on_conflict_do_nothing(index_elements=["cache_key"])
+    db.execute(statement)
+
+
+def invalidate(db, model_version=None):
+    # without an explicit version, drop everything not produced by the current model
+    query = db.query(ResultCacheEntry)
+    if model_version:
+        query = query.filter(ResultCacheEntry.model_version == model_version)
+    else:
+        query = query.filter(ResultCacheEntry.model_version != MODEL_VERSION)
+
+    deleted = query.delete(synchronize_session=False)
+    db.commit()
+    RESULT_CACHE_INVALIDATIONS.inc(deleted)
+    logger.info(f"Invalidated {deleted} result cache entries")
+    return deleted
@@ -0,0 +1,133 @@
+import os
+import re
+import time
+import threading
+from collections import deque
+from urllib.parse import quote
+
+import httpx
+
+from api_gateway import expiry
+from api_gateway.queue_backends import QueueDepth
+
+# "true": tasks go through a topic exchange keyed by model and style instead of straight to the work queue
+TOPIC_ROUTING_ENABLED = os.getenv("TOPIC_ROUTING_ENABLED", "false").lower() == "true"
+TASK_EXCHANGE = "image_generation.tasks"
+# receives every task no worker queue is bound for, and feeds the shared work queue
+UNROUTED_EXCHANGE = "image_generation.unrouted"
+ROUTING_MODEL = os.getenv("ROUTING_MODEL", "sd")
+DEFAULT_STYLE = "default"
+# prompt tokens that select a fine-tune or LoRA, e.g. "tsuki_advtr"
+STYLE_TRIGGER_TOKENS = [token.strip() for token in os.getenv("STYLE_TRIGGER_TOKENS", "tsuki_advtr").split(",") if token.strip()]
+# queues workers declare for the keys they have weights loaded for, matched by the dead-letter policy
+WORKER_QUEUE_PATTERN = r"image_generation\.worker\..+"
+# how often the routed queues' depth is read from the management API, and how far its counters trail
+# the broker (RabbitMQ's collect_statistics_interval, 5s by default)
+ROUTED_DEPTH_REFRESH_SECONDS = float(os.getenv("ROUTED_DEPTH_REFRESH_SECONDS", "5"))
+MANAGEMENT_STATS_LAG_SECONDS = float(os.getenv("MANAGEMENT_STATS_LAG_SECONDS", "5"))
+# a sample this old is treated as unknown rather than trusted
+ROUTED_DEPTH_MAX_AGE_SECONDS = 6 * ROUTED_DEPTH_REFRESH_SECONDS
+
+STYLE_PATTERN = r"^[a-z0-9_]{1,64}$"
+_WORD = re.compile(r"[A-Za-z0-9_]+")
+
+
+def detect_style(prompt):
+    words = set(_WORD.findall(prompt))
+    for token in STYLE_TRIGGER_TOKENS:
+        if token in words:
+            return token.lower()
+    return None
+
+
+def resolve_style(style, prompt):
+    # an explicit style wins over a trigger token in the prompt
+    return style or detect_style(prompt)
+
+
+def routing_key(style, model=ROUTING_MODEL):
+    # "<model>.<style>", so workers can bind "sd.tsuki_advtr", "sd.*" or "*.tsuki_advtr"
+    return f"{_word(model)}.{_word(style or DEFAULT_STYLE)}"
+
+
+def _word(value):
+    # topic routing keys are dot-separated words, keep a value like "v1.5" as one word
+    return re.sub(r"[^a-z0-9_-]", "_", value.lower())
+
+
+def explicit_style(style, prompt):
+    # a style already named by a trigger token is part of the prompt; only a different one changes the output
+    return style if style and style != detect_style(prompt) else None
+
+
+def declare_exchanges(channel, fallback_queue):
+    channel.queue_declare(queue=fallback_queue, durable=True)
+    channel.exchange_declare(exchange=UNROUTED_EXCHANGE, exchange_type="fanout", durable=True)
+    channel.queue_bind(queue=fallback_queue, exchange=UNROUTED_EXCHANGE)
+    channel.exchange_declare(
+        exchange=TASK_EXCHANGE,
+        exchange_type="topic",
+        durable=True,
+        arguments={"alternate-exchange": UNROUTED_EXCHANGE}
+    )
+
+
+def routed_queue_depth(host, user, password, fallback_queue):
+    # routed tasks wait in the fallback queue and in worker queues only the workers know the names of,
+    # so both are read through the management API; its counters lag the broker by a few seconds
+    api = f"http://{host}:{expiry.RABBITMQ_MANAGEMENT_PORT}/api"
+    vhost = quote("/", safe="")
+    pattern = re.compile(f"{re.escape(fallback_queue)}|{WORKER_QUEUE_PATTERN}")
+    with httpx.Client(auth=(user, password), timeout=10) as client:
+        queues = client.get(f"{api}/queues/{vhost}", params={"columns": "name,messages_ready"})
+        queues.raise_for_status()
+        consumers = client.get(f"{api}/consumers/{vhost}")
+        consumers.raise_for_status()
+
+    messages = sum(queue.get("messages_ready") or 0 for queue in queues.json() if pattern.fullmatch(queue["name"]))
+    # a worker consumes its own queue and usually the fallback queue too, count it once
+    workers = {
+        consumer["channel_details"]["connection_name"]
+        for consumer in consumers.json()
+        if pattern.fullmatch(consumer["queue"]["name"])
+    }
+    return QueueDepth(messages, len(workers))
+
+
+class RoutedQueueDepth:
+    # the management API is polled on its own interval; between samples, tasks published since the last
+    # sample could have counted them are added locally, so frequent callers do not refill the same room
+    def __init__(self, sample, lag_seconds=MANAGEMENT_STATS_LAG_SECONDS, max_age_seconds=ROUTED_DEPTH_MAX_AGE_SECONDS):
+        self.sample = sample
+        self.lag = lag_seconds
+        self.max_age = max_age_seconds
+        self._depth = None
+        self._sampled_at = None
+        self._published = deque()
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        depth = self.sample()
+        now = time.monotonic()
+        with self._lock:
+            self._depth, self._sampled_at = depth, now
+            self._prune(now - self.lag)
+
+    def record_published(self, count=1, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._published.append((now, count))
+            self._prune(now - self.lag - self.max_age)
+
+    def current(self, now=None):
+        # None while there is no recent sample, callers then assume the worst
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._depth is None or now - self._sampled_at > self.max_age:
+                return None
+            unseen = sum(count for published_at, count in self._published if published_at > self._sampled_at - self.lag)
+            return QueueDepth(self._depth.messages + unseen, self._depth.consumers)
+
+    def _prune(self, cutoff):
+        while self._published and self._published[0][0] <= cutoff:
+            self._published.popleft()
@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from api_gateway.models import GenerationRequest
+from api_gateway.rate_limit import TokenBucket
+from api_gateway.timer_wheel import HierarchicalTimerWheel
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "1"))
+# the indexed scan loads everything due within the horizon into the wheel, so restarts lose nothing
+SCHEDULED_SCAN_SECONDS = int(os.getenv("SCHEDULED_SCAN_SECONDS", "10"))
+SCHEDULED_SCAN_HORIZON_SECONDS = int(os.getenv("SCHEDULED_SCAN_HORIZON_SECONDS", "60"))
+SCHEDULED_SCAN_BATCH_SIZE = int(os.getenv("SCHEDULED_SCAN_BATCH_SIZE", "5000"))
+# smooths nightly batches into the queue instead of releasing them all on the same second
+SCHEDULED_RELEASE_RATE_PER_SECOND = float(os.getenv("SCHEDULED_RELEASE_RATE_PER_SECOND", "20"))
+SCHEDULED_RELEASE_BURST = int(os.getenv("SCHEDULED_RELEASE_BURST", "20"))
+SCHEDULED_RELEASE_LOCK_ID = 0x72756e61
+
+
+def to_utc_naive(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def is_delayed(run_at, now=None):
+    now = datetime.utcnow() if now is None else now
+    return run_at is not None and run_at > now
+
+
+def _epoch(value):
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+class ScheduledJobReleaser:
+    # releases held jobs once their run_at passes: a periodic indexed scan feeds a timer wheel,
+    # and due jobs leave through a token bucket so a large batch becomes a steady stream
+    def __init__(self, session_factory, leader, dispatch, wheel=None, release_bucket=None):
+        self.session_factory = session_factory
+        self.leader = leader
+        self.dispatch = dispatch
+        self.wheel = wheel or HierarchicalTimerWheel(SCHEDULER_TICK_SECONDS, now=time.time())
+        self.release_bucket = release_bucket or TokenBucket(SCHEDULED_RELEASE_RATE_PER_SECOND, SCHEDULED_RELEASE_BURST)
+        self._ready = deque()
+        self._next_scan = 0.0
+
+    def run_once(self, now=None):
+        now = time.time() if now is None else now
+        if not self.leader.is_leader():
+            # another replica owns the wheel now, its scan picks up everything we held
+            self.wheel = HierarchicalTimerWheel(self.wheel.tick_seconds, now=now)
+            self._ready.clear()
+            self._next_scan = 0.0
+            return 0
+
+        if now >= self._next_scan:
+            self.scan(now)
+            self._next_scan = now + SCHEDULED_SCAN_SECONDS
+
+        self._ready.extend(self.wheel.advance(now))
+        return self.release()
+
+    def scan(self, now):
+        horizon = datetime.fromtimestamp(now, timezone.utc).replace(tzinfo=None) + timedelta(seconds=SCHEDULED_SCAN_HORIZON_SECONDS)
+        db = self.session_factory()
+        try:
+            rows = (
+                db.query(GenerationRequest.request_id, GenerationRequest.run_at)
+                .filter(
+                    GenerationRequest.awaiting_dispatch.is_(True),
+                    GenerationRequest.status == "Pending",
+                    GenerationRequest.run_at <= horizon
+                )
+                .order_by(GenerationRequest.run_at)
+                .limit(SCHEDULED_SCAN_BATCH_SIZE)
+                .all()
+            )
+        finally:
+            db.close()
+
+        queued = set(self._ready)
+        added = 0
+        for request_id, run_at in rows:
+            if request_id not in self.wheel and request_id not in queued:
+                self.wheel.add(request_id, _epoch(run_at))
+                added += 1
+        if added:
+            logger.info(f"Loaded {added} scheduled jobs due within {SCHEDULED_SCAN_HORIZON_SECONDS}s")
+        return added
+
+    def release(self):
+        batch = []
+        while self._ready and self.release_bucket.try_consume(1) == 0:
+            batch.append(self._ready.popleft())
+        if not batch:
+            return 0
+
+        db = self.session_factory()
+        released = 0
+        try:
+            # cancelled, expired or already released rows drop out here
+            jobs = (
+                db.query(GenerationRequest)
+                .filter(
+                    GenerationRequest.request_id.in_(batch),
+                    GenerationRequest.awaiting_dispatch.is_(True),
+                    GenerationRequest.status == "Pending"
+                )
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            try:
+                for job in jobs:
+                    self.dispatch(db, job)
+                    job.awaiting_dispatch = False
+                    released += 1
+            finally:
+                # rows left awaiting dispatch after a failed publish are loaded again by the next scan
+                db.commit()
+        finally:
+            db.close()
+
+        logger.info(f"Released {released} scheduled jobs")
+        return released
@@ -0,0 +1,120 @@
+import os
+import re
+import hashlib
+import threading
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+NEAR_DUPLICATE_ENABLED = os.getenv("NEAR_DUPLICATE_ENABLED", "false").lower() == "true"
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.9"))
+NEAR_DUPLICATE_CAPACITY = int(os.getenv("NEAR_DUPLICATE_CAPACITY", "4096"))
+NEAR_DUPLICATE_DIM = int(os.getenv("NEAR_DUPLICATE_DIM", "512"))
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9_]+")
+
+
+def _feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def prompt_vector(prompt, dim=NEAR_DUPLICATE_DIM):
+    # bag of words plus character trigrams, so punctuation and word order do not matter
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in _TOKEN_PATTERN.findall(prompt.lower()):
+        features = ["w:" + token]
+        padded = f"#{token}#"
+        features.extend("c:" + padded[i:i + 3] for i in range(len(padded) - 2))
+        for feature in features:
+            hashed = _feature_hash(feature)
+            vector[hashed % dim] += 1.0 if hashed >> 63 else -1.0
+
+    return vector
+
+
+class NearDuplicateMatch:
+    def __init__(self, request_id, image_url, score):
+        self.request_id = request_id
+        self.image_url = image_url
+        self.score = score
+
+
+class PromptIndex:
+    # fixed-size ring buffer of recently completed prompts, scored in one matrix-vector product.
+    # features are idf-weighted against the indexed prompts, so shared style boilerplate counts
+    # for little and a changed subject word counts for a lot
+    def __init__(self, capacity=NEAR_DUPLICATE_CAPACITY, dim=NEAR_DUPLICATE_DIM):
+        self.capacity = capacity
+        self.dim = dim
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._steps = np.zeros(capacity, dtype=np.int64)
+        self._guidance = np.zeros(capacity, dtype=np.float32)
+        self._seeds = np.zeros(capacity, dtype=np.int64)
+        self._negative = np.zeros(capacity, dtype=np.uint64)
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._document_frequency = np.zeros(dim, dtype=np.float32)
+        self._request_ids = [None] * capacity
+        self._image_urls = [None] * capacity
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return int(self._valid.sum())
+
+    def add(self, request_id, prompt, negative_prompt, num_inference_steps, guidance_scale, seed, image_url):
+        vector = prompt_vector(prompt, self.dim)
+        with self._lock:
+            slot = self._next_slot
+            if self._valid[slot]:
+                self._document_frequency -= self._vectors[slot] != 0
+            self._vectors[slot] = vector
+            self._document_frequency += vector != 0
+            self._steps[slot] = num_inference_steps
+            self._guidance[slot] = guidance_scale
+            self._seeds[slot] = seed
+            self._negative[slot] = _feature_hash((negative_prompt or "").strip().lower())
+            self._valid[slot] = True
+            self._request_ids[slot] = request_id
+            self._image_urls[slot] = image_url
+            self._next_slot = (slot + 1) % self.capacity
+
+    def find(self, prompt, negative_prompt, num_inference_steps, guidance_scale, seed, threshold=NEAR_DUPLICATE_THRESHOLD):
+        vector = prompt_vector(prompt, self.dim)
+        negative = np.uint64(_feature_hash((negative_prompt or "").strip().lower()))
+        with self._lock:
+            candidates = (
+                self._valid
+                & (self._steps == num_inference_steps)
+                & np.isclose(self._guidance, np.float32(guidance_scale))
+                & (self._seeds == seed)
+                & (self._negative == negative)
+            )
+            if not candidates.any():
+                return None
+
+            indexed = np.float32(self._valid.sum())
+            idf = np.log((1.0 + indexed) / (1.0 + self._document_frequency)) + 1.0
+            weights = idf * idf
+
+            query_norm = np.sqrt(np.dot(vector * vector, weights))
+            row_norms = np.sqrt(np.einsum("ij,ij,j->i", self._vectors, self._vectors, weights))
+            if query_norm == 0:
+                return None
+
+            scores = (self._vectors @ (vector * weights)) / (np.maximum(row_norms, 1e-6) * query_norm)
+            scores[~candidates] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                return None
+            return NearDuplicateMatch(self._request_ids[best], self._image_urls[best], float(scores[best]))
+
+    def clear(self):
+        with self._lock:
+            self._valid[:] = False
+            self._vectors[:] = 0
+            self._document_frequency[:] = 0
+            self._request_ids = [None] * self.capacity
+            self._image_urls = [None] * self.capacity
+            self._next_slot = 0
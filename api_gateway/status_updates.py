@@ -0,0 +1,198 @@
+import os
+import json
+import uuid
+import threading
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from api_gateway import leases
+from api_gateway.metrics import STATUS_UPDATES
+
+logger = logging.getLogger(__name__)
+
+STATUS_RESULTS_ENABLED = os.getenv("STATUS_RESULTS_ENABLED", "false").lower() == "true"
+RESULTS_QUEUE_NAME = os.getenv("RESULTS_QUEUE_NAME", "generation_results")
+RESULTS_BATCH_SIZE = int(os.getenv("RESULTS_BATCH_SIZE", "200"))
+RESULTS_BATCH_WAIT_SECONDS = float(os.getenv("RESULTS_BATCH_WAIT_SECONDS", "0.2"))
+RECONNECT_DELAY_SECONDS = 5
+MAX_STATUS_BATCH_SIZE = 500
+
+WORKER_STATUSES = ("Processing", "Completed", "Failed")
+# (current, reported) pairs a worker may cause; everything else is rejected inside the UPDATE
+ALLOWED_TRANSITIONS = (
+    ("Pending", "Processing"),
+    ("Pending", "Completed"),
+    ("Pending", "Failed"),
+    ("Processing", "Processing"),
+    ("Processing", "Completed"),
+    ("Processing", "Failed"),
+)
+
+StatusUpdate = namedtuple("StatusUpdate", ["request_id", "status", "image_url", "model_version"])
+# result: updated, superseded, not_found, cancelled, expired, pipeline, illegal_transition;
+# the gateway may also report invalid or failed for pipeline jobs it applied one by one
+Outcome = namedtuple("Outcome", ["request_id", "result", "previous_status"])
+
+_TRANSITIONS_SQL = ", ".join(f"('{current}', '{reported}')" for current, reported in ALLOWED_TRANSITIONS)
+
+
+def _batch_statement(size):
+    # the outer SELECT reads the pre-update snapshot, so every item comes back with the status it had
+    values = ", ".join(f"(CAST(:request_id_{i} AS uuid), :status_{i}, :image_url_{i})" for i in range(size))
+    return text(f"""
+        WITH incoming (request_id, status, image_url) AS (VALUES {values}),
+        applied AS (
+            UPDATE generation_requests AS job
+            SET status = incoming.status,
+                image_url = COALESCE(incoming.image_url, job.image_url),
+                started_at = CASE WHEN incoming.status = 'Processing' THEN :now ELSE job.started_at END,
+                attempts = CASE WHEN incoming.status = 'Processing' AND job.status <> 'Processing'
+                    THEN COALESCE(job.attempts, 0) + 1 ELSE job.attempts END,
+                lease_expires_at = CASE WHEN incoming.status = 'Processing' THEN :lease_expires_at ELSE NULL END,
+                lease_token = CASE WHEN incoming.status = 'Processing' THEN job.lease_token ELSE NULL END,
+                updated_at = :now
+            FROM incoming
+            WHERE job.request_id = incoming.request_id
+              AND job.pipeline IS NULL
+              AND (job.status, incoming.status) IN ({_TRANSITIONS_SQL})
+              AND NOT (job.status = 'Pending' AND incoming.status = 'Processing' AND job.expires_at IS NOT NULL AND job.expires_at <= :now)
+            RETURNING job.request_id
+        )
+        SELECT incoming.request_id, job.status, job.pipeline IS NOT NULL AS has_pipeline,
+               job.expires_at, applied.request_id IS NOT NULL AS applied
+        FROM incoming
+        LEFT JOIN generation_requests AS job ON job.request_id = incoming.request_id
+        LEFT JOIN applied ON applied.request_id = incoming.request_id
+    """)
+
+
+def _classify(previous_status, status, has_pipeline, expires_at, now):
+    if previous_status is None:
+        return "not_found"
+    if previous_status == "Cancelled":
+        return "cancelled"
+    if previous_status == "Expired" or (previous_status == "Pending" and status == "Processing" and expires_at is not None and expires_at <= now):
+        # not started past its deadline; the reaper's sweep marks it Expired
+        return "expired"
+    if has_pipeline and previous_status not in ("Completed", "Failed"):
+        # stage hand-off needs the per-job path in update_db
+        return "pipeline"
+    return "illegal_transition"
+
+
+def apply_batch(db, updates, now=None):
+    # one set-based UPDATE for the whole batch; the caller commits and runs per-job side effects.
+    # Later reports for the same job win, earlier ones come back as superseded.
+    now = datetime.utcnow() if now is None else now
+    latest = {update.request_id: index for index, update in enumerate(updates)}
+    unique = [updates[index] for index in sorted(latest.values())]
+
+    found = {}
+    if unique:
+        params = {"now": now, "lease_expires_at": now + timedelta(seconds=leases.PROCESSING_LEASE_SECONDS)}
+        for i, update in enumerate(unique):
+            params[f"request_id_{i}"] = str(update.request_id)
+            params[f"status_{i}"] = update.status
+            params[f"image_url_{i}"] = update.image_url
+        for row in db.execute(_batch_statement(len(unique)), params):
+            found[uuid.UUID(str(row[0]))] = row
+
+    outcomes = []
+    for index, update in enumerate(updates):
+        if latest[update.request_id] != index:
+            outcomes.append(Outcome(update.request_id, "superseded", None))
+            continue
+        row = found.get(update.request_id)
+        if row is None:
+            outcomes.append(Outcome(update.request_id, "not_found", None))
+            continue
+        _, previous_status, has_pipeline, expires_at, applied = row
+        result = "updated" if applied else _classify(previous_status, update.status, has_pipeline, expires_at, now)
+        outcomes.append(Outcome(update.request_id, result, previous_status))
+    return outcomes
+
+
+def parse_result_message(body):
+    message = json.loads(body)
+    status = message["status"]
+    if status not in WORKER_STATUSES:
+        raise ValueError(f"unsupported status {status}")
+    return StatusUpdate(
+        uuid.UUID(message["request_id"]),
+        status,
+        message.get("image_url"),
+        message.get("model_version")
+    )
+
+
+class StatusResultConsumer:
+    # drains worker status events from the results queue and applies each batch in one statement
+    def __init__(self, rabbitmq_manager, apply):
+        self.rabbitmq_manager = rabbitmq_manager
+        self.apply = apply
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="status-result-consumer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=RESULTS_BATCH_WAIT_SECONDS + RECONNECT_DELAY_SECONDS)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                channel = self.rabbitmq_manager.get_channel()
+                if channel is None:
+                    self._stop_event.wait(RECONNECT_DELAY_SECONDS)
+                    continue
+                self._consume(channel)
+            except Exception:
+                logger.error("Status result consumer failed, reconnecting", exc_info=True)
+                self._stop_event.wait(RECONNECT_DELAY_SECONDS)
+
+    def _consume(self, channel):
+        channel.queue_declare(queue=RESULTS_QUEUE_NAME, durable=True)
+        channel.basic_qos(prefetch_count=RESULTS_BATCH_SIZE)
+
+        batch = []
+        for method, properties, body in channel.consume(RESULTS_QUEUE_NAME, inactivity_timeout=RESULTS_BATCH_WAIT_SECONDS):
+            if method is not None:
+                batch.append((method, body))
+            if batch and (method is None or len(batch) >= RESULTS_BATCH_SIZE):
+                self._apply(channel, batch)
+                batch = []
+            if self._stop_event.is_set():
+                break
+        channel.cancel()
+
+    def _apply(self, channel, batch):
+        updates = []
+        for method, body in batch:
+            try:
+                updates.append(parse_result_message(body))
+            except (ValueError, KeyError, TypeError):
+                logger.warning("Discarding malformed status result message")
+
+        try:
+            outcomes = self.apply(channel, updates) if updates else []
+        except Exception:
+            # requeued for redelivery, the transition check makes replays harmless; left unacked, the next
+            # multiple ack on this channel would cover these deliveries too
+            channel.basic_nack(delivery_tag=batch[-1][0].delivery_tag, multiple=True, requeue=True)
+            raise
+        channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+
+        for outcome in outcomes:
+            STATUS_UPDATES.labels(path="amqp", result=outcome.result).inc()
+        logger.info(f"Applied {sum(outcome.result == 'updated' for outcome in outcomes)} of {len(batch)} status results")
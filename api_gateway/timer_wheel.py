@@ -0,0 +1,73 @@
+import math
+
+
+class HierarchicalTimerWheel:
+    # timers bucketed by tick: level 0 slots are one tick wide, each level above is `slots` times coarser.
+    # Adding and expiring are O(1); entries cascade down a level when their coarse slot comes up.
+    def __init__(self, tick_seconds=1.0, slots=64, levels=3, now=0.0):
+        self.tick_seconds = tick_seconds
+        self.slots = slots
+        self.levels = levels
+        self.current_tick = math.floor(now / tick_seconds)
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._due = {}
+        self._expired = []
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def add(self, key, due_at):
+        if key in self._due:
+            self.remove(key)
+        self._due[key] = due_at
+        self._place(key, due_at)
+
+    def remove(self, key):
+        due_at = self._due.pop(key, None)
+        if due_at is None:
+            return
+        for wheel in self._wheels:
+            for slot in wheel:
+                if slot.pop(key, None) is not None:
+                    return
+
+    def _place(self, key, due_at):
+        due_tick = math.ceil(due_at / self.tick_seconds)
+        delta = due_tick - self.current_tick
+        if delta <= 0:
+            self._expired.append(key)
+            return
+
+        for level in range(self.levels):
+            span = self.slots ** level
+            if delta < span * self.slots or level == self.levels - 1:
+                # beyond the top level's range the entry waits in the furthest slot and is placed again on cascade
+                target_tick = min(due_tick, self.current_tick + span * (self.slots - 1))
+                self._wheels[level][(target_tick // span) % self.slots][key] = due_at
+                return
+
+    def advance(self, now):
+        # returns the keys whose time has come, in tick order
+        target = math.floor(now / self.tick_seconds)
+        while self.current_tick < target:
+            self.current_tick += 1
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots ** level
+                if self.current_tick % span == 0:
+                    slot = self._wheels[level][(self.current_tick // span) % self.slots]
+                    entries = list(slot.items())
+                    slot.clear()
+                    for key, due_at in entries:
+                        self._place(key, due_at)
+
+            slot = self._wheels[0][self.current_tick % self.slots]
+            self._expired.extend(slot)
+            slot.clear()
+
+        expired, self._expired = self._expired, []
+        for key in expired:
+            self._due.pop(key, None)
+        return expired
@@ -0,0 +1,93 @@
+import os
+import uuid
+from datetime import datetime
+from sqlalchemy import func
+
+from api_gateway.models import GenerationRequest, TERMINAL_STATUSES
+
+MAX_VARIANTS = int(os.getenv("MAX_VARIANTS", "8"))
+
+
+def variant_seeds(seed, num_variants):
+    return [seed + offset for offset in range(num_variants)]
+
+
+def create_children(parent, seeds):
+    # one row per seed so workers report each image separately; the parent row only aggregates them
+    return [
+        GenerationRequest(
+            request_id = uuid.uuid4(),
+            parent_request_id = parent.request_id,
+            prompt = parent.prompt,
+            negative_prompt = parent.negative_prompt,
+            num_inference_steps = parent.num_inference_steps,
+            guidance_scale = parent.guidance_scale,
+            seed = seed,
+            style = parent.style,
+            tenant_id = parent.tenant_id,
+            created_at = parent.created_at,
+            expires_at = parent.expires_at,
+            # children are leased one by one in pull mode, so each carries the delay itself
+            run_at = parent.run_at
+        )
+        for seed in seeds
+    ]
+
+
+def task_variants(children):
+    return [{"request_id": str(child.request_id), "seed": child.seed} for child in children]
+
+
+def aggregate_status(status_counts):
+    total = sum(status_counts.values())
+    if total == 0:
+        return None
+
+    terminal = sum(count for status, count in status_counts.items() if status in TERMINAL_STATUSES)
+    if terminal < total:
+        return "Pending" if status_counts.get("Pending", 0) == total else "Processing"
+
+    # a parent with at least one image is Completed, each variant reports its own outcome
+    for status in ("Completed", "Failed", "Expired", "Cancelled"):
+        if status_counts.get(status):
+            return status
+
+
+def children_of(db, parent_request_id):
+    return (
+        db.query(GenerationRequest)
+        .filter(GenerationRequest.parent_request_id == parent_request_id)
+        .order_by(GenerationRequest.seed)
+        .all()
+    )
+
+
+def refresh_parent(db, parent_request_id):
+    # the row lock serialises concurrent child updates so the last one sees every sibling's status
+    parent = (
+        db.query(GenerationRequest)
+        .filter(GenerationRequest.request_id == parent_request_id)
+        .with_for_update()
+        .first()
+    )
+    if not parent or parent.status in TERMINAL_STATUSES:
+        return None
+
+    status_counts = dict(
+        db.query(GenerationRequest.status, func.count(GenerationRequest.request_id))
+        .filter(GenerationRequest.parent_request_id == parent_request_id)
+        .group_by(GenerationRequest.status)
+        .all()
+    )
+    status = aggregate_status(status_counts)
+    if status:
+        parent.status = status
+    if status == "Completed":
+        parent.image_url = db.query(GenerationRequest.image_url).filter(
+            GenerationRequest.parent_request_id == parent_request_id,
+            GenerationRequest.status == "Completed"
+        ).order_by(GenerationRequest.seed).limit(1).scalar()
+    # bumped on every child change so the parent's ETag covers the variant list
+    parent.updated_at = datetime.utcnow()
+    db.commit()
+    return parent
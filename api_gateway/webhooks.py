@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import hmac
+import uuid
+import random
+import socket
+import asyncio
+import hashlib
+import ipaddress
+import threading
+import logging
+from urllib.parse import urlsplit
+
+import httpx
+import httpcore
+
+from api_gateway.metrics import WEBHOOK_DELIVERIES
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "6"))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.getenv("WEBHOOK_RETRY_BASE_SECONDS", "1.0"))
+WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "10"))
+WEBHOOK_MAX_CONCURRENCY_PER_HOST = int(os.getenv("WEBHOOK_MAX_CONCURRENCY_PER_HOST", "4"))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+# comma separated hosts callbacks may go to; when empty any host is allowed as long as it resolves to public addresses
+WEBHOOK_ALLOWED_HOSTS = frozenset(host.strip().lower() for host in os.getenv("WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip())
+
+# statuses worth retrying besides network errors and 5xx
+RETRYABLE_STATUS_CODES = {408, 425, 429}
+
+
+def sign_payload(secret, timestamp, body):
+    message = f"{timestamp}.".encode("utf-8") + body
+    return "sha256=" + hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+class UnsafeDestination(Exception):
+    pass
+
+
+def _is_public(address):
+    address = ipaddress.ip_address(address)
+    return address.is_global and not address.is_multicast
+
+
+def check_callback_url(url, allowed_hosts=WEBHOOK_ALLOWED_HOSTS):
+    # cheap check at submission, without a DNS lookup; delivery checks every resolved address again
+    host = (urlsplit(url).hostname or "").lower()
+    if allowed_hosts:
+        return None if host in allowed_hosts else f"callback host {host} is not allowed"
+    if host == "localhost" or host.endswith(".localhost"):
+        return "callback_url must not point at the gateway's own host"
+    try:
+        public = _is_public(host)
+    except ValueError:
+        return None
+    return None if public else "callback_url must not point at a private, loopback or link-local address"
+
+
+async def resolve_destination(host, port, allowed_hosts=WEBHOOK_ALLOWED_HOSTS):
+    # a public name may resolve to an internal address, or be changed to one after the job was submitted;
+    # returns the vetted address to connect to
+    host = host.lower()
+    if allowed_hosts and host not in allowed_hosts:
+        raise UnsafeDestination(f"callback host {host} is not allowed")
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    if not allowed_hosts:
+        blocked = sorted({info[4][0] for info in infos if not _is_public(info[4][0])})
+        if blocked:
+            raise UnsafeDestination(f"callback host {host} resolves to non-public addresses {blocked}")
+    return infos[0][4][0]
+
+
+class VettedNetworkBackend(httpcore.AsyncNetworkBackend):
+    # connects to the address the destination check resolved instead of letting the connection resolve the
+    # name again, which a rebinding DNS server could answer with an internal address. Host header, SNI and
+    # certificate checks still use the original name.
+    def __init__(self, allowed_hosts):
+        self.allowed_hosts = allowed_hosts
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        address = await resolve_destination(host, port, self.allowed_hosts)
+        return await self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+class VettedTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, allowed_hosts, limits):
+        super().__init__(limits=limits)
+        # the pool httpx builds by default, with the vetting backend; httpx has no public hook for it
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=VettedNetworkBackend(allowed_hosts)
+        )
+
+
+class HostSlots:
+    # one concurrency limit per callback host, kept only while deliveries to that host are pending
+    def __init__(self, limit=WEBHOOK_MAX_CONCURRENCY_PER_HOST):
+        self.limit = limit
+        self._slots = {}
+
+    def __len__(self):
+        return len(self._slots)
+
+    def acquire(self, host):
+        entry = self._slots.setdefault(host, [asyncio.Semaphore(self.limit), 0])
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, host):
+        entry = self._slots[host]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._slots[host]
+
+
+class WebhookDispatcher:
+    # delivers completion callbacks from its own event loop so update_db only pays for a queue put
+    def __init__(self, secret=WEBHOOK_SECRET, max_attempts=WEBHOOK_MAX_ATTEMPTS, retry_base_seconds=WEBHOOK_RETRY_BASE_SECONDS,
+                 allowed_hosts=WEBHOOK_ALLOWED_HOSTS):
+        self.secret = secret
+        self.allowed_hosts = allowed_hosts
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self._loop = None
+        self._queue = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._stopping = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        if not self.secret:
+            logger.error("WEBHOOK_SECRET is not set, completion callbacks are sent without a signature")
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run, name="webhook-dispatcher", daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout=5)
+
+    def stop(self):
+        if self._loop and self._stopping:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+        if self._thread:
+            self._thread.join(timeout=WEBHOOK_TIMEOUT_SECONDS + 5)
+            self._thread = None
+
+    def enqueue(self, callback_url, payload):
+        if not self._ready.is_set():
+            logger.warning("Webhook dispatcher is not running, dropping callback", extra={"request_id": payload.get("request_id")})
+            WEBHOOK_DELIVERIES.labels(result="dropped").inc()
+            return False
+        event = {"id": str(uuid.uuid4()), "url": callback_url, "payload": payload}
+        self._loop.call_soon_threadsafe(self._put, event)
+        return True
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.error("Webhook queue is full, dropping callback", extra={"request_id": event["payload"].get("request_id")})
+            WEBHOOK_DELIVERIES.labels(result="dropped").inc()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._main())
+        finally:
+            self._loop.close()
+
+    async def _main(self):
+        self._queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self._stopping = asyncio.Event()
+        host_slots = HostSlots()
+        total_slots = asyncio.Semaphore(WEBHOOK_MAX_CONCURRENCY)
+        limits = httpx.Limits(max_connections=WEBHOOK_MAX_CONCURRENCY, max_keepalive_connections=WEBHOOK_MAX_CONCURRENCY)
+        in_flight = set()
+
+        transport = VettedTransport(self.allowed_hosts, limits)
+        # a redirect could lead anywhere past the destination check, so none is followed
+        async with httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT_SECONDS, transport=transport, follow_redirects=False) as client:
+            self._ready.set()
+            while not self._stopping.is_set():
+                get_event = asyncio.ensure_future(self._queue.get())
+                stopping = asyncio.ensure_future(self._stopping.wait())
+                done, _ = await asyncio.wait({get_event, stopping}, return_when=asyncio.FIRST_COMPLETED)
+                if get_event not in done:
+                    get_event.cancel()
+                    break
+                stopping.cancel()
+
+                event = get_event.result()
+                host = urlsplit(event["url"]).netloc
+                task = asyncio.ensure_future(self._deliver(client, event, host_slots.acquire(host), total_slots))
+                task.add_done_callback(lambda _, host=host: host_slots.release(host))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+
+            self._ready.clear()
+            for task in in_flight:
+                task.cancel()
+
+    async def _deliver(self, client, event, host_slot, total_slot):
+        body = json.dumps(event["payload"], separators=(",", ":")).encode("utf-8")
+        request_id = event["payload"].get("request_id")
+
+        for attempt in range(1, self.max_attempts + 1):
+            timestamp = str(int(time.time()))
+            headers = {
+                "Content-Type": "application/json",
+                "X-Webhook-Id": event["id"],
+                "X-Webhook-Timestamp": timestamp,
+            }
+            if self.secret:
+                headers["X-Webhook-Signature"] = sign_payload(self.secret, timestamp, body)
+
+            retryable = True
+            try:
+                async with host_slot, total_slot:
+                    response = await client.post(event["url"], content=body, headers=headers)
+                if response.is_success:
+                    WEBHOOK_DELIVERIES.labels(result="delivered").inc()
+                    logger.info("Delivered completion callback", extra={"request_id": request_id, "attempt": attempt})
+                    return
+                retryable = response.status_code >= 500 or response.status_code in RETRYABLE_STATUS_CODES
+                logger.warning(
+                    f"Callback returned HTTP {response.status_code}",
+                    extra={"request_id": request_id, "attempt": attempt}
+                )
+            except UnsafeDestination as e:
+                WEBHOOK_DELIVERIES.labels(result="blocked").inc()
+                logger.error(f"Refusing completion callback: {e}", extra={"request_id": request_id})
+                return
+            except (httpx.HTTPError, OSError) as e:
+                # OSError: the host did not resolve
+                logger.warning(f"Callback delivery failed: {e}", extra={"request_id": request_id, "attempt": attempt})
+
+            if not retryable or attempt == self.max_attempts:
+                break
+            # full jitter keeps retries to a recovering host from arriving in lockstep
+            await asyncio.sleep(random.uniform(0, self.retry_base_seconds * 2 ** (attempt - 1)))
+
+        WEBHOOK_DELIVERIES.labels(result="failed").inc()
+        logger.error("Giving up on completion callback", extra={"request_id": request_id})
@@ -0,0 +1,162 @@
+# Compares task throughput of the RabbitMQ and Postgres queue backends against live services, e.g.
+#   DATABASE_URL=postgresql://... RABBITMQ_HOST=localhost python -m benchmarks.queue_backends --messages 5000 --consumers 4
+# Producers publish the way the gateway does (one confirmed publish or one transaction per task), consumers
+# take up to --batch messages at a time and ack each batch. Both backends use a scratch queue that is emptied first.
+import os
+import json
+import time
+import argparse
+import threading
+
+import pika
+
+from api_gateway.database import SessionLocal
+from api_gateway.models import QueuedTask
+from api_gateway.notifications import PgNotificationListener
+from api_gateway.queue_backends import RabbitMQBackend, PostgresQueueBackend, TASK_QUEUE_CHANNEL
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "localhost")
+RABBITMQ_USER = os.getenv("RABBITMQ_DEFAULT_USER", "user")
+RABBITMQ_PASS = os.getenv("RABBITMQ_DEFAULT_PASS", "password")
+BENCHMARK_QUEUE = "queue_backend_benchmark"
+
+
+def task_message(index):
+    return {
+        "request_id": f"benchmark-{index}",
+        "params": {"prompt": "a samoyed dog smiling", "num_inference_steps": 50, "guidance_scale": 7.5, "seed": index}
+    }
+
+
+def rabbitmq_channel():
+    connection = pika.BlockingConnection(pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        credentials=pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+    ))
+    channel = connection.channel()
+    channel.queue_declare(queue=BENCHMARK_QUEUE, durable=True)
+    return connection, channel
+
+
+def run_producers(publish_many, messages, producers):
+    per_producer = [range(i, messages, producers) for i in range(producers)]
+    threads = [threading.Thread(target=publish_many, args=(indexes,)) for indexes in per_producer]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - started
+
+
+def run_consumers(consume, messages, consumers):
+    consumed = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def count(n):
+        with lock:
+            consumed.append(n)
+            if sum(consumed) >= messages:
+                done.set()
+
+    threads = [threading.Thread(target=consume, args=(count, done), daemon=True) for _ in range(consumers)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    done.wait()
+    elapsed = time.monotonic() - started
+    for thread in threads:
+        thread.join(timeout=5)
+    return elapsed
+
+
+def benchmark_rabbitmq(messages, producers, consumers, batch):
+    connection, channel = rabbitmq_channel()
+    channel.queue_purge(BENCHMARK_QUEUE)
+    connection.close()
+
+    def publish_many(indexes):
+        connection, channel = rabbitmq_channel()
+        # the gateway publishes with confirms, so every publish waits for the broker
+        channel.confirm_delivery()
+        backend = RabbitMQBackend(channel)
+        for index in indexes:
+            backend.publish(BENCHMARK_QUEUE, task_message(index))
+        connection.close()
+
+    def consume(count, done):
+        connection, channel = rabbitmq_channel()
+        channel.basic_qos(prefetch_count=batch)
+        pending = []
+        for method, properties, body in channel.consume(BENCHMARK_QUEUE, inactivity_timeout=0.05):
+            if method is not None:
+                json.loads(body)
+                pending.append(method)
+            if pending and (method is None or len(pending) >= batch):
+                channel.basic_ack(delivery_tag=pending[-1].delivery_tag, multiple=True)
+                count(len(pending))
+                pending = []
+            if done.is_set():
+                break
+        channel.cancel()
+        connection.close()
+
+    publish_seconds = run_producers(publish_many, messages, producers)
+    consume_seconds = run_consumers(consume, messages, consumers)
+    return publish_seconds, consume_seconds
+
+
+def benchmark_postgres(messages, producers, consumers, batch):
+    backend = PostgresQueueBackend(SessionLocal)
+    db = SessionLocal()
+    try:
+        db.query(QueuedTask).filter(QueuedTask.queue_name == BENCHMARK_QUEUE).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+    listener = PgNotificationListener()
+    listener.subscribe(TASK_QUEUE_CHANNEL, backend.on_notification)
+    listener.start()
+
+    def publish_many(indexes):
+        for index in indexes:
+            backend.publish(BENCHMARK_QUEUE, task_message(index))
+
+    def consume(count, done):
+        while not done.is_set():
+            claimed = backend.claim_or_wait(BENCHMARK_QUEUE, batch, wait_seconds=0.5)
+            if claimed:
+                backend.ack(BENCHMARK_QUEUE, [task.id for task in claimed])
+                count(len(claimed))
+
+    try:
+        publish_seconds = run_producers(publish_many, messages, producers)
+        consume_seconds = run_consumers(consume, messages, consumers)
+    finally:
+        listener.stop()
+    return publish_seconds, consume_seconds
+
+
+BENCHMARKS = {"rabbitmq": benchmark_rabbitmq, "postgres": benchmark_postgres}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queue backend throughput benchmark")
+    parser.add_argument("--backend", choices=[*BENCHMARKS, "both"], default="both")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--producers", type=int, default=4)
+    parser.add_argument("--consumers", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=16)
+    args = parser.parse_args()
+
+    backends = list(BENCHMARKS) if args.backend == "both" else [args.backend]
+    print(f"{'backend':<10}{'publish msg/s':>16}{'consume msg/s':>16}")
+    for name in backends:
+        publish_seconds, consume_seconds = BENCHMARKS[name](args.messages, args.producers, args.consumers, args.batch)
+        print(f"{name:<10}{args.messages / publish_seconds:>16.1f}{args.messages / consume_seconds:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -30,4 +30,121 @@ BEFORE UPDATE ON generation_requests
 FOR EACH ROW
 EXECUTE PROCEDURE update_updated_at_column();
 
-COMMENT ON TABLE generation_requests IS 'Stores image generation requests and their statuses.';
\ No newline at end of file
+COMMENT ON TABLE generation_requests IS 'Stores image generation requests and their statuses.';
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key VARCHAR(255) PRIMARY KEY,
+    request_id UUID NOT NULL REFERENCES generation_requests (request_id) ON DELETE CASCADE,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys (expires_at);
+
+COMMENT ON TABLE idempotency_keys IS 'Maps client Idempotency-Key headers to the request they created.';
+
+CREATE TABLE IF NOT EXISTS result_cache (
+    cache_key VARCHAR(64) PRIMARY KEY,
+    model_version VARCHAR(64) NOT NULL,
+    image_url TEXT NOT NULL,
+    source_request_id UUID,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+);
+
+CREATE INDEX IF NOT EXISTS idx_result_cache_model_version ON result_cache (model_version);
+
+COMMENT ON TABLE result_cache IS 'Images keyed by a hash of prompt, params, seed and model version.';
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS started_at TIMESTAMP WITHOUT TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS idx_generation_requests_status_created_at ON generation_requests (status, created_at);
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS callback_url TEXT;
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS lease_token VARCHAR(64);
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITHOUT TIME ZONE;
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_generation_requests_status_lease_expires_at ON generation_requests (status, lease_expires_at);
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP WITHOUT TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS idx_generation_requests_status_expires_at ON generation_requests (status, expires_at);
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS parent_request_id UUID REFERENCES generation_requests (request_id) ON DELETE CASCADE;
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS num_variants INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_generation_requests_parent_request_id ON generation_requests (parent_request_id);
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS style VARCHAR(64);
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS tenant_id VARCHAR(64);
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS awaiting_dispatch BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_generation_requests_awaiting_dispatch ON generation_requests (tenant_id, created_at) WHERE awaiting_dispatch AND status = 'Pending';
+
+CREATE TABLE IF NOT EXISTS api_keys (
+    key_hash VARCHAR(64) PRIMARY KEY,
+    tenant_id VARCHAR(64) NOT NULL,
+    plan VARCHAR(32) NOT NULL DEFAULT 'free',
+    steps_per_minute INTEGER NOT NULL,
+    burst_steps INTEGER NOT NULL,
+    daily_step_quota BIGINT,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+);
+
+CREATE INDEX IF NOT EXISTS idx_api_keys_tenant_id ON api_keys (tenant_id);
+
+CREATE TABLE IF NOT EXISTS api_key_usage (
+    key_hash VARCHAR(64) NOT NULL REFERENCES api_keys (key_hash) ON DELETE CASCADE,
+    window_start TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    inference_steps BIGINT NOT NULL DEFAULT 0,
+    jobs INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (key_hash, window_start)
+);
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS run_at TIMESTAMP WITHOUT TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS idx_generation_requests_scheduled_run_at ON generation_requests (run_at) WHERE awaiting_dispatch AND status = 'Pending';
+
+CREATE INDEX IF NOT EXISTS idx_generation_requests_created_at ON generation_requests (created_at);
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS pipeline VARCHAR(255);
+
+CREATE TABLE IF NOT EXISTS job_stages (
+    request_id UUID NOT NULL REFERENCES generation_requests (request_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name VARCHAR(64) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'Pending',
+    input_image_url TEXT,
+    output_image_url TEXT,
+    queued_at TIMESTAMP WITHOUT TIME ZONE,
+    started_at TIMESTAMP WITHOUT TIME ZONE,
+    finished_at TIMESTAMP WITHOUT TIME ZONE,
+    PRIMARY KEY (request_id, position)
+);
+
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS progress_step INTEGER;
+ALTER TABLE generation_requests ADD COLUMN IF NOT EXISTS progress_updated_at TIMESTAMP WITHOUT TIME ZONE;
+
+-- progress flushes must leave updated_at, and with it the /status ETag, as it is
+DROP TRIGGER IF EXISTS update_generation_requests_updated_at ON generation_requests;
+CREATE TRIGGER update_generation_requests_updated_at
+BEFORE UPDATE ON generation_requests
+FOR EACH ROW
+WHEN ((to_jsonb(NEW) - 'progress_step' - 'progress_updated_at' - 'updated_at') IS DISTINCT FROM (to_jsonb(OLD) - 'progress_step' - 'progress_updated_at' - 'updated_at'))
+EXECUTE PROCEDURE update_updated_at_column();
+
+CREATE TABLE IF NOT EXISTS task_queue (
+    id BIGSERIAL PRIMARY KEY,
+    queue_name VARCHAR(255) NOT NULL,
+    routing_key VARCHAR(255),
+    body TEXT NOT NULL,
+    enqueued_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    visible_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    expires_at TIMESTAMP WITHOUT TIME ZONE,
+    deliveries INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_task_queue_queue_name_visible_at ON task_queue (queue_name, visible_at);
@@ -7,7 +7,8 @@ import sys
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from api_gateway.api_gateway import app, get_db, get_mq_channel
+from api_gateway.api_gateway import app, get_db, get_mq_channel, get_optional_mq_channel, get_queue_backend, get_optional_queue_backend
+from api_gateway.queue_backends import RabbitMQBackend
 from api_gateway.models import GenerationRequest
 
 @pytest.fixture()
@@ -23,7 +24,10 @@ def sample_request():
 
 @pytest.fixture()
 def mock_db_session():
-    return MagicMock(spec=Session)
+    session = MagicMock(spec=Session)
+    # primary key lookups (idempotency keys, result cache) find nothing by default
+    session.get.return_value = None
+    return session
 
 
 @pytest.fixture
@@ -35,6 +39,9 @@ def mock_mq_channel():
 def client(mock_db_session, mock_mq_channel):
     app.dependency_overrides[get_db] = lambda: mock_db_session
     app.dependency_overrides[get_mq_channel] = lambda: mock_mq_channel
+    app.dependency_overrides[get_optional_mq_channel] = lambda: mock_mq_channel
+    app.dependency_overrides[get_queue_backend] = lambda: RabbitMQBackend(mock_mq_channel)
+    app.dependency_overrides[get_optional_queue_backend] = lambda: RabbitMQBackend(mock_mq_channel)
     
     test_client = TestClient(app)
     
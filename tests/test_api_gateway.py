@@ -1,15 +1,35 @@
 import pytest
 from unittest.mock import MagicMock, patch
 import uuid
+import hmac
+import hashlib
 import json
+import math
+import re
+import time
+from collections import deque
+import asyncio
+import httpx
+import httpcore
+import socket
 import os
+from datetime import datetime, timedelta
 import sys
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import api_gateway
-from api_gateway.api_gateway import app, get_db
-from api_gateway.models import GenerationRequest
+import api_gateway.api_gateway
+from api_gateway import result_cache, http_cache, leases, reaper, expiry, variants, routing, fair_scheduler, rate_limit, scheduled_jobs, pipelines, progress, queue_backends, idempotency
+from api_gateway.api_gateway import app, get_db, InferenceRequest
+from api_gateway.models import GenerationRequest, IdempotencyKey, ResultCacheEntry, ApiKey, JobStage
+from api_gateway.estimator import ThroughputEstimator
+from api_gateway.bloom import BloomFilter, KnownRequestIds
+from api_gateway.webhooks import sign_payload, check_callback_url, resolve_destination, UnsafeDestination, VettedTransport, HostSlots
+from api_gateway.cancellation import CancellationSet
 
 
 MOCK_REQUEST_ID = uuid.uuid4()
@@ -126,4 +146,1194 @@ def test_update_db_not_found(client, mock_db_session):
     
     assert response.status_code == 404
     assert response.json()["detail"] == "request_id not found"
-    mock_db_session.commit.assert_not_called()
\ No newline at end of file
+    mock_db_session.commit.assert_not_called()
+
+#-----------TEST FOR Idempotency-Key on /generate -------------#
+# TC7: Replay a submission with a known idempotency key
+def test_generate_task_idempotent_replay(client, mock_db_session, mock_mq_channel, sample_request):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+
+    mock_db_session.get.return_value = IdempotencyKey(
+        key = "retry-key-1",
+        request_id = MOCK_REQUEST_ID,
+        expires_at = datetime.utcnow() + timedelta(hours=1)
+    )
+
+    response = client.post("/generate", json=sample_request, headers={"Idempotency-Key": "retry-key-1"})
+
+    assert response.status_code == 202
+    assert response.json() == {"request_id": str(MOCK_REQUEST_ID)}
+    mock_db_session.add.assert_not_called()
+    mock_mq_channel.basic_publish.assert_not_called()
+
+
+# TC8: First submission with an idempotency key stores the key with the request
+def test_generate_task_idempotent_first_submission(client, mock_db_session, mock_mq_channel, sample_request):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+
+    mock_db_session.get.return_value = None
+
+    def set_request_id(db_request_obj):
+        db_request_obj.request_id = MOCK_REQUEST_ID
+
+    mock_db_session.refresh.side_effect = set_request_id
+
+    response = client.post("/generate", json=sample_request, headers={"Idempotency-Key": "retry-key-2"})
+
+    assert response.status_code == 202
+    added_objects = [call[0][0] for call in mock_db_session.add.call_args_list]
+    assert [type(obj) for obj in added_objects] == [GenerationRequest, IdempotencyKey]
+    assert added_objects[1].key == idempotency.scoped_key(fair_scheduler.DEFAULT_TENANT, "retry-key-2")
+    mock_mq_channel.basic_publish.assert_called_once()
+
+
+# TC9: Reject an oversized idempotency key
+def test_generate_task_invalid_idempotency_key(client, sample_request):
+    response = client.post("/generate", json=sample_request, headers={"Idempotency-Key": "k" * 256})
+
+    assert response.status_code == 400
+
+
+#-----------TEST FOR result cache -------------#
+# TC10: Identical request is served from the result cache without queuing
+def test_generate_task_result_cache_hit(client, mock_db_session, mock_mq_channel, sample_request):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+
+    mock_db_session.get.return_value = ResultCacheEntry(
+        cache_key = result_cache.request_cache_key(InferenceRequest(**sample_request)),
+        model_version = result_cache.MODEL_VERSION,
+        image_url = "http://example.com/cached_image.png"
+    )
+
+    def set_request_id(db_request_obj):
+        db_request_obj.request_id = MOCK_REQUEST_ID
+
+    mock_db_session.refresh.side_effect = set_request_id
+
+    response = client.post("/generate", json=sample_request)
+
+    assert response.status_code == 202
+    assert response.json() == {"request_id": str(MOCK_REQUEST_ID)}
+
+    added_object = mock_db_session.add.call_args[0][0]
+    assert added_object.status == "Completed"
+    assert added_object.image_url == "http://example.com/cached_image.png"
+    mock_mq_channel.basic_publish.assert_not_called()
+
+
+# TC11: Cache key is stable for guidance_scale values read back from a REAL column
+def test_result_cache_key_canonical():
+    stored_guidance = 7.300000190734863
+
+    assert result_cache.cache_key("p", None, 50, 7.3, 50) == result_cache.cache_key("p", "", 50, stored_guidance, 50)
+    assert result_cache.cache_key("p", "", 50, 7.3, 50) != result_cache.cache_key("p", "", 50, 7.3, 51)
+    assert result_cache.cache_key("p", "", 50, 7.3, 50, "v1") != result_cache.cache_key("p", "", 50, 7.3, 50, "v2")
+
+
+# TC12: Completing a request stores its image in the result cache
+def test_update_db_completed_fills_result_cache(client, mock_db_session):
+    mock_db_session.reset_mock()
+
+    existing_record = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        prompt = "a samoyed dog",
+        negative_prompt = "",
+        num_inference_steps = 50,
+        guidance_scale = 7.5,
+        seed = 50,
+        status = "Processing"
+    )
+    mock_db_session.query.return_value.filter.return_value.first.return_value = existing_record
+
+    response = client.put(f"/update_db/{MOCK_REQUEST_ID}", json={
+        "status": "Completed",
+        "image_url": "http://example.com/updated_image.png"
+    })
+
+    assert response.status_code == 200
+    mock_db_session.execute.assert_called_once()
+
+
+#-----------TEST FOR conditional GET on /status -------------#
+# TC13: Status responses carry an ETag and long-lived Cache-Control once terminal
+def test_get_status_sets_cache_headers(client, mock_db_session):
+    mock_db_session.reset_mock()
+
+    updated_at = datetime(2025, 1, 1, 12, 0, 0)
+    mock_db_session.query.return_value.filter.return_value.first.return_value = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        status = "Completed",
+        image_url = "http://example.com/generated_image.png",
+        updated_at = updated_at
+    )
+
+    response = client.get(f"/status/{MOCK_REQUEST_ID}")
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == http_cache.status_etag("Completed", updated_at)
+    assert "immutable" in response.headers["Cache-Control"]
+
+
+# TC14: Matching If-None-Match returns 304 after reading only the version columns
+def test_get_status_not_modified(client, mock_db_session):
+    mock_db_session.reset_mock()
+
+    updated_at = datetime(2025, 1, 1, 12, 0, 0)
+    mock_db_session.query.return_value.filter.return_value.first.return_value = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        status = "Pending",
+        updated_at = updated_at
+    )
+    etag = http_cache.status_etag("Pending", updated_at)
+
+    response = client.get(f"/status/{MOCK_REQUEST_ID}", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.headers["Cache-Control"] == f"public, max-age={http_cache.STATUS_PENDING_MAX_AGE_SECONDS}"
+    assert mock_db_session.query.call_count == 1
+    # progress is part of the version, it moves without updated_at changing
+    assert mock_db_session.query.call_args[0] == (
+        GenerationRequest.status,
+        GenerationRequest.updated_at,
+        GenerationRequest.progress_step,
+        GenerationRequest.num_inference_steps
+    )
+
+
+#-----------TEST FOR poll interval hints -------------#
+# TC15: Pending request gets Retry-After and next_poll_ms scaled by queue position
+def test_get_status_pending_poll_hint(client, mock_db_session):
+    mock_db_session.reset_mock()
+
+    mock_db_session.query.return_value.filter.return_value.first.return_value = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        status = "Pending",
+        num_inference_steps = 50,
+        created_at = datetime(2025, 1, 1, 12, 0, 0),
+        updated_at = datetime(2025, 1, 1, 12, 0, 0)
+    )
+    mock_db_session.query.return_value.filter.return_value.scalar.return_value = 0
+    short_queue = client.get(f"/status/{MOCK_REQUEST_ID}")
+
+    mock_db_session.query.return_value.filter.return_value.scalar.return_value = 40
+    long_queue = client.get(f"/status/{MOCK_REQUEST_ID}")
+
+    assert short_queue.status_code == 200
+    assert short_queue.json()["next_poll_ms"] <= long_queue.json()["next_poll_ms"]
+    assert int(long_queue.headers["Retry-After"]) == math.ceil(long_queue.json()["next_poll_ms"] / 1000)
+
+
+# TC16: Estimator learns seconds per step from completions
+def test_throughput_estimator_learns_step_time():
+    estimator = ThroughputEstimator(seconds_per_step=0.1, alpha=1.0, window_seconds=60)
+
+    estimator.observe_completion(50, 25.0, now=0.0)
+
+    assert estimator.seconds_per_step == 0.5
+    assert estimator.seconds_remaining("Processing", 50, processing_seconds=5.0) == 20.0
+    assert estimator.next_poll_ms("Processing", 50, processing_seconds=5.0) == 10000
+
+
+#-----------TEST FOR request_id bloom filter -------------#
+# TC17: Unknown request_id is rejected without querying the database
+def test_get_status_bloom_filter_definite_miss(client, mock_db_session, monkeypatch):
+    mock_db_session.reset_mock()
+
+    known_request_ids = KnownRequestIds()
+    known_request_ids._filter = BloomFilter(capacity=1000)
+    known_request_ids.add(MOCK_REQUEST_ID)
+    monkeypatch.setattr(api_gateway.api_gateway, "known_request_ids", known_request_ids)
+
+    response = client.get(f"/status/{uuid.uuid4()}")
+    update_response = client.put(f"/update_db/{uuid.uuid4()}", json={"status": "Completed"})
+
+    assert response.status_code == 404
+    assert update_response.status_code == 404
+    mock_db_session.query.assert_not_called()
+
+
+#-----------TEST FOR completion callbacks -------------#
+# TC18: callback_url is stored with the request but not forwarded to workers
+def test_generate_task_stores_callback_url(client, mock_db_session, mock_mq_channel, sample_request):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+
+    response = client.post("/generate", json={**sample_request, "callback_url": "https://partner.example.com/hooks/done"})
+
+    assert response.status_code == 202
+    added_object = mock_db_session.add.call_args[0][0]
+    assert added_object.callback_url == "https://partner.example.com/hooks/done"
+
+    task_message = json.loads(mock_mq_channel.basic_publish.call_args.kwargs["body"])
+    assert "callback_url" not in task_message["params"]
+
+
+# TC19: Reaching a terminal state enqueues the callback without blocking update_db
+def test_update_db_enqueues_completion_callback(client, mock_db_session, monkeypatch):
+    mock_db_session.reset_mock()
+
+    dispatcher = MagicMock()
+    monkeypatch.setattr(api_gateway.api_gateway, "webhook_dispatcher", dispatcher)
+
+    mock_db_session.query.return_value.filter.return_value.first.return_value = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        status = "Processing",
+        callback_url = "https://partner.example.com/hooks/done"
+    )
+
+    client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Processing"})
+    dispatcher.enqueue.assert_not_called()
+
+    response = client.put(f"/update_db/{MOCK_REQUEST_ID}", json={
+        "status": "Completed",
+        "image_url": "http://example.com/updated_image.png"
+    })
+
+    assert response.status_code == 200
+    dispatcher.enqueue.assert_called_once_with("https://partner.example.com/hooks/done", {
+        "request_id": str(MOCK_REQUEST_ID),
+        "status": "Completed",
+        "image_url": "http://example.com/updated_image.png"
+    })
+
+
+# TC20: Callback signatures are HMAC-SHA256 over timestamp and body
+def test_webhook_signature():
+    body = b'{"request_id":"abc","status":"Completed"}'
+    expected = hmac.new(b"secret", b"1700000000." + body, hashlib.sha256).hexdigest()
+
+    assert sign_payload("secret", "1700000000", body) == "sha256=" + expected
+
+
+#-----------TEST FOR queue position and ETA -------------#
+# TC21: Pending status reports queue position and an ETA based on broker worker count
+def test_get_status_reports_queue_position_and_eta(client, mock_db_session, monkeypatch):
+    mock_db_session.reset_mock()
+
+    estimator = ThroughputEstimator(seconds_per_step=0.2)
+    estimator.observe_lane("default", queue_depth=10, workers=2)
+    monkeypatch.setattr(api_gateway.api_gateway, "throughput_estimator", estimator)
+
+    mock_db_session.query.return_value.filter.return_value.first.return_value = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        status = "Pending",
+        num_inference_steps = 50,
+        created_at = datetime(2025, 1, 1, 12, 0, 0),
+        updated_at = datetime(2025, 1, 1, 12, 0, 0)
+    )
+    mock_db_session.query.return_value.filter.return_value.scalar.return_value = 4
+
+    response = client.get(f"/status/{MOCK_REQUEST_ID}")
+
+    # 2 workers at 10s per 50-step job clear 0.2 jobs/s: 4 ahead wait 20s, plus 10s of own inference
+    assert response.json()["queue_position"] == 4
+    assert response.json()["eta_seconds"] == 30.0
+
+
+# TC22: /capacity summarizes lanes and throughput
+def test_get_capacity(client, monkeypatch):
+    estimator = ThroughputEstimator(seconds_per_step=0.2)
+    estimator.observe_lane("default", queue_depth=10, workers=2)
+    monkeypatch.setattr(api_gateway.api_gateway, "throughput_estimator", estimator)
+
+    response = client.get("/capacity")
+
+    assert response.status_code == 200
+    assert response.json()["lanes"] == {"default": {"queue_depth": 10, "workers": 2}}
+    assert response.json()["active_workers"] == 2
+    assert response.json()["estimated_drain_seconds"] == 50.0
+
+
+#-----------TEST FOR HTTP work leasing -------------#
+# TC23: Leasing is refused while jobs are dispatched through RabbitMQ
+def test_lease_work_disabled_in_amqp_mode(client):
+    response = client.post("/work/lease?max=4")
+
+    assert response.status_code == 409
+
+
+# TC24: Lease a batch, heartbeat it and complete it
+def test_lease_heartbeat_complete(client, mock_db_session, monkeypatch):
+    mock_db_session.reset_mock()
+    monkeypatch.setattr(leases, "WORK_DISPATCH_MODE", "pull")
+
+    job = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        prompt = "a samoyed dog",
+        negative_prompt = "",
+        num_inference_steps = 50,
+        guidance_scale = 7.5,
+        seed = 50,
+        status = "Pending",
+        attempts = 0
+    )
+    lease_query = mock_db_session.query.return_value.filter.return_value.order_by.return_value.limit.return_value
+    lease_query.with_for_update.return_value.all.return_value = [job]
+
+    response = client.post("/work/lease?max=4")
+
+    assert response.status_code == 200
+    leased = response.json()["jobs"]
+    assert [item["request_id"] for item in leased] == [str(MOCK_REQUEST_ID)]
+    assert leased[0]["params"]["num_inference_steps"] == 50
+    mock_db_session.query.return_value.filter.return_value.order_by.return_value.limit.assert_called_once_with(4)
+    lease_query.with_for_update.assert_called_once_with(skip_locked=True)
+    assert job.status == "Processing"
+    assert job.attempts == 1
+
+    mock_db_session.query.return_value.filter.return_value.update.return_value = 1
+    heartbeat = client.post(f"/work/{MOCK_REQUEST_ID}/heartbeat", json={"lease_token": leased[0]["lease_token"]})
+    assert heartbeat.status_code == 200
+
+    mock_db_session.query.return_value.filter.return_value.first.return_value = job
+    stale = client.post(f"/work/{MOCK_REQUEST_ID}/complete", json={"lease_token": "not-the-token"})
+    assert stale.status_code == 409
+
+    completed = client.post(f"/work/{MOCK_REQUEST_ID}/complete", json={
+        "lease_token": leased[0]["lease_token"],
+        "image_url": "http://example.com/leased.png"
+    })
+    assert completed.status_code == 200
+    assert job.status == "Completed"
+    assert job.lease_token is None
+
+
+#-----------TEST FOR stuck-job reaper -------------#
+# TC25: Expired processing leases are requeued until the retry budget runs out
+def test_reaper_requeues_then_fails(mock_db_session):
+    mock_db_session.reset_mock()
+
+    retryable = GenerationRequest(request_id=uuid.uuid4(), status="Processing", attempts=1, lease_expires_at=datetime(2025, 1, 1))
+    exhausted = GenerationRequest(request_id=uuid.uuid4(), status="Processing", attempts=reaper.MAX_JOB_ATTEMPTS, lease_expires_at=datetime(2025, 1, 1))
+    expired_query = mock_db_session.query.return_value.filter.return_value.order_by.return_value.limit.return_value
+    expired_query.with_for_update.return_value.all.side_effect = [[retryable, exhausted], []]
+
+    leader = MagicMock()
+    leader.is_leader.return_value = True
+    publish = MagicMock()
+    on_terminal = MagicMock()
+
+    reaped = reaper.StuckJobReaper(lambda: mock_db_session, leader, publish, on_terminal).run_once()
+
+    assert reaped == 2
+    assert retryable.status == "Pending"
+    assert retryable.lease_expires_at is None
+    assert exhausted.status == "Failed"
+    publish.assert_called_once_with(retryable)
+    on_terminal.assert_called_once_with(exhausted)
+
+
+# TC26: Replicas that are not the leader do nothing
+def test_reaper_skips_without_leadership(mock_db_session):
+    leader = MagicMock()
+    leader.is_leader.return_value = False
+    session_factory = MagicMock()
+
+    assert reaper.StuckJobReaper(session_factory, leader, MagicMock()).run_once() == 0
+    session_factory.assert_not_called()
+
+
+#-----------TEST FOR job cancellation -------------#
+# TC27: Cancel a pending job, broadcast it and answer worker checks from memory
+def test_cancel_task(client, mock_db_session, mock_mq_channel, monkeypatch):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+    monkeypatch.setattr(api_gateway.api_gateway, "cancelled_requests", CancellationSet())
+
+    job = GenerationRequest(request_id=MOCK_REQUEST_ID, status="Pending")
+    mock_db_session.query.return_value.filter.return_value.with_for_update.return_value.first.return_value = job
+
+    response = client.delete(f"/generate/{MOCK_REQUEST_ID}")
+
+    assert response.status_code == 200
+    assert job.status == "Cancelled"
+    mock_db_session.commit.assert_called_once()
+    assert mock_mq_channel.basic_publish.call_args.kwargs["exchange"] == "generation_cancellations"
+
+    mock_db_session.reset_mock()
+    check = client.head(f"/work/{MOCK_REQUEST_ID}")
+    assert check.headers["X-Cancelled"] == "true"
+    assert client.head(f"/work/{uuid.uuid4()}").headers["X-Cancelled"] == "false"
+    mock_db_session.query.assert_not_called()
+
+
+# TC28: Finished jobs cannot be cancelled, cancelled jobs cannot be started
+def test_cancel_task_conflicts(client, mock_db_session):
+    mock_db_session.reset_mock()
+
+    mock_db_session.query.return_value.filter.return_value.with_for_update.return_value.first.return_value = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        status = "Completed"
+    )
+    assert client.delete(f"/generate/{MOCK_REQUEST_ID}").status_code == 409
+
+    mock_db_session.query.return_value.filter.return_value.first.return_value = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        status = "Cancelled"
+    )
+    assert client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Processing"}).status_code == 410
+
+
+# TC29: Cancellation set stays bounded
+def test_cancellation_set_is_bounded():
+    cancelled = CancellationSet(capacity=2)
+    first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+
+    for request_uuid in (first, second, third):
+        cancelled.add(request_uuid)
+
+    assert len(cancelled) == 2
+    assert first not in cancelled
+    assert third in cancelled
+
+
+#-----------TEST FOR job deadlines -------------#
+# TC30: A TTL is stored as expires_at and sent to the broker as the message expiration
+def test_generate_task_with_ttl(client, mock_db_session, mock_mq_channel, sample_request):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+
+    response = client.post("/generate", json={**sample_request, "ttl_seconds": 60})
+
+    assert response.status_code == 202
+    saved = mock_db_session.add.call_args.args[0]
+    assert 59 <= (saved.expires_at - datetime.utcnow()).total_seconds() <= 60
+    properties = mock_mq_channel.basic_publish.call_args.kwargs["properties"]
+    assert 59000 <= int(properties.expiration) <= 60000
+    assert "ttl_seconds" not in json.loads(mock_mq_channel.basic_publish.call_args.kwargs["body"])["params"]
+
+    past = (datetime.utcnow() - timedelta(minutes=1)).isoformat() + "Z"
+    assert client.post("/generate", json={**sample_request, "deadline": past}).status_code == 422
+
+
+# TC31: A worker starting a job past its deadline is told to drop it
+def test_update_status_expired_job(client, mock_db_session):
+    mock_db_session.reset_mock()
+
+    job = GenerationRequest(request_id=MOCK_REQUEST_ID, status="Pending", expires_at=datetime.utcnow() - timedelta(seconds=1))
+    mock_db_session.query.return_value.filter.return_value.first.return_value = job
+
+    response = client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Processing"})
+
+    assert response.status_code == 410
+    assert job.status == "Expired"
+    assert client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Completed"}).status_code == 410
+
+
+# TC32: Dead-lettered messages are expired in one batch and acked together
+def test_expired_job_consumer_batch(mock_db_session):
+    mock_db_session.reset_mock()
+
+    expired_job = GenerationRequest(request_id=MOCK_REQUEST_ID, status="Expired")
+    mock_db_session.scalars.return_value.all.return_value = [expired_job]
+    on_expired = MagicMock()
+    channel = MagicMock()
+
+    def message(delivery_tag, reason):
+        method = MagicMock(delivery_tag=delivery_tag)
+        properties = MagicMock(headers={"x-death": [{"reason": reason}]})
+        return method, properties, json.dumps({"request_id": str(uuid.uuid4()), "params": {}})
+
+    consumer = expiry.ExpiredJobConsumer(MagicMock(), lambda: mock_db_session, on_expired)
+    consumer._apply(channel, [message(1, "expired"), message(2, "rejected"), message(3, "expired")])
+
+    mock_db_session.scalars.assert_called_once()
+    mock_db_session.commit.assert_called_once()
+    channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+    on_expired.assert_called_once_with(expired_job)
+
+
+# TC33: The reaper expires pending jobs the broker did not dead-letter
+def test_reaper_expires_overdue_pending_jobs(mock_db_session):
+    mock_db_session.reset_mock()
+
+    overdue = GenerationRequest(request_id=uuid.uuid4(), status="Pending", expires_at=datetime(2025, 1, 1))
+    claimed = mock_db_session.query.return_value.filter.return_value.order_by.return_value.limit.return_value
+    claimed.with_for_update.return_value.all.side_effect = [[], [overdue]]
+
+    leader = MagicMock()
+    leader.is_leader.return_value = True
+    publish = MagicMock()
+    on_terminal = MagicMock()
+
+    assert reaper.StuckJobReaper(lambda: mock_db_session, leader, publish, on_terminal).run_once() == 1
+    assert overdue.status == "Expired"
+    publish.assert_not_called()
+    on_terminal.assert_called_once_with(overdue)
+
+
+#-----------TEST FOR variant fan-out -------------#
+# TC34: Variants create one row per seed under a parent but publish a single message
+def test_generate_task_with_variants(client, mock_db_session, mock_mq_channel, sample_request):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+
+    response = client.post("/generate", json={**sample_request, "num_variants": 4})
+
+    assert response.status_code == 202
+    parent = mock_db_session.add.call_args.args[0]
+    children = mock_db_session.add_all.call_args.args[0]
+    assert parent.num_variants == 4
+    assert [child.seed for child in children] == [50, 51, 52, 53]
+    assert all(child.parent_request_id == parent.request_id for child in children)
+
+    mock_mq_channel.basic_publish.assert_called_once()
+    message = json.loads(mock_mq_channel.basic_publish.call_args.kwargs["body"])
+    assert message["request_id"] == response.json()["request_id"]
+    assert [variant["request_id"] for variant in message["variants"]] == [str(child.request_id) for child in children]
+    assert "num_variants" not in message["params"]
+
+    assert client.post("/generate", json={**sample_request, "num_variants": variants.MAX_VARIANTS + 1}).status_code == 422
+
+
+# TC35: Parent status aggregates its variants
+def test_variant_aggregate_status():
+    assert variants.aggregate_status({"Pending": 3}) == "Pending"
+    assert variants.aggregate_status({"Pending": 2, "Completed": 1}) == "Processing"
+    assert variants.aggregate_status({"Completed": 1, "Failed": 2}) == "Completed"
+    assert variants.aggregate_status({"Failed": 1, "Cancelled": 2}) == "Failed"
+    assert variants.aggregate_status({"Cancelled": 3}) == "Cancelled"
+    assert variants.aggregate_status({}) is None
+
+
+#-----------TEST FOR style routing -------------#
+# TC36: Tasks are routed by the style named in the request or detected in the prompt
+def test_generate_task_topic_routing(client, mock_db_session, mock_mq_channel, sample_request, monkeypatch):
+    monkeypatch.setattr(routing, "TOPIC_ROUTING_ENABLED", True)
+
+    def published_route(request_body):
+        mock_mq_channel.reset_mock()
+        assert client.post("/generate", json=request_body).status_code == 202
+        kwargs = mock_mq_channel.basic_publish.call_args.kwargs
+        return kwargs["exchange"], kwargs["routing_key"]
+
+    assert published_route(sample_request) == (routing.TASK_EXCHANGE, "sd.tsuki_advtr")
+    assert published_route({**sample_request, "prompt": "a red apple"}) == (routing.TASK_EXCHANGE, "sd.default")
+    assert published_route({**sample_request, "style": "pixel_art"}) == (routing.TASK_EXCHANGE, "sd.pixel_art")
+    assert client.post("/generate", json={**sample_request, "style": "Pixel.Art"}).status_code == 422
+
+
+# TC37: Only a style the prompt does not already name changes the result cache key
+def test_result_cache_key_with_style(sample_request):
+    request = InferenceRequest(**sample_request)
+    assert result_cache.request_cache_key(request) == result_cache.request_cache_key(request.model_copy(update={"style": "tsuki_advtr"}))
+    assert result_cache.request_cache_key(request) != result_cache.request_cache_key(request.model_copy(update={"style": "pixel_art"}))
+
+
+#-----------TEST FOR fair scheduling -------------#
+# TC38: With fair scheduling on, new jobs are held for their tenant instead of published
+def test_generate_task_held_for_fair_scheduling(client, mock_db_session, mock_mq_channel, sample_request, monkeypatch):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+    monkeypatch.setattr(fair_scheduler, "FAIR_SCHEDULING_ENABLED", True)
+
+    response = client.post("/generate", json=sample_request, headers={"X-Tenant-ID": "acme"})
+
+    assert response.status_code == 202
+    saved = mock_db_session.add.call_args.args[0]
+    assert saved.tenant_id == "acme"
+    assert saved.awaiting_dispatch is True
+    mock_mq_channel.basic_publish.assert_not_called()
+
+    assert client.post("/generate", json=sample_request, headers={"X-Tenant-ID": "a b"}).status_code == 400
+
+
+#-----------TEST FOR API keys and rate limits -------------#
+# TC39: Requests need a valid key, are charged by inference steps and get 429 once over the limit
+def test_generate_task_rate_limited(client, mock_db_session, mock_mq_channel, sample_request, monkeypatch):
+    mock_db_session.reset_mock()
+    monkeypatch.setattr(rate_limit, "API_KEY_AUTH_ENABLED", True)
+    monkeypatch.setattr(api_gateway.api_gateway, "api_key_limiter", rate_limit.ApiKeyLimiter(MagicMock()))
+
+    assert client.post("/generate", json=sample_request).status_code == 401
+
+    key_row = ApiKey(key_hash=rate_limit.hash_api_key("secret"), tenant_id="acme", plan="free", steps_per_minute=60, burst_steps=100, active=True)
+    mock_db_session.get.side_effect = lambda model, key: key_row if model is ApiKey and key == key_row.key_hash else None
+    headers = {"X-API-Key": "secret", "X-Tenant-ID": "someone-else"}
+    sample_request = {**sample_request, "num_inference_steps": 60}
+
+    response = client.post("/generate", json=sample_request, headers=headers)
+    assert response.status_code == 202
+    assert mock_db_session.add.call_args.args[0].tenant_id == "acme"
+
+    response = client.post("/generate", json=sample_request, headers=headers)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+
+    assert client.post("/generate", json={**sample_request, "num_inference_steps": 150}, headers=headers).status_code == 422
+    assert client.post("/generate", json=sample_request, headers={"X-API-Key": "wrong"}).status_code == 401
+    mock_db_session.get.side_effect = None
+
+
+#-----------TEST FOR scheduled jobs -------------#
+# TC40: A job with a future run_at is stored and held instead of published
+def test_generate_task_with_run_at(client, mock_db_session, mock_mq_channel, sample_request):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+    run_at = datetime.utcnow() + timedelta(hours=6)
+
+    response = client.post("/generate", json={**sample_request, "run_at": run_at.isoformat() + "Z"})
+
+    assert response.status_code == 202
+    saved = mock_db_session.add.call_args.args[0]
+    assert saved.run_at == run_at
+    assert saved.awaiting_dispatch is True
+    mock_mq_channel.basic_publish.assert_not_called()
+
+    too_early = {**sample_request, "run_at": run_at.isoformat(), "ttl_seconds": 60}
+    assert client.post("/generate", json=too_early).status_code == 422
+
+
+# TC41: Due jobs are released through the rate limit, the rest wait for the next tick
+def test_scheduled_job_releaser(mock_db_session):
+    mock_db_session.reset_mock()
+
+    jobs = [GenerationRequest(request_id=uuid.uuid4(), status="Pending", awaiting_dispatch=True, run_at=datetime(2025, 1, 1)) for _ in range(3)]
+    mock_db_session.query.return_value.filter.return_value.order_by.return_value.limit.return_value.all.return_value = [
+        (job.request_id, job.run_at) for job in jobs
+    ]
+    by_id = {job.request_id: job for job in jobs}
+
+    def locked_rows():
+        requested = mock_db_session.query.return_value.filter.call_args.args[0].right.value
+        return [by_id[request_id] for request_id in requested]
+    mock_db_session.query.return_value.filter.return_value.with_for_update.return_value.all.side_effect = locked_rows
+
+    leader = MagicMock()
+    leader.is_leader.return_value = True
+    dispatch = MagicMock()
+    releaser = scheduled_jobs.ScheduledJobReleaser(
+        lambda: mock_db_session,
+        leader,
+        dispatch,
+        release_bucket=rate_limit.TokenBucket(rate_per_second=0.01, capacity=2)
+    )
+
+    assert releaser.run_once(now=datetime(2025, 1, 1).timestamp()) == 2
+    assert dispatch.call_count == 2
+    assert [job.awaiting_dispatch for job in jobs].count(False) == 2
+    assert len(releaser._ready) == 1
+
+
+#-----------TEST FOR multi-stage pipelines -------------#
+# TC42: A job with stages stores its pipeline and one stage row per step, unknown stages are rejected
+def test_generate_task_with_stages(client, mock_db_session, mock_mq_channel, sample_request):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+
+    response = client.post("/generate", json={**sample_request, "stages": ["upscale", "remove_background"]})
+
+    assert response.status_code == 202
+    saved = mock_db_session.add.call_args.args[0]
+    assert saved.pipeline == "upscale,remove_background"
+    stages = mock_db_session.add_all.call_args.args[0]
+    assert [stage.name for stage in stages] == ["generate", "upscale", "remove_background"]
+    mock_mq_channel.basic_publish.assert_called_once()
+
+    assert client.post("/generate", json={**sample_request, "stages": ["sharpen"]}).status_code == 422
+    assert client.post("/generate", json={**sample_request, "stages": ["upscale"], "num_variants": 2}).status_code == 422
+
+
+# TC43: The base generation hands its image to the next stage's queue, the last stage completes the job
+def test_pipeline_advances_through_stages(client, mock_db_session, mock_mq_channel):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+
+    job = GenerationRequest(request_id=MOCK_REQUEST_ID, status="Processing", prompt="a cat", seed=1, pipeline="upscale")
+    stages = pipelines.create_stages(MOCK_REQUEST_ID, ["upscale"])
+    mock_db_session.query.return_value.filter.return_value.first.return_value = job
+    mock_db_session.query.return_value.filter.return_value.order_by.return_value.with_for_update.return_value.all.return_value = stages
+
+    response = client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Completed", "image_url": "http://example.com/base.png"})
+
+    assert response.status_code == 200
+    assert job.status == "Processing"
+    assert stages[0].status == "Completed"
+    assert mock_mq_channel.basic_publish.call_args.kwargs["routing_key"] == pipelines.PIPELINE_STAGE_QUEUES["upscale"]
+    message = json.loads(mock_mq_channel.basic_publish.call_args.kwargs["body"])
+    assert message["stage"] == "upscale"
+    assert message["input_image_url"] == "http://example.com/base.png"
+
+    assert client.put(f"/update_db/{MOCK_REQUEST_ID}/stages/remove_background", json={"status": "Completed"}).status_code == 409
+
+    response = client.put(f"/update_db/{MOCK_REQUEST_ID}/stages/upscale", json={"status": "Completed", "image_url": "http://example.com/upscaled.png"})
+
+    assert response.status_code == 200
+    assert job.status == "Completed"
+    assert job.image_url == "http://example.com/upscaled.png"
+
+
+#-----------TEST FOR progress reports -------------#
+# TC44: Progress ticks stay in memory and are served on /status without touching the database
+def test_progress_is_buffered(client, mock_db_session, monkeypatch):
+    mock_db_session.reset_mock()
+    monkeypatch.setattr(api_gateway.api_gateway, "progress_buffer", progress.ProgressBuffer(MagicMock()))
+
+    for step in range(1, 24):
+        assert client.patch(f"/progress/{MOCK_REQUEST_ID}", json={"step": step}).status_code == 204
+    mock_db_session.commit.assert_not_called()
+
+    mock_db_session.query.return_value.filter.return_value.first.return_value = GenerationRequest(
+        request_id = MOCK_REQUEST_ID,
+        status = "Processing",
+        num_inference_steps = 50,
+        started_at = datetime.utcnow()
+    )
+    response = client.get(f"/status/{MOCK_REQUEST_ID}")
+
+    assert response.json()["progress"] == {"step": 23, "total_steps": 50}
+    assert client.patch(f"/progress/{MOCK_REQUEST_ID}", json={"step": -1}).status_code == 422
+
+
+#-----------TEST FOR batched status updates -------------#
+# TC45: A batch is applied in one statement and each item reports whether its transition was accepted
+def test_update_db_batch(client, mock_db_session):
+    mock_db_session.reset_mock()
+    done, finished = uuid.uuid4(), uuid.uuid4()
+    mock_db_session.execute.return_value = [
+        (done, "Processing", False, None, True),
+        (finished, "Completed", False, None, False),
+    ]
+    mock_db_session.query.return_value.filter.return_value.populate_existing.return_value.all.return_value = [
+        GenerationRequest(request_id=done, status="Completed", image_url="http://example.com/a.png")
+    ]
+
+    response = client.put("/update_db/batch", json=[
+        {"request_id": str(done), "status": "Completed", "image_url": "http://example.com/a.png"},
+        {"request_id": str(finished), "status": "Processing"},
+        {"request_id": str(finished), "status": "Cancelled"},
+    ])
+
+    assert response.status_code == 200
+    assert [item["result"] for item in response.json()["results"]] == ["updated", "illegal_transition", "invalid"]
+    assert response.json()["results"][1]["previous_status"] == "Completed"
+    mock_db_session.execute.assert_called_once()
+    mock_db_session.commit.assert_called_once()
+
+    assert client.put("/update_db/batch", json=[]).status_code == 422
+
+
+#-----------TEST FOR queue backends -------------#
+# TC46: With the Postgres backend a new job becomes a task_queue row announced with NOTIFY, no broker involved
+def test_generate_task_with_postgres_queue(client, mock_db_session, mock_mq_channel, sample_request):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+    queue_session = MagicMock()
+    app.dependency_overrides[api_gateway.api_gateway.get_queue_backend] = lambda: queue_backends.PostgresQueueBackend(lambda: queue_session)
+
+    response = client.post("/generate", json=sample_request)
+
+    assert response.status_code == 202
+    task = queue_session.add.call_args.args[0]
+    assert task.queue_name == api_gateway.api_gateway.QUEUE_NAME
+    assert json.loads(task.body)["request_id"] == response.json()["request_id"]
+    queue_session.execute.assert_called_once()
+    queue_session.commit.assert_called_once()
+    mock_mq_channel.basic_publish.assert_not_called()
+
+
+#-----------TEST FOR status transitions -------------#
+# TC47: A job that already failed rejects a late worker report instead of being reopened
+def test_update_db_rejects_terminal_transition(client, mock_db_session):
+    mock_db_session.reset_mock()
+    job = GenerationRequest(request_id=MOCK_REQUEST_ID, status="Failed", attempts=3)
+    mock_db_session.query.return_value.filter.return_value.first.return_value = job
+
+    assert client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Processing"}).status_code == 409
+    assert client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Completed", "image_url": "http://example.com/late.png"}).status_code == 409
+    assert client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Done"}).status_code == 400
+
+    assert job.status == "Failed"
+    assert job.lease_expires_at is None
+    mock_db_session.commit.assert_not_called()
+
+
+#-----------TEST FOR request_id registration -------------#
+# TC48: A new request_id reaches the local bloom filter only once its row is committed
+def test_generate_task_adds_request_id_after_commit(client, mock_db_session, mock_mq_channel, sample_request, monkeypatch):
+    mock_db_session.reset_mock()
+    known_request_ids = KnownRequestIds()
+    known_request_ids._filter = BloomFilter(capacity=1000)
+    monkeypatch.setattr(api_gateway.api_gateway, "known_request_ids", known_request_ids)
+
+    seen_at_commit = []
+    mock_db_session.commit.side_effect = lambda: seen_at_commit.append(
+        known_request_ids.might_exist(mock_db_session.add.call_args.args[0].request_id)
+    )
+
+    response = client.post("/generate", json=sample_request)
+
+    assert response.status_code == 202
+    assert seen_at_commit[0] is False
+    assert known_request_ids.might_exist(uuid.UUID(response.json()["request_id"]))
+    mock_db_session.commit.side_effect = None
+
+
+#-----------TEST FOR callback destinations -------------#
+# TC49: callback_url may not point into the cluster, neither as submitted nor as resolved at delivery
+def test_callback_url_rejects_internal_destinations(client, mock_db_session, sample_request):
+    mock_db_session.reset_mock()
+
+    for callback_url in ["http://127.0.0.1:8000/update_db", "http://169.254.169.254/latest/meta-data", "http://[::1]/hook", "http://localhost/hook"]:
+        response = client.post("/generate", json={**sample_request, "callback_url": callback_url})
+        assert response.status_code == 422
+    mock_db_session.add.assert_not_called()
+
+    assert check_callback_url("https://hooks.partner.com/done", frozenset({"hooks.partner.com"})) is None
+    assert check_callback_url("https://other.example.com/done", frozenset({"hooks.partner.com"})) is not None
+    with pytest.raises(UnsafeDestination):
+        asyncio.run(resolve_destination("10.0.0.5", 80, frozenset()))
+
+
+# TC56: Callbacks connect to the address that passed the check, a second lookup cannot redirect them inward
+def test_callback_connects_to_vetted_address(monkeypatch):
+    lookups = []
+
+    async def getaddrinfo(host, port, **kwargs):
+        # a rebinding server answers the check with a public address and any later lookup with an internal one
+        lookups.append(host)
+        address = "93.184.216.34" if len(lookups) == 1 else "10.0.0.5"
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))]
+
+    connected = []
+
+    async def connect_tcp(self, host, port, *args, **kwargs):
+        connected.append(host)
+        raise httpcore.ConnectError("refused")
+
+    async def post():
+        asyncio.get_running_loop().getaddrinfo = getaddrinfo
+        async with httpx.AsyncClient(transport=VettedTransport(frozenset(), httpx.Limits())) as client:
+            for url in ["https://rebind.example.com/hooks/done", "http://127.0.0.1:8000/update_db"]:
+                try:
+                    await client.post(url)
+                except (httpx.HTTPError, UnsafeDestination) as e:
+                    connected.append(type(e).__name__)
+
+    monkeypatch.setattr(httpcore.AnyIOBackend, "connect_tcp", connect_tcp)
+    asyncio.run(post())
+
+    assert lookups == ["rebind.example.com", "127.0.0.1"]
+    assert connected == ["93.184.216.34", "ConnectError", "UnsafeDestination"]
+
+
+#-----------TEST FOR routed queue depth -------------#
+# TC50: With topic routing, dispatch capacity counts tasks waiting in the worker queues and each worker once,
+# from a sample taken on its own interval plus what was published since
+def test_fair_capacity_counts_routed_worker_queues(monkeypatch):
+    def consumer(queue_name, connection_name):
+        return {"queue": {"name": queue_name}, "channel_details": {"connection_name": connection_name}}
+
+    api_calls = []
+
+    def management_api(request):
+        api_calls.append(request.url.path)
+        if request.url.path.startswith("/api/queues"):
+            return httpx.Response(200, json=[
+                {"name": "image_generation_queue", "messages_ready": 3},
+                {"name": "image_generation.worker.gpu-1", "messages_ready": 40},
+                {"name": "image_generation_batch", "messages_ready": 7}
+            ])
+        return httpx.Response(200, json=[
+            consumer("image_generation_queue", "worker-1"),
+            consumer("image_generation.worker.gpu-1", "worker-1"),
+            consumer("image_generation.worker.gpu-2", "worker-2"),
+            consumer("generation_results", "gateway")
+        ])
+
+    client_class = httpx.Client
+    monkeypatch.setattr(httpx, "Client", lambda **kwargs: client_class(transport=httpx.MockTransport(management_api), **kwargs))
+    routed_depth = routing.RoutedQueueDepth(lambda: routing.routed_queue_depth("rabbitmq", "user", "password", "image_generation_queue"), lag_seconds=5)
+    monkeypatch.setattr(api_gateway.api_gateway, "routed_depth", routed_depth)
+    monkeypatch.setattr(routing, "TOPIC_ROUTING_ENABLED", True)
+    broker_queue = MagicMock()
+    monkeypatch.setattr(api_gateway.api_gateway, "_background_queue", lambda manager: broker_queue)
+
+    # unknown until the first sample
+    assert api_gateway.api_gateway._fair_broker_capacity() == 0
+    assert api_gateway.api_gateway._pregeneration_queue_depth() == float("inf")
+
+    routed_depth.refresh()
+    assert api_gateway.api_gateway._fair_broker_capacity() == fair_scheduler.broker_capacity(43, 2)
+    assert api_gateway.api_gateway._pregeneration_queue_depth() == 43
+
+    # dispatches between samples count against the stale sample, and ticks do not call the management API
+    api_gateway.api_gateway.publish_task(broker_queue, str(uuid.uuid4()), {}, style="pixel_art")
+    routed_depth.record_published(2)
+    assert api_gateway.api_gateway._pregeneration_queue_depth() == 46
+    assert len(api_calls) == 2
+    broker_queue.depth.assert_not_called()
+
+    # a sample taken well after the publishes already counts them
+    assert routed_depth.current(now=time.monotonic() + routed_depth.max_age + 1) is None
+    routed_depth._published = deque((published_at - 10, count) for published_at, count in routed_depth._published)
+    routed_depth.refresh()
+    assert routed_depth.current().messages == 43
+
+
+#-----------TEST FOR tenant-scoped idempotency keys -------------#
+# TC51: Two API keys reusing the same Idempotency-Key get their own requests
+def test_idempotency_key_is_scoped_by_tenant(client, mock_db_session, mock_mq_channel, sample_request, monkeypatch):
+    mock_db_session.reset_mock()
+    monkeypatch.setattr(rate_limit, "API_KEY_AUTH_ENABLED", True)
+    monkeypatch.setattr(api_gateway.api_gateway, "api_key_limiter", rate_limit.ApiKeyLimiter(MagicMock()))
+
+    key_rows = {
+        rate_limit.hash_api_key(secret): ApiKey(key_hash=rate_limit.hash_api_key(secret), tenant_id=tenant_id, plan="free", steps_per_minute=600, burst_steps=1000, active=True)
+        for secret, tenant_id in [("secret-a", "acme"), ("secret-b", "globex")]
+    }
+    stored_keys = {}
+
+    def get(model, key):
+        if model is ApiKey:
+            return key_rows.get(key)
+        return stored_keys.get(key) if model is IdempotencyKey else None
+
+    def add(obj):
+        if isinstance(obj, GenerationRequest):
+            obj.request_id = uuid.uuid4()
+        if isinstance(obj, IdempotencyKey):
+            stored_keys[obj.key] = obj
+
+    mock_db_session.get.side_effect = get
+    mock_db_session.add.side_effect = add
+
+    first = client.post("/generate", json=sample_request, headers={"X-API-Key": "secret-a", "Idempotency-Key": "order-42"})
+    replay = client.post("/generate", json=sample_request, headers={"X-API-Key": "secret-a", "Idempotency-Key": "order-42"})
+    other_tenant = client.post("/generate", json=sample_request, headers={"X-API-Key": "secret-b", "Idempotency-Key": "order-42"})
+
+    assert replay.json()["request_id"] == first.json()["request_id"]
+    assert other_tenant.status_code == 202
+    assert other_tenant.json()["request_id"] != first.json()["request_id"]
+    assert len(stored_keys) == 2
+    mock_db_session.get.side_effect = None
+    mock_db_session.add.side_effect = None
+
+
+#-----------TEST FOR duplicate base reports on pipelines -------------#
+# TC52: Once the base generation completed, repeated base reports neither finish the job nor restart it
+def test_pipeline_ignores_duplicate_base_reports(client, mock_db_session, mock_mq_channel, monkeypatch):
+    mock_db_session.reset_mock()
+    mock_mq_channel.reset_mock()
+    store = MagicMock()
+    monkeypatch.setattr(result_cache, "store", store)
+
+    job = GenerationRequest(request_id=MOCK_REQUEST_ID, status="Processing", prompt="a cat", seed=1, pipeline="upscale")
+    stages = pipelines.create_stages(MOCK_REQUEST_ID, ["upscale"])
+    mock_db_session.query.return_value.filter.return_value.first.return_value = job
+    mock_db_session.query.return_value.filter.return_value.order_by.return_value.with_for_update.return_value.all.return_value = stages
+
+    assert client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Completed", "image_url": "http://example.com/base.png"}).status_code == 200
+    image_url, lease_expires_at = job.image_url, job.lease_expires_at
+
+    duplicate = client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Completed", "image_url": "http://example.com/base.png"})
+    late_start = client.put(f"/update_db/{MOCK_REQUEST_ID}", json={"status": "Processing"})
+
+    assert duplicate.status_code == 409
+    assert late_start.status_code == 409
+    assert job.status == "Processing"
+    assert job.image_url == image_url
+    assert job.lease_expires_at == lease_expires_at
+    assert stages[1].status == "Pending"
+    assert mock_mq_channel.basic_publish.call_count == 1
+    store.assert_not_called()
+
+
+#-----------TEST FOR expired job consumer sessions -------------#
+# TC53: Expired jobs are finished while their session is open, a failed batch is nacked back to the broker
+def test_expired_job_consumer_finishes_jobs_in_session():
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    GenerationRequest.__table__.create(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    db = session_factory()
+    parent = GenerationRequest(prompt="a cat", status="Processing", num_variants=2)
+    db.add(parent)
+    db.flush()
+    job = GenerationRequest(prompt="a cat", status="Pending", parent_request_id=parent.request_id, callback_url="https://partner.example.com/hooks/done")
+    db.add(job)
+    db.commit()
+    request_id, parent_request_id = job.request_id, parent.request_id
+    db.close()
+
+    finished = []
+    consumer = expiry.ExpiredJobConsumer(MagicMock(), session_factory, lambda job: finished.append((job.callback_url, job.parent_request_id)))
+    method = MagicMock(delivery_tag=7)
+    properties = MagicMock(headers={"x-death": [{"reason": "expired"}]})
+    channel = MagicMock()
+
+    consumer._apply(channel, [(method, properties, json.dumps({"request_id": str(request_id), "params": {}}))])
+
+    assert finished == [("https://partner.example.com/hooks/done", parent_request_id)]
+    channel.basic_ack.assert_called_once_with(delivery_tag=7, multiple=True)
+
+    broken_session = MagicMock()
+    broken_session.scalars.side_effect = RuntimeError("database is down")
+    channel = MagicMock()
+    consumer = expiry.ExpiredJobConsumer(MagicMock(), lambda: broken_session)
+    with pytest.raises(RuntimeError):
+        consumer._apply(channel, [(method, properties, json.dumps({"request_id": str(request_id), "params": {}}))])
+    channel.basic_nack.assert_called_once_with(delivery_tag=7, multiple=True, requeue=True)
+    channel.basic_ack.assert_not_called()
+
+
+#-----------TEST FOR delayed variants in pull mode -------------#
+# TC54: The variants of a delayed request are not leased before run_at
+def test_delayed_variants_are_not_leased_early(client, sample_request, monkeypatch):
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    GenerationRequest.__table__.create(engine)
+    db = sessionmaker(bind=engine)()
+    app.dependency_overrides[get_db] = lambda: db
+    monkeypatch.setattr(leases, "WORK_DISPATCH_MODE", "pull")
+    run_at = datetime.utcnow() + timedelta(hours=6)
+
+    response = client.post("/generate", json={**sample_request, "num_variants": 3, "run_at": run_at.isoformat() + "Z"})
+
+    assert response.status_code == 202
+    children = db.query(GenerationRequest).filter(GenerationRequest.parent_request_id.isnot(None)).all()
+    assert len(children) == 3
+    assert all(child.run_at == run_at for child in children)
+    assert leases.lease_jobs(db, 10) == []
+    db.close()
+
+
+#-----------TEST FOR cancellation reload -------------#
+# TC55: A reload that finds more cancellations than fit keeps the newest ones
+def test_cancellation_reload_keeps_newest(monkeypatch):
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    GenerationRequest.__table__.create(engine)
+    session_factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(api_gateway.cancellation, "SessionLocal", session_factory)
+
+    db = session_factory()
+    now = datetime.utcnow()
+    jobs = [GenerationRequest(prompt="a cat", status="Cancelled", updated_at=now - timedelta(minutes=minutes)) for minutes in (30, 20, 10, 0)]
+    db.add_all(jobs)
+    db.commit()
+    oldest, older, newer, newest = [job.request_id for job in jobs]
+    db.close()
+
+    cancelled = CancellationSet(capacity=2)
+    cancelled.reload()
+
+    assert newer in cancelled and newest in cancelled
+    assert oldest not in cancelled and older not in cancelled
+    cancelled.add(uuid.uuid4())
+    assert newest in cancelled
+
+
+# TC57: Per-host delivery limits are shared while a host has pending callbacks and dropped afterwards
+def test_webhook_host_slots_are_pruned():
+    host_slots = HostSlots(limit=2)
+
+    first = host_slots.acquire("partner.example.com")
+    assert host_slots.acquire("partner.example.com") is first
+    host_slots.acquire("other.example.com")
+    assert len(host_slots) == 2
+
+    host_slots.release("other.example.com")
+    host_slots.release("partner.example.com")
+    assert len(host_slots) == 1
+    host_slots.release("partner.example.com")
+    assert len(host_slots) == 0
+    assert host_slots.acquire("partner.example.com") is not first
+
+
+#-----------TEST FOR dead-letter policy -------------#
+# TC58: Work queues already governed by an operator policy keep its settings alongside dead-lettering
+def test_dead_letter_policy_merges_operator_policy(monkeypatch):
+    requests = []
+
+    def management_api(request):
+        requests.append((request.method, request.url.path, json.loads(request.content) if request.content else None))
+        if request.method == "GET" and request.url.path.startswith("/api/policies"):
+            return httpx.Response(200, json=[
+                {"name": "work-limits", "pattern": "^image_generation", "apply-to": "queues", "priority": 5, "definition": {"max-length": 1000}},
+                {"name": "image-generation-dead-letter.retired", "pattern": "^gone$", "apply-to": "queues", "priority": 11, "definition": {}}
+            ])
+        if request.method == "GET":
+            return httpx.Response(200, json=[{"name": "image_generation_queue"}, {"name": "image_generation.worker.gpu-1"}, {"name": "unrelated"}])
+        return httpx.Response(204)
+
+    client_class = httpx.Client
+    monkeypatch.setattr(httpx, "Client", lambda **kwargs: client_class(transport=httpx.MockTransport(management_api), **kwargs))
+
+    expiry.apply_dead_letter_policy("rabbitmq", "user", "password", ["image_generation_queue", routing.WORKER_QUEUE_PATTERN])
+
+    written = {path.rsplit("/", 1)[-1]: body for method, path, body in requests if method == "PUT"}
+    assert written["image-generation-dead-letter"]["definition"] == {"dead-letter-exchange": expiry.DEAD_LETTER_EXCHANGE}
+    merged = written["image-generation-dead-letter.work-limits"]
+    assert merged["definition"] == {"max-length": 1000, "dead-letter-exchange": expiry.DEAD_LETTER_EXCHANGE}
+    assert merged["priority"] == 11
+    assert re.fullmatch(merged["pattern"], "image_generation.worker.gpu-1") and not re.fullmatch(merged["pattern"], "image_generation.worker.gpu-2")
+    assert [path.rsplit("/", 1)[-1] for method, path, body in requests if method == "DELETE"] == ["image-generation-dead-letter.retired"]
+
+
+#-----------TEST FOR pipeline stage leases -------------#
+# TC59: A running stage holds the job's lease, the reaper runs a stage whose worker died again and fails it once retries are spent
+def test_reaper_requeues_pipeline_stage(client, mock_db_session, mock_mq_channel):
+    mock_db_session.reset_mock()
+
+    job = GenerationRequest(request_id=MOCK_REQUEST_ID, status="Processing", prompt="a cat", seed=1, pipeline="upscale", attempts=1)
+    stages = pipelines.create_stages(MOCK_REQUEST_ID, ["upscale"])
+    pipelines.mark(stages[0], "Completed", "http://example.com/base.png")
+    pipelines.queue_stage(stages[1], "http://example.com/base.png")
+    mock_db_session.query.return_value.filter.return_value.first.return_value = job
+    mock_db_session.query.return_value.filter.return_value.order_by.return_value.with_for_update.return_value.all.return_value = stages
+
+    assert client.put(f"/update_db/{MOCK_REQUEST_ID}/stages/upscale", json={"status": "Processing"}).status_code == 200
+    assert job.lease_expires_at is not None
+
+    job.lease_expires_at = datetime(2025, 1, 1)
+    expired_query = mock_db_session.query.return_value.filter.return_value.order_by.return_value.limit.return_value
+    expired_query.with_for_update.return_value.all.side_effect = [[job], []]
+    leader = MagicMock()
+    leader.is_leader.return_value = True
+    publish, publish_stage, on_terminal = MagicMock(), MagicMock(), MagicMock()
+    stuck_reaper = reaper.StuckJobReaper(lambda: mock_db_session, leader, publish, on_terminal, publish_stage=publish_stage)
+
+    assert stuck_reaper.run_once() == 1
+    assert job.status == "Processing"
+    assert job.attempts == 2
+    assert stages[1].status == "Pending"
+    publish_stage.assert_called_once_with(job, stages[1])
+    publish.assert_not_called()
+
+    job.attempts = reaper.MAX_JOB_ATTEMPTS
+    job.lease_expires_at = datetime(2025, 1, 1)
+    expired_query.with_for_update.return_value.all.side_effect = [[job], []]
+
+    stuck_reaper.run_once()
+
+    assert job.status == "Failed"
+    assert stages[1].status == "Failed"
+    on_terminal.assert_called_once_with(job)
+
+
+#-----------TEST FOR result cache invalidation auth -------------#
+# TC60: With API keys on, only admin-plan keys may drop the result cache
+def test_result_cache_invalidation_requires_admin_key(client, mock_db_session, monkeypatch):
+    mock_db_session.reset_mock()
+    monkeypatch.setattr(rate_limit, "API_KEY_AUTH_ENABLED", True)
+    monkeypatch.setattr(api_gateway.api_gateway, "api_key_limiter", rate_limit.ApiKeyLimiter(MagicMock()))
+    invalidate = MagicMock(return_value=3)
+    monkeypatch.setattr(result_cache, "invalidate", invalidate)
+
+    key_rows = {
+        rate_limit.hash_api_key(secret): ApiKey(key_hash=rate_limit.hash_api_key(secret), tenant_id="acme", plan=plan, steps_per_minute=60, burst_steps=100, active=True)
+        for secret, plan in [("tenant-secret", "free"), ("admin-secret", rate_limit.ADMIN_PLAN)]
+    }
+    mock_db_session.get.side_effect = lambda model, key: key_rows.get(key) if model is ApiKey else None
+
+    assert client.delete("/result_cache").status_code == 401
+    assert client.delete("/result_cache", headers={"X-API-Key": "tenant-secret"}).status_code == 403
+    invalidate.assert_not_called()
+
+    response = client.delete("/result_cache", headers={"X-API-Key": "admin-secret"})
+    assert response.status_code == 200
+    assert response.json() == {"deleted": 3}
+    mock_db_session.get.side_effect = None
@@ -0,0 +1,62 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.batching import BatchingPublisher, batch_key
+
+
+def params(steps, guidance):
+    return {"prompt": "a cat", "num_inference_steps": steps, "guidance_scale": guidance, "seed": 1}
+
+
+# TC1: Compatible jobs are packed together, incompatible ones go out in their own batch
+def test_batching_groups_compatible_jobs():
+    batches = []
+    publisher = BatchingPublisher(lambda jobs: batches.append([job.request_id for job in jobs]), max_size=2, max_wait_ms=50)
+    publisher.start()
+    try:
+        futures = [
+            publisher.submit("a", params(50, 7.5)),
+            publisher.submit("b", params(30, 7.5)),
+            publisher.submit("c", params(50, 7.5)),
+        ]
+        for future in futures:
+            future.result(timeout=5)
+    finally:
+        publisher.stop()
+
+    assert sorted(batches) == [["a", "c"], ["b"]]
+    assert batch_key(params(50, 7.5)) == batch_key(params(50, 7.50001))
+
+
+# TC2: A lone job is flushed once the wait window passes
+def test_batching_flushes_after_max_wait():
+    published = threading.Event()
+    publisher = BatchingPublisher(lambda jobs: published.set(), max_size=8, max_wait_ms=20)
+    publisher.start()
+    try:
+        publisher.submit("a", params(50, 7.5)).result(timeout=5)
+    finally:
+        publisher.stop()
+
+    assert published.is_set()
+
+
+# TC3: Publish errors reach every job in the batch
+def test_batching_propagates_publish_errors():
+    def fail(jobs):
+        raise RuntimeError("broker down")
+
+    publisher = BatchingPublisher(fail, max_size=2, max_wait_ms=1000)
+    publisher.start()
+    try:
+        futures = [publisher.submit(request_id, params(50, 7.5)) for request_id in ("a", "b")]
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result(timeout=5)
+    finally:
+        publisher.stop()
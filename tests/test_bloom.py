@@ -0,0 +1,36 @@
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.bloom import BloomFilter, KnownRequestIds
+
+
+# TC1: No false negatives, and false positives stay near the configured rate
+def test_bloom_filter_false_positive_rate():
+    bloom_filter = BloomFilter(capacity=5000, false_positive_rate=0.01)
+    known = [uuid.uuid4().bytes for _ in range(5000)]
+    for item in known:
+        bloom_filter.add(item)
+
+    assert all(item in bloom_filter for item in known)
+
+    unknown = [uuid.uuid4().bytes for _ in range(20000)]
+    false_positives = sum(item in bloom_filter for item in unknown)
+    assert false_positives / len(unknown) < 0.02
+
+
+# TC2: Memory budget caps the bit array
+def test_bloom_filter_respects_memory_budget():
+    bloom_filter = BloomFilter(capacity=1_000_000, false_positive_rate=0.001, max_bytes=1024)
+
+    assert bloom_filter.size_bytes == 1024
+
+
+# TC3: Unbuilt filter never answers a definite miss
+def test_known_request_ids_not_ready_is_permissive():
+    known_request_ids = KnownRequestIds()
+
+    assert not known_request_ids.ready
+    assert known_request_ids.might_exist(uuid.uuid4())
@@ -0,0 +1,52 @@
+import os
+import sys
+from collections import deque, Counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.fair_scheduler import DeficitRoundRobin, broker_capacity
+from api_gateway.models import GenerationRequest
+
+
+def jobs(count, steps=50):
+    return deque(GenerationRequest(num_inference_steps=steps) for _ in range(count))
+
+
+# TC1: A small tenant is served right away even behind a large flood
+def test_drr_small_tenant_not_starved():
+    scheduler = DeficitRoundRobin(quantum=50, weight=lambda tenant: 1)
+    queues = {"flood": jobs(10000), "small": jobs(2)}
+
+    selected = [tenant for tenant, _ in scheduler.select(queues, budget=4)]
+
+    assert selected.count("small") == 2
+    assert selected.count("flood") == 2
+
+
+# TC2: Service is proportional to plan weight and measured in inference steps
+def test_drr_weights_and_step_cost():
+    weights = {"pro": 4, "free": 1}
+    scheduler = DeficitRoundRobin(quantum=50, weight=weights.get)
+    queues = {"pro": jobs(100), "free": jobs(100)}
+
+    served = Counter(tenant for tenant, _ in scheduler.select(queues, budget=50))
+    assert served["pro"] == 4 * served["free"]
+
+    scheduler = DeficitRoundRobin(quantum=50, weight=lambda tenant: 1)
+    queues = {"heavy": jobs(100, steps=100), "light": jobs(100, steps=25)}
+
+    served = Counter(tenant for tenant, _ in scheduler.select(queues, budget=30))
+    assert served["light"] == 4 * served["heavy"]
+
+
+# TC3: Deficits carry over between calls while a tenant stays backlogged, idle tenants bank nothing
+def test_drr_deficit_carry_over():
+    scheduler = DeficitRoundRobin(quantum=50, weight=lambda tenant: 1)
+    queues = {"big": jobs(3, steps=120), "idle": deque()}
+
+    assert scheduler.select(queues, budget=1)[0][0] == "big"
+    assert "idle" not in scheduler.deficits
+    assert scheduler.deficits["big"] == 30
+
+    assert broker_capacity(queue_depth=1, workers=3) == 5
+    assert broker_capacity(queue_depth=10, workers=3) < 0
@@ -0,0 +1,94 @@
+import os
+import sys
+import random
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway import pregeneration
+from api_gateway.pregeneration import SpaceSaving, Pregenerator
+from api_gateway.models import GenerationRequest
+
+
+# TC1: Heavy hitters survive a long tail of one-off keys in bounded memory
+def test_space_saving_keeps_heavy_hitters():
+    sketch = SpaceSaving(capacity=20)
+    rng = random.Random(3)
+    stream = ["hot-a"] * 300 + ["hot-b"] * 200 + [f"tail-{i}" for i in range(2000)]
+    rng.shuffle(stream)
+    for key in stream:
+        sketch.add(key)
+
+    assert len(sketch) == 20
+    assert sketch.top(min_count=50) == ["hot-a", "hot-b"]
+
+    sketch.decay()
+    assert sketch.counts["hot-a"] < 300
+
+
+def row(prompt, seed=50, created_at=datetime(2025, 1, 1)):
+    return GenerationRequest(
+        prompt = prompt,
+        negative_prompt = "",
+        num_inference_steps = 50,
+        guidance_scale = 7.5,
+        seed = seed,
+        created_at = created_at
+    )
+
+
+# TC2: When workers are idle the most popular uncached tuple is queued once
+def test_pregenerator_enqueues_popular_when_idle(monkeypatch):
+    monkeypatch.setattr(pregeneration, "PREGENERATION_MIN_COUNT", 3)
+    db = MagicMock(spec=Session)
+    db.get.return_value = None
+    recent = db.query.return_value.filter.return_value.order_by.return_value.limit.return_value
+    recent.all.return_value = [row("a samoyed") for _ in range(5)] + [row("a husky")]
+
+    leader = MagicMock()
+    leader.is_leader.return_value = True
+    publish = MagicMock()
+    depth = MagicMock(return_value=0)
+    planner = Pregenerator(lambda: db, leader, depth, publish)
+
+    assert planner.run_once() == 1
+    queued = publish.call_args.args[0]
+    assert queued.prompt == "a samoyed"
+    assert queued.tenant_id == pregeneration.PREGENERATION_TENANT
+
+    # already in flight, and nothing new is popular enough
+    recent.all.return_value = []
+    assert planner.run_once() == 0
+
+    # busy workers get no speculative work
+    depth.return_value = 100
+    planner._in_flight.clear()
+    assert planner.run_once() == 0
+    assert publish.call_count == 1
+
+
+# TC3: Speculative rows register their request_id in the insert transaction, like client submissions
+def test_pregenerator_registers_request_ids(monkeypatch):
+    monkeypatch.setattr(pregeneration, "PREGENERATION_MIN_COUNT", 3)
+    db = MagicMock(spec=Session)
+    db.get.return_value = None
+    recent = db.query.return_value.filter.return_value.order_by.return_value.limit.return_value
+    recent.all.return_value = [row("a samoyed") for _ in range(5)]
+
+    leader = MagicMock()
+    leader.is_leader.return_value = True
+    calls = []
+    db.commit.side_effect = lambda: calls.append("commit")
+    register = MagicMock(side_effect=lambda session, request_id: calls.append("register"))
+    remember = MagicMock(side_effect=lambda request_ids: calls.append("remember"))
+    publish = MagicMock()
+    planner = Pregenerator(lambda: db, leader, MagicMock(return_value=0), publish, register_request_id=register, remember_request_ids=remember)
+
+    assert planner.run_once() == 1
+    request_id = publish.call_args.args[0].request_id
+    register.assert_called_once_with(db, request_id)
+    remember.assert_called_once_with([request_id])
+    assert calls == ["register", "commit", "remember"]
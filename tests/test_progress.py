@@ -0,0 +1,52 @@
+import os
+import sys
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+import pytest
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.progress import ProgressBuffer
+
+
+NOW = datetime(2025, 1, 1, 12, 0, 0)
+
+
+# TC1: Many ticks for a job collapse into one row per flush, carrying only the latest step
+def test_flush_coalesces_reports():
+    session = MagicMock(spec=Session)
+    buffer = ProgressBuffer(lambda: session)
+
+    for step in range(1, 51):
+        buffer.report("a", step, 50, now=NOW)
+    buffer.report("b", 3, 30, now=NOW)
+
+    assert buffer.flush(now=NOW) == 2
+    rows = session.execute.call_args.args[1]
+    assert sorted((row["b_request_id"], row["b_step"]) for row in rows) == [("a", 50), ("b", 3)]
+    session.commit.assert_called_once()
+
+    assert buffer.flush(now=NOW) == 0
+    assert session.execute.call_count == 1
+
+
+# TC2: Finished jobs are dropped, stale entries expire and failed flushes are retried
+def test_discard_retention_and_retry():
+    session = MagicMock(spec=Session)
+    buffer = ProgressBuffer(lambda: session, retention_seconds=60)
+
+    buffer.report("done", 10, now=NOW)
+    buffer.discard("done")
+    buffer.report("stale", 10, now=NOW)
+    buffer.report("live", 5, now=NOW + timedelta(seconds=90))
+
+    session.execute.side_effect = RuntimeError("database down")
+    with pytest.raises(RuntimeError):
+        buffer.flush(now=NOW + timedelta(seconds=100))
+    assert buffer.get("stale") is None
+
+    session.execute.side_effect = None
+    assert buffer.flush(now=NOW + timedelta(seconds=100)) == 1
+    assert session.execute.call_args.args[1][0]["b_request_id"] == "live"
@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.models import QueuedTask
+from api_gateway.queue_backends import RabbitMQBackend, PostgresQueueBackend
+
+
+NOW = datetime(2025, 1, 1, 12, 0, 0)
+
+
+# TC1: The RabbitMQ backend publishes persistent messages that expire with the job
+def test_rabbitmq_backend_publish():
+    channel = MagicMock()
+
+    RabbitMQBackend(channel).publish("tasks", {"request_id": "a"}, datetime.utcnow() + timedelta(seconds=60), "image_generation.tasks", "sd.default")
+
+    kwargs = channel.basic_publish.call_args.kwargs
+    assert (kwargs["exchange"], kwargs["routing_key"]) == ("image_generation.tasks", "sd.default")
+    assert json.loads(kwargs["body"]) == {"request_id": "a"}
+    assert 0 < int(kwargs["properties"].expiration) <= 60000
+
+
+# TC2: Claims lock with SKIP LOCKED and hide the batch until the visibility timeout
+def test_postgres_backend_claim():
+    session = MagicMock(spec=Session)
+    tasks = [QueuedTask(id=i, queue_name="tasks", body=json.dumps({"n": i}), deliveries=0) for i in (1, 2)]
+    locked = session.query.return_value.filter.return_value.order_by.return_value.limit.return_value.with_for_update
+    locked.return_value.all.return_value = tasks
+
+    claimed = PostgresQueueBackend(lambda: session).claim("tasks", 2, visibility_seconds=30, now=NOW)
+
+    locked.assert_called_once_with(skip_locked=True)
+    assert [task.message for task in claimed] == [{"n": 1}, {"n": 2}]
+    assert all(task.visible_at == NOW + timedelta(seconds=30) and task.deliveries == 1 for task in tasks)
+    session.commit.assert_called_once()
+
+
+# TC3: A long-polling claim wakes up on the publish notification instead of waiting out its timeout
+def test_postgres_backend_claim_wakes_on_notification():
+    backend = PostgresQueueBackend(MagicMock())
+    published = threading.Event()
+    backend.claim = lambda *args: ["task"] if published.is_set() else []
+
+    def publish():
+        time.sleep(0.05)
+        published.set()
+        backend.on_notification("tasks")
+    threading.Thread(target=publish).start()
+
+    started = time.monotonic()
+    assert backend.claim_or_wait("tasks", 1, wait_seconds=5) == ["task"]
+    assert time.monotonic() - started < 2
+
+
+# TC4: Past the waiter cap a claim on an empty queue answers at once instead of holding another request thread
+def test_postgres_backend_caps_long_poll_waiters():
+    backend = PostgresQueueBackend(MagicMock(), max_waiters=1)
+    backend.claim = lambda *args: []
+    waiting = threading.Thread(target=backend.claim_or_wait, args=("tasks", 1, 0.5))
+    waiting.start()
+    time.sleep(0.05)
+
+    started = time.monotonic()
+    assert backend.claim_or_wait("tasks", 1, wait_seconds=5) == []
+    assert time.monotonic() - started < 0.25
+    waiting.join()
+
+    started = time.monotonic()
+    assert backend.claim_or_wait("tasks", 1, wait_seconds=0.1) == []
+    assert time.monotonic() - started >= 0.1
@@ -0,0 +1,82 @@
+import os
+import sys
+from unittest.mock import MagicMock
+
+import pytest
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.rate_limit import TokenBucket, ApiKeyLimiter, ApiKeyInfo, RateLimitExceeded
+
+
+KEY = ApiKeyInfo("a" * 64, "acme", "free", steps_per_minute=600, burst_steps=100, daily_step_quota=None)
+
+
+# TC1: The bucket holds a burst, refills at its rate and reports when a cost will fit
+def test_token_bucket_refill_and_retry_after():
+    bucket = TokenBucket(rate_per_second=10, capacity=100, now=0)
+
+    assert bucket.try_consume(100, now=0) == 0
+    assert bucket.try_consume(50, now=0) == 5
+    assert bucket.try_consume(50, now=5) == 0
+    assert bucket.try_consume(1000, now=1000) == 90
+
+
+# TC2: Charges beyond the burst are rejected until refunded or refilled
+def test_limiter_charge_and_refund():
+    limiter = ApiKeyLimiter(MagicMock())
+
+    limiter.charge(KEY, 100, now=0)
+    with pytest.raises(RateLimitExceeded) as exceeded:
+        limiter.charge(KEY, 50, now=0)
+    assert exceeded.value.retry_after == 5
+
+    limiter.refund(KEY, 100)
+    limiter.charge(KEY, 50, now=0)
+
+
+# TC3: Reconciliation deducts what other replicas consumed since the last pass
+def test_limiter_reconcile_deducts_foreign_usage():
+    db = MagicMock(spec=Session)
+    limiter = ApiKeyLimiter(lambda: db)
+    limiter.charge(KEY, 20, now=0)
+
+    # first pass only records the window total
+    db.query.return_value.filter.return_value.all.return_value = [(KEY.key_hash, 120)]
+    limiter.reconcile()
+    db.execute.assert_called_once()
+    assert limiter._buckets[KEY.key_hash].tokens == 80
+
+    # 30 more steps were charged elsewhere, 10 here
+    limiter.charge(KEY, 10, now=0)
+    db.query.return_value.filter.return_value.all.return_value = [(KEY.key_hash, 160)]
+    limiter.reconcile()
+    assert limiter._buckets[KEY.key_hash].tokens == 40
+
+
+# TC4: Usage is put back only when its write fails, not when the follow-up window read does
+def test_limiter_reconcile_restores_only_unwritten_usage():
+    db = MagicMock(spec=Session)
+    limiter = ApiKeyLimiter(lambda: db)
+    limiter.charge(KEY, 20, now=0)
+    db.query.return_value.filter.return_value.all.return_value = [(KEY.key_hash, 20)]
+    limiter.reconcile()
+
+    limiter.charge(KEY, 10, now=0)
+    db.commit.side_effect = RuntimeError("database unavailable")
+    with pytest.raises(RuntimeError):
+        limiter.reconcile()
+    assert limiter._pending[KEY.key_hash] == (10, 1)
+
+    db.commit.side_effect = None
+    db.query.return_value.filter.return_value.all.side_effect = RuntimeError("database unavailable")
+    with pytest.raises(RuntimeError):
+        limiter.reconcile()
+    assert KEY.key_hash not in limiter._pending
+
+    # the 10 steps written on the failed pass are not deducted again as foreign usage
+    db.query.return_value.filter.return_value.all.side_effect = None
+    db.query.return_value.filter.return_value.all.return_value = [(KEY.key_hash, 30)]
+    limiter.reconcile()
+    assert limiter._buckets[KEY.key_hash].tokens == 70
@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.similarity import PromptIndex
+
+
+PROMPT = "tsuki_advtr, a samoyed dog smiling, white background, thick outlines, pastel color, cartoon style, hand-drawn, 2D icon, game item, 2D game style, minimalist"
+
+
+# TC1: Reordered, re-punctuated prompt with the same params matches the indexed result
+def test_prompt_index_matches_near_duplicate():
+    index = PromptIndex(capacity=8, dim=512)
+    index.add("req-1", PROMPT, "", 50, 7.5, 50, "http://example.com/dog.png")
+    index.add("req-2", PROMPT.replace("samoyed dog", "red potion bottle"), "", 50, 7.5, 50, "http://example.com/potion.png")
+    index.add("req-3", PROMPT.replace("samoyed dog", "golden sword"), "", 50, 7.5, 50, "http://example.com/sword.png")
+
+    reordered = "tsuki_advtr a samoyed dog smiling; thick outlines, white background, pastel color, cartoon style, hand-drawn 2D icon, game item, 2D game style"
+    match = index.find(reordered, "", 50, 7.5, 50, threshold=0.9)
+
+    assert match is not None
+    assert match.request_id == "req-1"
+    assert match.image_url == "http://example.com/dog.png"
+
+    different_subject = PROMPT.replace("samoyed", "husky")
+    assert index.find(different_subject, "", 50, 7.5, 50, threshold=0.9) is None
+
+
+# TC2: Different numeric params never match, and the ring buffer stays bounded
+def test_prompt_index_requires_matching_params_and_is_bounded():
+    index = PromptIndex(capacity=2, dim=256)
+    index.add("req-1", PROMPT, "", 50, 7.5, 50, "http://example.com/1.png")
+
+    assert index.find(PROMPT, "", 30, 7.5, 50) is None
+    assert index.find(PROMPT, "", 50, 7.5, 51) is None
+    assert index.find(PROMPT, "blurry", 50, 7.5, 50) is None
+
+    index.add("req-2", "a sword", "", 50, 7.5, 50, "http://example.com/2.png")
+    index.add("req-3", "a shield", "", 50, 7.5, 50, "http://example.com/3.png")
+
+    assert len(index) == 2
+    assert index.find(PROMPT, "", 50, 7.5, 50) is None
@@ -0,0 +1,48 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.singleflight import SingleFlight
+
+
+# TC1: Concurrent callers for the same key share one execution
+def test_singleflight_coalesces_concurrent_calls():
+    flight = SingleFlight("test")
+    release = threading.Event()
+    calls = []
+
+    def slow_query():
+        calls.append(1)
+        release.wait(timeout=5)
+        return {"status": "Pending"}
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = [pool.submit(flight.do, "request-1", slow_query) for _ in range(8)]
+        while not flight._calls:
+            pass
+        # give the followers time to join the in-flight call before it finishes
+        threading.Event().wait(0.1)
+        release.set()
+        results = [future.result(timeout=5) for future in futures]
+
+    assert len(calls) == 1
+    assert all(result == {"status": "Pending"} for result in results)
+    assert flight.do("request-1", lambda: "fresh") == "fresh"
+
+
+# TC2: Errors propagate to the caller and do not stick to the key
+def test_singleflight_propagates_errors():
+    flight = SingleFlight("test")
+
+    def failing_query():
+        raise RuntimeError("db down")
+
+    with pytest.raises(RuntimeError):
+        flight.do("request-1", failing_query)
+
+    assert flight.do("request-1", lambda: 42) == 42
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import uuid
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+import pytest
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.status_updates import StatusUpdate, StatusResultConsumer, apply_batch, parse_result_message
+
+
+NOW = datetime(2025, 1, 1, 12, 0, 0)
+
+
+def update(request_id, status, image_url=None):
+    return StatusUpdate(request_id, status, image_url, None)
+
+
+# TC1: The batch goes out as one statement and every item gets its own outcome
+def test_apply_batch_outcomes():
+    done, cancelled, finished, overdue, missing = (uuid.uuid4() for _ in range(5))
+    session = MagicMock(spec=Session)
+    session.execute.return_value = [
+        (done, "Processing", False, None, True),
+        (cancelled, "Cancelled", False, None, False),
+        (finished, "Completed", False, None, False),
+        (overdue, "Pending", False, NOW - timedelta(seconds=1), False),
+    ]
+
+    outcomes = apply_batch(session, [
+        update(done, "Processing"),
+        update(done, "Completed", "http://example.com/a.png"),
+        update(cancelled, "Completed", "http://example.com/b.png"),
+        update(finished, "Processing"),
+        update(overdue, "Processing"),
+        update(missing, "Failed"),
+    ], now=NOW)
+
+    assert [outcome.result for outcome in outcomes] == ["superseded", "updated", "cancelled", "illegal_transition", "expired", "not_found"]
+    session.execute.assert_called_once()
+    statement, params = session.execute.call_args.args
+    assert "UPDATE generation_requests" in str(statement)
+    # duplicates are coalesced before the statement, the later report wins
+    assert params["status_0"] == "Completed"
+    assert "request_id_5" not in params
+
+
+# TC2: The consumer applies a drained batch once and acks every delivery up to the last
+def test_status_result_consumer_acks_batch():
+    request_id = uuid.uuid4()
+    channel = MagicMock()
+    apply = MagicMock(return_value=[])
+    consumer = StatusResultConsumer(MagicMock(), apply)
+    batch = [
+        (MagicMock(delivery_tag=1), json.dumps({"request_id": str(request_id), "status": "Completed", "image_url": "http://example.com/a.png"})),
+        (MagicMock(delivery_tag=2), json.dumps({"request_id": str(request_id), "status": "Exploded"})),
+    ]
+
+    consumer._apply(channel, batch)
+
+    updates = apply.call_args.args[1]
+    assert updates == [StatusUpdate(request_id, "Completed", "http://example.com/a.png", None)]
+    channel.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+    with pytest.raises(ValueError):
+        parse_result_message(batch[1][1])
+
+
+# TC3: A batch that fails to apply is requeued at once instead of being swept up by the next ack
+def test_status_result_consumer_nacks_failed_batch():
+    channel = MagicMock()
+    consumer = StatusResultConsumer(MagicMock(), MagicMock(side_effect=RuntimeError("database is down")))
+    batch = [
+        (MagicMock(delivery_tag=tag), json.dumps({"request_id": str(uuid.uuid4()), "status": "Completed"}))
+        for tag in (1, 2, 3)
+    ]
+
+    with pytest.raises(RuntimeError):
+        consumer._apply(channel, batch)
+
+    channel.basic_nack.assert_called_once_with(delivery_tag=3, multiple=True, requeue=True)
+    channel.basic_ack.assert_not_called()
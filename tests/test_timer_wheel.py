@@ -0,0 +1,39 @@
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from api_gateway.timer_wheel import HierarchicalTimerWheel
+
+
+# TC1: Timers fire on the first advance at or after their due time, never before
+def test_timer_wheel_fires_in_order_and_on_time():
+    wheel = HierarchicalTimerWheel(tick_seconds=1.0, slots=8, levels=2, now=0.0)
+    rng = random.Random(7)
+    due = {key: rng.uniform(0, 500) for key in range(300)}
+    for key, due_at in due.items():
+        wheel.add(key, due_at)
+
+    now, fired = 0.0, {}
+    while now < 510:
+        now += 0.5
+        for key in wheel.advance(now):
+            fired[key] = now
+
+    assert fired.keys() == due.keys()
+    assert all(due[key] <= fired[key] <= due[key] + 1.5 for key in due)
+    assert len(wheel) == 0
+
+
+# TC2: Overdue timers fire on the next advance, removed ones never fire
+def test_timer_wheel_overdue_and_remove():
+    wheel = HierarchicalTimerWheel(tick_seconds=1.0, now=100.0)
+    wheel.add("late", 50.0)
+    wheel.add("cancelled", 105.0)
+    wheel.add("later", 105.0)
+    wheel.remove("cancelled")
+
+    assert wheel.advance(100.0) == ["late"]
+    assert wheel.advance(106.0) == ["later"]
+    assert "cancelled" not in wheel